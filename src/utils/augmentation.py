@@ -0,0 +1,104 @@
+"""
+Vectorized data augmentation on images (uint8 ndarrays) and their boxes as (N, 4) integer arrays of
+xmin, ymin, xmax, ymax, a replacement of the per box dicts of get_hflip_img, get_scaled_img and get_bbox_list_resized.
+
+A transform only works on sizes and boxes: it is a function
+    transform(widths, heights, boxes, box_img) -> new_widths, new_heights, new_boxes, flipped
+where widths, heights are (nb_imgs,) int arrays, boxes is the (N, 4) array of the boxes of all images of the batch and
+box_img the (N,) index of the image of each box. Transforms are chained with compose, the returned function applies
+them to a whole batch: boxes are transformed for all images at once, then each image is resized once to its final
+size (and flipped if needed).
+Boxes are computed exactly as the bbox_helper functions applied one after the other.
+"""
+
+import numpy as np
+from img_utils import resize_img
+
+
+def _resize_boxes(boxes, box_img, widths, heights, new_widths, new_heights):
+    # same as get_bbox_list_resized: int(coordinate * float(new_size) / size)
+    width_r = new_widths.astype(np.float64) / widths
+    height_r = new_heights.astype(np.float64) / heights
+    ratios = np.stack([width_r, height_r, width_r, height_r], axis=1)[box_img]
+    return (boxes * ratios).astype(boxes.dtype)
+
+
+def hflip():
+    """horizontal flip, as get_hflip_img"""
+    def transform(widths, heights, boxes, box_img):
+        box_widths = widths[box_img]
+        new_boxes = boxes.copy()
+        new_boxes[:, 0] = box_widths - boxes[:, 2]
+        new_boxes[:, 2] = box_widths - boxes[:, 0]
+        return widths, heights, new_boxes, True
+    return transform
+
+
+def scale(new_width_r, new_height_r):
+    """scale width and height by a ratio, as get_scaled_img"""
+    def transform(widths, heights, boxes, box_img):
+        new_widths = (widths * float(new_width_r)).astype(widths.dtype)
+        new_heights = (heights * float(new_height_r)).astype(heights.dtype)
+        return new_widths, new_heights, _resize_boxes(boxes, box_img, widths, heights, new_widths, new_heights), False
+    return transform
+
+
+def resize_min_side(resized_img_min_size):
+    """resize so that the smaller side is resized_img_min_size, the size given by get_resized_img_size"""
+    def transform(widths, heights, boxes, box_img):
+        min_size = float(resized_img_min_size)
+        width_smaller = widths < heights
+        new_widths = np.where(width_smaller, resized_img_min_size, (widths * min_size / heights).astype(widths.dtype))
+        new_heights = np.where(width_smaller, (heights * min_size / widths).astype(heights.dtype), resized_img_min_size)
+        return new_widths, new_heights, _resize_boxes(boxes, box_img, widths, heights, new_widths, new_heights), False
+    return transform
+
+
+def random_hflip(prob=0.5, rng=np.random):
+    """flip each image of the batch with probability prob"""
+    def transform(widths, heights, boxes, box_img):
+        to_flip = rng.random_sample(len(widths)) < prob
+        box_widths = widths[box_img]
+        box_flipped = to_flip[box_img]
+        new_boxes = boxes.copy()
+        new_boxes[box_flipped, 0] = box_widths[box_flipped] - boxes[box_flipped, 2]
+        new_boxes[box_flipped, 2] = box_widths[box_flipped] - boxes[box_flipped, 0]
+        return widths, heights, new_boxes, to_flip
+    return transform
+
+
+def compose(*transforms):
+    """
+    chain transforms into an augmentation of a batch
+    :return: function(imgs, boxes_list) -> (new_imgs, new_boxes_list), imgs is a list of (height, width, ...) arrays,
+    boxes_list a list of (n_i, 4) integer arrays (one per image)
+    """
+    def augment_batch(imgs, boxes_list):
+        nb_imgs = len(imgs)
+        widths = np.array([img.shape[1] for img in imgs], dtype=np.int64)
+        heights = np.array([img.shape[0] for img in imgs], dtype=np.int64)
+        counts = [len(boxes) for boxes in boxes_list]
+        boxes = np.concatenate([np.asarray(b).reshape(-1, 4) for b in boxes_list], axis=0) if nb_imgs > 0 \
+            else np.zeros((0, 4), dtype=np.int64)
+        box_img = np.repeat(np.arange(nb_imgs), counts)
+
+        flipped = np.zeros(nb_imgs, dtype=bool)
+        new_widths, new_heights = widths, heights
+        for transform in transforms:
+            new_widths, new_heights, boxes, cur_flipped = transform(new_widths, new_heights, boxes, box_img)
+            flipped ^= cur_flipped
+
+        new_imgs = []
+        for i, img in enumerate(imgs):
+            img = resize_img(img, (new_heights[i], new_widths[i]))  # only one resize per image
+            if flipped[i]:
+                img = np.fliplr(img)
+            new_imgs.append(img)
+        return new_imgs, np.split(boxes, np.cumsum(counts)[:-1]) if nb_imgs > 0 else []
+    return augment_batch
+
+
+def augment(augment_batch, img, boxes):
+    """apply an augmentation built by compose to a single image and its (n, 4) boxes"""
+    new_imgs, new_boxes_list = augment_batch([img], [boxes])
+    return new_imgs[0], new_boxes_list[0]
@@ -0,0 +1,169 @@
+"""
+Class-aware batch sampling over the images of bbox_parser.
+build_class_index scans the bbox lists once and keeps, as compact int32 arrays (CSR layout), the ids (positions in
+img_infos) of the images of each class and the set of classes of each image. ClassBalancedSampler then draws
+batches of image ids in O(batch_size) without looking at the bbox lists again:
+    balanced: a class drawn uniformly among the classes having images, then one of its images
+    weighted: images drawn with a weight, the max of the weights of their classes (rare class oversampling)
+    shuffle:  plain shuffle of all images at every epoch
+Every batch only depends on (seed, epoch, batch index), so the stream is reproducible and can be sharded across
+data loader workers: shard k of n gets batches k, k + n, k + 2n, ... of the same stream, without overlap.
+"""
+
+import numpy as np
+from collections import namedtuple
+
+# class_img_ids[class_offsets[c]:class_offsets[c + 1]]: ids of the images having a box of class c (sorted)
+# img_class_ids[img_offsets[i]:img_offsets[i + 1]]: classes of the boxes of image i (sorted, unique)
+ClassIndex = namedtuple('ClassIndex', ['class_offsets', 'class_img_ids', 'img_offsets', 'img_class_ids'])
+
+SAMPLING_MODES = ('balanced', 'weighted', 'shuffle')
+
+
+def build_class_index(img_infos, class_to_idx):
+    """
+    :param img_infos: list of image dicts of bbox_parser
+    :param class_to_idx: dict class name -> label of bbox_parser ('bg' has no image)
+    :return: ClassIndex
+    """
+    img_classes = [sorted(set(class_to_idx[bbox['class']] for bbox in img_info['bbox'])) for img_info in img_infos]
+    nb_classes_per_img = np.array([len(classes) for classes in img_classes], dtype=np.int64)
+    img_offsets = np.zeros(len(img_infos) + 1, dtype=np.int64)
+    np.cumsum(nb_classes_per_img, out=img_offsets[1:])
+    img_class_ids = np.array([c for classes in img_classes for c in classes], dtype=np.int32)
+
+    # group the (image, class) pairs by class, stable so the images of a class stay sorted
+    pair_img_ids = np.repeat(np.arange(len(img_infos), dtype=np.int32), nb_classes_per_img)
+    order = np.argsort(img_class_ids, kind='stable')
+    class_offsets = np.zeros(len(class_to_idx) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(img_class_ids, minlength=len(class_to_idx)), out=class_offsets[1:])
+    return ClassIndex(class_offsets.astype(np.int32), pair_img_ids[order], img_offsets.astype(np.int32),
+                      img_class_ids)
+
+
+def nb_imgs_per_class(class_index):
+    return np.diff(class_index.class_offsets)
+
+
+def class_img_ids(class_index, class_idx):
+    return class_index.class_img_ids[class_index.class_offsets[class_idx]:class_index.class_offsets[class_idx + 1]]
+
+
+def img_class_ids(class_index, img_id):
+    return class_index.img_class_ids[class_index.img_offsets[img_id]:class_index.img_offsets[img_id + 1]]
+
+
+def batch_class_counts(class_index, img_ids):
+    """number of images of a batch having each class, to check the balance of a sampler"""
+    img_ids = np.asarray(img_ids)
+    starts = class_index.img_offsets[img_ids].astype(np.int64)
+    lengths = class_index.img_offsets[img_ids + 1] - starts
+    ends = np.cumsum(lengths)
+    positions = np.repeat(starts - ends + lengths, lengths) + np.arange(ends[-1] if len(ends) > 0 else 0)
+    return np.bincount(class_index.img_class_ids[positions], minlength=len(class_index.class_offsets) - 1)
+
+
+class ClassBalancedSampler(object):
+    """
+    iterate over the batches (int64 arrays of image ids) of an epoch, the epoch index is increased at every
+    iteration, as the shuffle of RPNDataLoader.
+    :param mode: one of SAMPLING_MODES
+    :param class_weights: weighted mode, weight of each class (array indexed by class label), default to
+    1 / sqrt(number of images of the class). An image is drawn with the max weight of its classes.
+    :param nb_batches: batches of an epoch (all shards together), default to as many as needed to see
+    len(img_infos) images. Balanced and weighted modes draw with replacement, their batches are always full.
+    In shuffle mode an epoch of more batches makes several passes over the images, each pass with its own
+    permutation (every image once per pass, the last batch of a pass is partial unless drop_last).
+    :param shard_idx, nb_shards: this sampler only yields the batches shard_idx, shard_idx + nb_shards, ...
+    """
+
+    def __init__(self, class_index, batch_size, mode='balanced', class_weights=None, nb_batches=None, seed=0,
+                 shard_idx=0, nb_shards=1, drop_last=False):
+        if mode not in SAMPLING_MODES:
+            raise ValueError('mode must be one of %s' % (SAMPLING_MODES,))
+        if not 0 <= shard_idx < nb_shards:
+            raise ValueError('shard_idx must be in [0, nb_shards)')
+        self.class_index = class_index
+        self.batch_size = batch_size
+        self.mode = mode
+        self.seed = seed
+        self.shard_idx = shard_idx
+        self.nb_shards = nb_shards
+        self.drop_last = drop_last
+        self.nb_imgs = len(class_index.img_offsets) - 1
+        if drop_last:
+            self._batches_per_pass = self.nb_imgs // batch_size
+        else:
+            self._batches_per_pass = (self.nb_imgs + batch_size - 1) // batch_size
+        if nb_batches is None:
+            nb_batches = self._batches_per_pass
+        if nb_batches < 0:
+            raise ValueError('nb_batches must be >= 0')
+        if mode == 'shuffle' and nb_batches > 0 and self._batches_per_pass == 0:
+            raise ValueError('no full batch of %d images among %d images' % (batch_size, self.nb_imgs))
+        self.nb_batches = nb_batches
+        self.epoch = 0
+
+        counts = nb_imgs_per_class(class_index)
+        self._sampled_classes = np.flatnonzero(counts > 0)
+        self._img_cum_weights = None
+        if mode == 'weighted':
+            if class_weights is None:
+                class_weights = np.where(counts > 0, 1. / np.sqrt(np.maximum(counts, 1)), 0.)
+            class_weights = np.asarray(class_weights, dtype=np.float64)
+            # max weight over the classes of each image (images without box get 0)
+            img_weights = np.zeros(self.nb_imgs, dtype=np.float64)
+            has_classes = np.diff(class_index.img_offsets) > 0
+            img_weights[has_classes] = np.maximum.reduceat(class_weights[class_index.img_class_ids],
+                                                           class_index.img_offsets[:-1][has_classes])
+            self._img_cum_weights = np.cumsum(img_weights)
+        self._permutation_key = None
+        self._permutation = None
+
+    def __len__(self):
+        return len(range(self.shard_idx, self.nb_batches, self.nb_shards))
+
+    def _rng(self, *keys):
+        return np.random.RandomState([self.seed] + list(keys))
+
+    def batch(self, batch_idx, epoch=None):
+        """image ids of the batch batch_idx of the (global, unsharded) stream of an epoch"""
+        epoch = self.epoch if epoch is None else epoch
+        if self.mode == 'shuffle':
+            pass_idx, pass_batch_idx = divmod(batch_idx, self._batches_per_pass)
+            if self._permutation_key != (epoch, pass_idx):  # one permutation per pass, shared by its batches
+                # the first pass keeps the key (seed, epoch) of a single pass epoch
+                keys = (epoch,) if pass_idx == 0 else (epoch, pass_idx, 0)
+                self._permutation = self._rng(*keys).permutation(self.nb_imgs)
+                self._permutation_key = (epoch, pass_idx)
+            start = pass_batch_idx * self.batch_size
+            return self._permutation[start:start + self.batch_size]
+        rng = self._rng(epoch, batch_idx)
+        if self.mode == 'balanced':
+            classes = self._sampled_classes[rng.randint(len(self._sampled_classes), size=self.batch_size)]
+            offsets = self.class_index.class_offsets[classes].astype(np.int64)
+            sizes = self.class_index.class_offsets[classes + 1] - offsets
+            positions = offsets + (rng.random_sample(self.batch_size) * sizes).astype(np.int64)
+            return self.class_index.class_img_ids[positions].astype(np.int64)
+        draws = rng.random_sample(self.batch_size) * self._img_cum_weights[-1]
+        img_ids = np.searchsorted(self._img_cum_weights, draws, side='right')
+        return np.minimum(img_ids, self.nb_imgs - 1)
+
+    def __iter__(self):
+        epoch = self.epoch
+        self.epoch += 1
+        for batch_idx in range(self.shard_idx, self.nb_batches, self.nb_shards):
+            yield self.batch(batch_idx, epoch)
+
+
+if __name__ == '__main__':
+    import sys
+    from bbox_helper import bbox_parser
+    img_infos, nb_img_per_class, class_to_idx = bbox_parser(sys.argv[1])
+    index = build_class_index(img_infos, class_to_idx)
+    print('%d images, %d classes, index of %d bytes'
+          % (len(img_infos), len(class_to_idx), sum(array.nbytes for array in index)))
+    for mode in SAMPLING_MODES:
+        sampler = ClassBalancedSampler(index, batch_size=32, mode=mode)
+        counts = sum(batch_class_counts(index, img_ids) for img_ids in sampler)
+        print('%s: images per class min %d max %d' % (mode, counts[:-1].min(), counts[:-1].max()))
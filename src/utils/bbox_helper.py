@@ -1,6 +1,6 @@
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
-from scipy.misc import imread, imresize, imsave, imshow
+from img_utils import load_img, load_img_resized, resize_img
 import numpy as np
 
 def bbox_parser(bbox_info_file, data_dir_path='/data/hav16/imagenet/'):
@@ -50,10 +50,64 @@ def bbox_parser(bbox_info_file, data_dir_path='/data/hav16/imagenet/'):
     return list(all_info.values()), nb_img_per_class, class_to_idx
 
 
+class BBoxStream(object):
+    """
+    streaming version of bbox_parser: iterating over it yields one image at a time in a single pass over the file,
+    so memory does not grow with the dataset. Lines of an image must be consecutive, which is the case of the files
+    written by generate_img_bbox (otherwise an image is yielded once per group of consecutive lines).
+    Each image is a dict with file_path, width, height, boxes (int32 (n, 4) xmin, ymin, xmax, ymax)
+    and class_ids (int32 (n,) labels of class_to_idx).
+    nb_img_per_class and class_to_idx are filled while iterating, class_to_idx gets 'bg' once the file is exhausted.
+    """
+
+    def __init__(self, bbox_info_file, data_dir_path='/data/hav16/imagenet/'):
+        if data_dir_path[-1] != '/':
+            data_dir_path += '/'
+        self.bbox_info_file = bbox_info_file
+        self.data_dir_path = data_dir_path
+        self.nb_img_per_class = {}
+        self.class_to_idx = {}
+
+    def __iter__(self):
+        self.nb_img_per_class = {}
+        self.class_to_idx = {}
+        cur_file_name = None
+        cur_info = None
+        with open(self.bbox_info_file, mode='r') as f:
+            for line in f:
+                if line == '':
+                    continue
+                info_list = line.replace('\n', '').split(',')
+
+                class_name = info_list[7]
+                self.nb_img_per_class[class_name] = self.nb_img_per_class.get(class_name, 0) + 1
+                if class_name not in self.class_to_idx:
+                    self.class_to_idx[class_name] = len(self.class_to_idx)
+
+                if info_list[0] != cur_file_name:
+                    if cur_info is not None:
+                        yield self._to_arrays(cur_info)
+                    cur_file_name = info_list[0]
+                    cur_info = {'file_path': self.data_dir_path + cur_file_name, 'width': int(info_list[1]),
+                                'height': int(info_list[2]), 'boxes': [], 'class_ids': []}
+                cur_info['boxes'].append((int(info_list[3]), int(info_list[4]), int(info_list[5]), int(info_list[6])))
+                cur_info['class_ids'].append(self.class_to_idx[class_name])
+        if cur_info is not None:
+            yield self._to_arrays(cur_info)
+        # add background 'bg' in class_to_idx:
+        self.class_to_idx['bg'] = len(self.class_to_idx)
+
+    @staticmethod
+    def _to_arrays(img_info):
+        img_info['boxes'] = np.array(img_info['boxes'], dtype=np.int32).reshape(-1, 4)
+        img_info['class_ids'] = np.array(img_info['class_ids'], dtype=np.int32)
+        return img_info
+
+
 def random_visualize_bbox_img(list_all_info, idx_to_show=None, show_hflip=False, new_width_r=1.0, new_height_r=1.0):
     if idx_to_show is None:
         idx_to_show = np.random.randint(len(list_all_info))
-    im = imread(list_all_info[idx_to_show]['file_path'])
+    im = load_img(list_all_info[idx_to_show]['file_path'])
     bb = list_all_info[idx_to_show]['bbox']
     show_img_with_bbox(im, bb)
     if new_height_r != 1.0 or new_width_r != 1.0:
@@ -66,9 +120,10 @@ def random_visualize_bbox_img(list_all_info, idx_to_show=None, show_hflip=False,
 
 
 def show_img_from_file(file_path, bbox_list, resized_width=None, resized_height=None, blocking=True):
-    img = imread(file_path)
     if resized_width is not None and resized_height is not None:
-        img = imresize(img, (resized_height, resized_width))
+        img = load_img_resized(file_path, resized_width, resized_height)
+    else:
+        img = load_img(file_path)
     show_img_with_bbox(img, bbox_list, blocking)
 
 
@@ -120,7 +175,7 @@ def get_scaled_img(img, bbox_list, new_width_r, new_height_r):
     new_height = int(height * new_height_r)
     new_width = int(width * new_width_r)
 
-    img_resized = imresize(img, (new_height, new_width))
+    img_resized = resize_img(img, (new_height, new_width))
     new_bbox_list = get_bbox_list_resized(bbox_list, width, height, new_width, new_height)
     return img_resized, new_bbox_list
 
@@ -4,29 +4,20 @@ This file helps to preprocess images from imagenet with bounding box
 
 import xml.etree.ElementTree as ET
 import os
+import time
+import shutil
+import multiprocessing
+import pickle
+import hashlib
+from collections import namedtuple
+import instrumentation
+import tar_source
 
 
 set_other_idx = set()
 
-
-def _get_int(name, root, box_idx=0):
-    """ find item with that name in the box with that box_idx then return its value in int"""
-    cur_idx = 0
-    for item in root.iter(name):
-        if cur_idx == box_idx:
-            return int(float(item.text))
-        cur_idx += 1  # go to next bounding box
-    # found no box with that box_idx
-    return -1
-
-
-def _get_number_bbox(root):
-    nb_box = 0
-    while True:
-        if _get_int('xmin', root, nb_box) == -1:
-            break
-        nb_box += 1
-    return nb_box
+# one valid bounding box of an annotation file, class_name is the english name of the object
+BBoxRecord = namedtuple('BBoxRecord', ['file_name', 'width', 'height', 'xmin', 'ymin', 'xmax', 'ymax', 'class_name'])
 
 
 def box_is_valid(xmin, ymin, xmax, ymax, width, height):
@@ -35,16 +26,29 @@ def box_is_valid(xmin, ymin, xmax, ymax, width, height):
     return False
 
 
-def process_xml_annotation(xml_file, class_name_dict, include_width_height=True, prefix_path=None):
-    """Find all bbox that contains the object by matching object_name. 
-    Note that an annotation folder can contain xml files of different folder name
-    and multiple objects    
-    Return empty string if bbox is invalid and/or does not contain any object in class_name_dict
-    if class_name_dict is None, return a string containing all valid boxes
-    class_name_dict[wnid] -> english name of that wnid
+def parse_xml_annotation(xml_file, class_name_dict, prefix_path=None):
+    """Find all valid bbox of objects in class_name_dict, return them as a list of BBoxRecord.
+    Same search as process_xml_annotation without formatting, so records of many files can be written at once.
+    class_name_dict[wnid] -> english name of that wnid, an empty dict gives no record
     """
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
+    records, other_folder = _parse_xml_annotation(xml_file, class_name_dict, prefix_path)
+    if other_folder is not None:
+        set_other_idx.add(other_folder)
+    return records
+
+
+def _parse_xml_annotation(xml_file, class_name_dict, prefix_path=None):
+    """parse_xml_annotation without touching set_other_idx,
+    return the records and the folder name to add to set_other_idx (None if nothing to add)"""
+    # annotation files are small: reading them in one go and building the tree with the C parser is faster
+    # than iterparse, each element is then visited once
+    with open(xml_file, mode='rb') as f:
+        return _parse_xml_content(f.read(), class_name_dict, prefix_path)
+
+
+def _parse_xml_content(xml_content, class_name_dict, prefix_path=None):
+    """_parse_xml_annotation of the content (bytes) of an xml file, e.g. a member of an archive"""
+    root = ET.fromstring(xml_content)
     folder_name = root.findtext('folder')
     img_file_name = root.findtext('filename') + '.JPEG'
     if prefix_path is not None:
@@ -52,32 +56,57 @@ def process_xml_annotation(xml_file, class_name_dict, include_width_height=True,
             prefix_path += '/'
         img_file_name = prefix_path + img_file_name
 
-    img_width = float(root.find('size').find('width').text)
-    img_height = float(root.find('size').find('height').text)
-
-    # find all bounding boxes that contain object in list_object_name
-    bbs = []
-    string_res = ''
-
-    for ob in root.findall('object'):
-        cur_obj = ob.find('name').text
+    size = root.find('size')
+    img_width = float(size.findtext('width'))
+    img_height = float(size.findtext('height'))
+
+    records = []
+    other_folder = None
+    nb_objects = 0
+    nb_invalid = 0
+    for ob in root.iterfind('object'):
+        nb_objects += 1
+        cur_obj = ob.findtext('name')
         if len(class_name_dict) == 0 or cur_obj in class_name_dict:
             bb = ob.find('bndbox')
-            xmin = int(float(bb.find('xmin').text))
-            ymin = int(float(bb.find('ymin').text))
-            xmax = int(float(bb.find('xmax').text))
-            ymax = int(float(bb.find('ymax').text))
+            xmin = int(float(bb.findtext('xmin')))
+            ymin = int(float(bb.findtext('ymin')))
+            xmax = int(float(bb.findtext('xmax')))
+            ymax = int(float(bb.findtext('ymax')))
             if box_is_valid(xmin, ymin, xmax, ymax, img_width, img_height):
-                bbs.append([xmin, ymin, xmax, ymax])
                 if cur_obj in class_name_dict:
-                    cur_obj = class_name_dict[cur_obj]  # change wnid to english name
-                    if include_width_height:
-                        string_res += '%s,%d,%d,%d,%d,%d,%d,%s\n' % (img_file_name, img_width, img_height, xmin, ymin, xmax, ymax, cur_obj)
-                    else:
-                        string_res += '%s,%d,%d,%d,%d,%s\n' % (img_file_name, xmin, ymin, xmax, ymax, cur_obj)
+                    records.append(BBoxRecord(img_file_name, int(img_width), int(img_height), xmin, ymin, xmax, ymax,
+                                              class_name_dict[cur_obj]))  # change wnid to english name
                 if len(class_name_dict) > 0 and folder_name not in class_name_dict:
-                    set_other_idx.add(folder_name)
-    return string_res
+                    other_folder = folder_name
+            else:
+                nb_invalid += 1
+    if instrumentation.get_recorder() is not None:
+        instrumentation.count('xml.files_parsed')
+        instrumentation.count('xml.objects', nb_objects)
+        instrumentation.count('xml.boxes_kept', len(records))
+        instrumentation.count('xml.boxes_rejected_invalid', nb_invalid)
+        instrumentation.count('xml.objects_other_class', nb_objects - len(records) - nb_invalid)
+    return records, other_folder
+
+
+def format_bbox_records(records, include_width_height=True):
+    """format a batch of BBoxRecord into lines of bbox info file,
+    img_file_name,im_width,im_height,xmin,ymin,xmax,ymax,object_name or without im_width,im_height"""
+    if include_width_height:
+        return ''.join(['%s,%d,%d,%d,%d,%d,%d,%s\n' % r for r in records])
+    return ''.join(['%s,%d,%d,%d,%d,%s\n' % (r.file_name, r.xmin, r.ymin, r.xmax, r.ymax, r.class_name)
+                    for r in records])
+
+
+def process_xml_annotation(xml_file, class_name_dict, include_width_height=True, prefix_path=None):
+    """Find all bbox that contains the object by matching object_name. 
+    Note that an annotation folder can contain xml files of different folder name
+    and multiple objects    
+    Return empty string if bbox is invalid and/or does not contain any object in class_name_dict
+    class_name_dict[wnid] -> english name of that wnid
+    """
+    return format_bbox_records(parse_xml_annotation(xml_file, class_name_dict, prefix_path), include_width_height)
 
 
 def process_folder_xml(folder_path, dest_file, class_name_dict, include_width_height=True, prefix_path=None):
@@ -103,68 +132,308 @@ def test_write_file():
                 f.write(string_info)
 
 
-def generate_img_bbox(annotation_path='/data/hav16/imagenet/Annotation/', dest_file='all_bbox.txt', class_name_dict={}, include_width_height=True, prefix_path=None):
+def _process_annotation_folders(folder_paths, dest_file, class_name_dict, include_width_height=True, prefix_path=None):
+    """write bbox info of all xml files in folder_paths (sorted by file name) to dest_file.
+    Return the number of xml files processed"""
+    nb_xml = 0
+    with open(dest_file, mode='w') as res_file:
+        for folder_path in folder_paths:
+            with instrumentation.timer('annotations.list_dir'):
+                xml_files = [f for f in os.listdir(folder_path) if f.endswith('.xml')]
+                xml_files = sorted(xml_files)
+            records = []
+            with instrumentation.timer('annotations.parse_xml'):
+                for xml_f in xml_files:
+                    records.extend(parse_xml_annotation(folder_path + '/' + xml_f, class_name_dict, prefix_path))
+            with instrumentation.timer('annotations.write'):
+                res_file.write(format_bbox_records(records, include_width_height))  # one write per folder
+            nb_xml += len(xml_files)
+    return nb_xml
+
+
+def _process_annotation_archive(archive_path, dest_file, class_name_dict, include_width_height=True,
+                                prefix_path=None):
+    """_process_annotation_folders of the xml files of an archive, streamed without extracting them.
+    The records of a folder (synset) are written, xml files sorted, as soon as the archive moves past the folder,
+    so only one folder is held in memory. Folders are written in the order of the archive: the same file as for
+    the extracted directory when the archive lists its folders sorted (e.g. tar --sort=name, or Annotation.tar.gz
+    of ImageNet, one archive per synset). A folder spread over the archive gives several groups of lines.
+    Return the number of xml files and of folders processed"""
+    nb_xml = 0
+    folders = set()
+    with open(dest_file, mode='w') as res_file:
+
+        def write_folder(file_records):
+            records = []
+            for _, records_of_file in sorted(file_records, key=lambda file_entry: file_entry[0]):
+                records.extend(records_of_file)
+            with instrumentation.timer('annotations.write'):
+                res_file.write(format_bbox_records(records, include_width_height))
+
+        cur_folder, cur_file_records = None, []
+        for member_name, xml_content in tar_source.iter_archive_members(archive_path, '.xml'):
+            path_parts = member_name.rsplit('/', 2)
+            folder = path_parts[-2] if len(path_parts) > 1 else ''
+            if folder != cur_folder:
+                write_folder(cur_file_records)
+                cur_folder, cur_file_records = folder, []
+                folders.add(folder)
+            with instrumentation.timer('annotations.parse_xml'):
+                records, other_folder = _parse_xml_content(xml_content, class_name_dict, prefix_path)
+            if other_folder is not None:
+                set_other_idx.add(other_folder)
+            cur_file_records.append((path_parts[-1], records))
+            nb_xml += 1
+        write_folder(cur_file_records)
+    return nb_xml, len(folders)
+
+
+def _process_annotation_shard(shard_args):
+    """worker of generate_img_bbox: process a shard of folders into its own shard file.
+    set_other_idx lives in the worker process so it is sent back to the parent with the number of xml files,
+    so are the instrumentation stats when the parent records them"""
+    set_other_idx.clear()
+    folders_args, instrumented = shard_args
+    recorder = instrumentation.StatsRecorder() if instrumented else None
+    previous_recorder = instrumentation.set_recorder(recorder)
+    try:
+        nb_xml = _process_annotation_folders(*folders_args)
+    finally:
+        instrumentation.set_recorder(previous_recorder)
+    return nb_xml, set(set_other_idx), recorder.report() if instrumented else None
+
+
+def generate_img_bbox(annotation_path='/data/hav16/imagenet/Annotation/', dest_file='all_bbox.txt', class_name_dict={},
+                      include_width_height=True, prefix_path=None, nb_workers=1):
+    """extract bbox info from all xml files in the sub folders (one per synset) of annotation_path to dest_file.
+    Folders and xml files are processed in sorted order.
+    A single process by default. If nb_workers > 1, contiguous shards of folders are processed by a pool of
+    nb_workers processes, each writing its own shard file next to dest_file, shards are then concatenated in folder
+    order so dest_file is the same as with a single process. nb_workers=None uses all cpus.
+    annotation_path can also be an archive (.tar, .tar.gz, .tgz, see tar_source.py) of the sub folders, or of an
+    archive per sub folder, it is then streamed by a single process without extracting it, folders in the order
+    of the archive (see _process_annotation_archive)"""
+    start_time = time.time()
+    if tar_source.is_archive(annotation_path):
+        nb_xml, nb_folders = _process_annotation_archive(annotation_path, dest_file, class_name_dict,
+                                                         include_width_height, prefix_path)
+        instrumentation.count('annotations.xml_files', nb_xml)
+        print(set_other_idx)
+        print('processed %d xml files in %d folders of %s in %.1fs'
+              % (nb_xml, nb_folders, annotation_path, time.time() - start_time))
+        return
+    dirs = sorted(os.listdir(annotation_path))
+    folder_paths = [annotation_path + '/' + d for d in dirs]
+    if nb_workers is None:
+        nb_workers = multiprocessing.cpu_count()
+    nb_workers = max(1, min(nb_workers, len(folder_paths)))
+
+    if nb_workers == 1:
+        nb_xml = _process_annotation_folders(folder_paths, dest_file, class_name_dict, include_width_height, prefix_path)
+    else:
+        # a few shards per worker to balance synsets of different sizes
+        nb_shards = min(len(folder_paths), 4 * nb_workers)
+        shard_files = ['%s.shard%d' % (dest_file, i) for i in range(nb_shards)]
+        recorder = instrumentation.get_recorder()
+        shard_args = [((folder_paths[i * len(folder_paths) // nb_shards: (i + 1) * len(folder_paths) // nb_shards],
+                        shard_files[i], class_name_dict, include_width_height, prefix_path), recorder is not None)
+                      for i in range(nb_shards)]
+        pool = multiprocessing.Pool(nb_workers)
+        try:
+            try:
+                shard_results = pool.map(_process_annotation_shard, shard_args)
+            finally:
+                pool.close()
+                pool.join()
+            nb_xml = 0
+            for shard_nb_xml, shard_other_idx, shard_stats in shard_results:
+                nb_xml += shard_nb_xml
+                set_other_idx.update(shard_other_idx)
+                if shard_stats is not None and hasattr(recorder, 'merge'):
+                    recorder.merge(shard_stats)
+            with instrumentation.timer('annotations.merge_shards'):
+                with open(dest_file, mode='w') as res_file:
+                    for shard_file in shard_files:
+                        with open(shard_file) as f:
+                            shutil.copyfileobj(f, res_file)
+        finally:
+            # also when a worker raised: no shard file is left next to dest_file
+            for shard_file in shard_files:
+                if os.path.isfile(shard_file):
+                    os.remove(shard_file)
+
+    instrumentation.count('annotations.xml_files', nb_xml)
+    print(set_other_idx)
+    print('processed %d xml files in %d folders with %d worker(s) in %.1fs'
+          % (nb_xml, len(folder_paths), nb_workers, time.time() - start_time))
+
+
+def _file_signature(file_path, use_hash=False):
+    """(size, mtime in ns) of a file, or (size, md5 of its content) when use_hash"""
+    if use_hash:
+        with open(file_path, mode='rb') as f:
+            content = f.read()
+        return len(content), hashlib.md5(content).hexdigest()
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def generate_img_bbox_incremental(annotation_path='/data/hav16/imagenet/Annotation/', dest_file='all_bbox.txt',
+                                  class_name_dict={}, include_width_height=True, prefix_path=None,
+                                  manifest_file='annotation_manifest.pkl', use_hash=False):
+    """same result as generate_img_bbox, but the records parsed from each xml file are kept in manifest_file with
+    the (size, mtime) of the file, or (size, content hash) if use_hash. Next runs only parse new or modified files,
+    drop deleted ones and rebuild dest_file from the manifest.
+    The manifest is discarded when class_name_dict or prefix_path differ from the ones it was built with."""
+    if tar_source.is_archive(annotation_path):
+        raise ValueError('the incremental mode needs an annotation directory, use generate_img_bbox on archives')
+    start_time = time.time()
+    settings = (sorted(class_name_dict.items()), prefix_path)
+    entries = {}  # relative path of xml file -> (signature, records, other folder)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file, mode='rb') as f:
+            manifest = pickle.load(f)
+        if manifest['settings'] == settings and manifest['use_hash'] == use_hash:
+            entries = manifest['entries']
+
+    new_entries = {}
+    nb_parsed = 0
+    dirs = sorted(os.listdir(annotation_path))
     with open(dest_file, mode='w') as res_file:
-        dirs = sorted(os.listdir(annotation_path))
         for d in dirs:
             folder_path = annotation_path + '/' + d
             xml_files = [f for f in os.listdir(folder_path) if f.endswith('.xml')]
             xml_files = sorted(xml_files)
+            records = []
             for xml_f in xml_files:
-                string_info = process_xml_annotation(folder_path + '/' + xml_f, class_name_dict, include_width_height, prefix_path)
-                # print(string_info)
-                if string_info != '':
-                    res_file.write(string_info)
+                rel_path = d + '/' + xml_f
+                signature = _file_signature(folder_path + '/' + xml_f, use_hash)
+                entry = entries.get(rel_path)
+                if entry is None or entry[0] != signature:
+                    file_records, other_folder = _parse_xml_annotation(folder_path + '/' + xml_f, class_name_dict,
+                                                                       prefix_path)
+                    entry = (signature, file_records, other_folder)
+                    nb_parsed += 1
+                new_entries[rel_path] = entry
+                records.extend(entry[1])
+                if entry[2] is not None:
+                    set_other_idx.add(entry[2])
+            res_file.write(format_bbox_records(records, include_width_height))
+
+    nb_deleted = len(set(entries) - set(new_entries))
+    instrumentation.count('annotations.xml_files', len(new_entries))
+    instrumentation.count('annotations.xml_from_manifest', len(new_entries) - nb_parsed)
+    tmp_manifest_file = manifest_file + '.tmp'
+    with open(tmp_manifest_file, mode='wb') as f:
+        pickle.dump({'settings': settings, 'use_hash': use_hash, 'entries': new_entries}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_manifest_file, manifest_file)  # a crash never leaves a half written manifest
 
     print(set_other_idx)
+    print('%d xml files: %d parsed, %d from manifest, %d deleted in %.1fs'
+          % (len(new_entries), nb_parsed, len(new_entries) - nb_parsed, nb_deleted, time.time() - start_time))
 
 
 def get_imgs_having_bbox(bbox_info_file):
-    list_img = set()
-    with open(bbox_info_file) as f:
-        for line in f:
-            if line != '':
-                img_name = line.split(',')[0]
-                list_img.add(img_name)
-    return list(list_img)
-
-
-def remove_no_bbox_imgs(path_to_all_imgs, bbox_info_file='all_bbox.txt'):
-    """note that there are a lot of images without bbox -> remove them"""
-    # first find all images in path_to_imgs:
+    """set of image names (first field) of a bbox info file"""
+    set_img = set()
+    with instrumentation.timer('clean.read_bbox_info'):
+        with open(bbox_info_file) as f:
+            for line in f:
+                if line != '':
+                    img_name = line.split(',', 1)[0]
+                    set_img.add(img_name)
+    return set_img
+
+
+def index_img_dir(path_to_all_imgs, ext='.JPEG'):
+    """set of image file names (without path) in path_to_all_imgs, listed with a single os.scandir,
+    or in the uncompressed .tar path_to_all_imgs, listed from its cached index (tar_source.TarReader)"""
+    with instrumentation.timer('clean.list_img_dir'):
+        if tar_source.is_archive(path_to_all_imgs):
+            img_index = set(tar_source.TarReader(path_to_all_imgs).file_names(ext))
+        else:
+            with os.scandir(path_to_all_imgs) as it:
+                img_index = set(e.name for e in it if e.name.endswith(ext) and e.is_file())
+    instrumentation.count('clean.imgs_listed', len(img_index))
+    return img_index
+
+
+def _img_key(img_name):
+    """image names in bbox info files may or may not carry the prefix path, images are compared by file name"""
+    return img_name.rsplit('/', 1)[-1]
+
+
+def remove_no_bbox_imgs(path_to_all_imgs, bbox_info_file='all_bbox.txt', dry_run=False, manifest=None, img_index=None):
+    """note that there are a lot of images without bbox -> remove them
+    :param path_to_all_imgs: directory or uncompressed .tar of the images, images are never removed from a .tar
+    (as with dry_run), they are only left out of the clean bbox info file
+    :param dry_run: only report what would be removed, no file is touched
+    :param manifest: opened file, a line remove,<image path> is written for each image (to be) removed
+    :param img_index: result of index_img_dir(path_to_all_imgs), computed if not given
+    :return: number of images (to be) removed
+    """
+    if img_index is None:
+        img_index = index_img_dir(path_to_all_imgs)
+    if tar_source.is_archive(path_to_all_imgs):
+        dry_run = True
     if path_to_all_imgs[-1] != '/':
-        path_to_all_imgs += '/'
-    all_img_files = ['%s%s' % (path_to_all_imgs, e) for e in os.listdir(path_to_all_imgs) if e.endswith('.JPEG')]
+        path_to_all_imgs += '/'  # in the manifest, images of an archive are archive/image
     imgs_with_bbox = get_imgs_having_bbox(bbox_info_file)
-    for e in all_img_files:
-        if e not in imgs_with_bbox:
-            os.remove(path_to_all_imgs + '/' + e)
-
-
-def write_clean_img_bbox(path_to_all_imgs, bbox_info_file='all_bbox.txt', clean_bbox_info_file='clean_bbox.txt'):
-    """note that there are lacking images, some annotated images are not found in .tar file"""
-    if path_to_all_imgs[-1] != '/':
-        path_to_all_imgs += '/'
-    all_img_files = ['%s%s' % (path_to_all_imgs, e) for e in os.listdir(path_to_all_imgs) if e.endswith('.JPEG')]
-    print(all_img_files[0])
+    with instrumentation.timer('clean.membership'):
+        imgs_with_bbox = set(_img_key(e) for e in imgs_with_bbox)
+        to_remove = sorted(img_index - imgs_with_bbox)
+    with instrumentation.timer('clean.remove_imgs'):
+        for e in to_remove:
+            if manifest is not None:
+                manifest.write('remove,%s%s\n' % (path_to_all_imgs, e))
+            if not dry_run:
+                os.remove(path_to_all_imgs + e)
+    instrumentation.count('clean.imgs_removed' if not dry_run else 'clean.imgs_to_remove', len(to_remove))
+    return len(to_remove)
+
+
+def write_clean_img_bbox(path_to_all_imgs, bbox_info_file='all_bbox.txt', clean_bbox_info_file='clean_bbox.txt',
+                         dry_run=False, manifest=None, img_index=None):
+    """note that there are lacking images, some annotated images are not found in .tar file
+    :param dry_run: only report the lacking images, clean_bbox_info_file is not written
+    :param manifest: opened file, a line drop,<image name> is written for each annotated image that is lacking
+    :param img_index: result of index_img_dir(path_to_all_imgs), computed if not given
+    :return: number of lacking images
+    """
+    if img_index is None:
+        img_index = index_img_dir(path_to_all_imgs)
     # first find all lacking images
-    lacking_imgs = []
-    imgs_having_bbox = get_imgs_having_bbox(bbox_info_file)
-    for e in imgs_having_bbox:
-        if e not in all_img_files:
-            lacking_imgs.append(e)
+    imgs_with_bbox = get_imgs_having_bbox(bbox_info_file)
+    with instrumentation.timer('clean.membership'):
+        lacking_imgs = set(e for e in imgs_with_bbox if _img_key(e) not in img_index)
+    instrumentation.count('clean.annotated_imgs_lacking', len(lacking_imgs))
+    if manifest is not None:
+        for e in sorted(lacking_imgs):
+            manifest.write('drop,%s\n' % e)
+    if dry_run:
+        return len(lacking_imgs)
     # write clean bbox info file
-    with open(clean_bbox_info_file, mode='w') as clean_file:
-        with open(bbox_info_file) as all_file:
-            for line in all_file:
-                if line != '':
-                    img_name = line.split(',')[0]
-                    if img_name not in lacking_imgs:
-                        clean_file.write(line)
+    nb_lines = 0
+    nb_kept = 0
+    with instrumentation.timer('clean.write_clean_bbox_info'):
+        with open(clean_bbox_info_file, mode='w') as clean_file:
+            with open(bbox_info_file) as all_file:
+                for line in all_file:
+                    if line != '':
+                        nb_lines += 1
+                        img_name = line.split(',', 1)[0]
+                        if img_name not in lacking_imgs:
+                            clean_file.write(line)
+                            nb_kept += 1
+    instrumentation.count('clean.bbox_lines_kept', nb_kept)
+    instrumentation.count('clean.bbox_lines_dropped', nb_lines - nb_kept)
+    return len(lacking_imgs)
 
 
 def split_trainval_test(clean_bbox_info_file, trainval_file, test_file):
-    """split from clean bbox file into 2 files with 9:1 ratio"""
+    """split from clean bbox file into 2 files with 9:1 ratio, by line: the boxes of an image can end up in both
+    files, split_bbox_info splits by image"""
     cnt = 0
     with open(clean_bbox_info_file, mode='r') as f:
         with open(trainval_file, mode='w') as train_val_f:
@@ -179,11 +448,134 @@ def split_trainval_test(clean_bbox_info_file, trainval_file, test_file):
                             train_val_f.write(line)
 
 
-def clean_data(path_to_all_imgs, bbox_info_file, clean_bbox_info_file):
-    print('removing images without bbox')
-    remove_no_bbox_imgs(path_to_all_imgs, bbox_info_file)
-    print('write clean bbox info file')
-    write_clean_img_bbox(path_to_all_imgs, bbox_info_file, clean_bbox_info_file)
+def _split_hash(img_name, seed=0):
+    """stable uniform number in [0, 1) of an image name, the same for every run, python version and machine"""
+    digest = hashlib.md5(('%d:%s' % (seed, img_name)).encode('utf-8')).hexdigest()
+    return int(digest[:13], 16) / float(16 ** 13)
+
+
+def _iter_img_lines(bbox_info_file):
+    """(img_name, class_name, lines) of each image of a bbox info file, lines of an image must be contiguous
+    (as written by generate_img_bbox and write_clean_img_bbox), class_name is the one of its first box"""
+    img_name, class_name, lines = None, None, []
+    with open(bbox_info_file, mode='r') as f:
+        for line in f:
+            if line.strip() == '':
+                continue
+            name = line.split(',', 1)[0]
+            if name != img_name:
+                if lines:
+                    yield img_name, class_name, lines
+                img_name, class_name, lines = name, line.rstrip('\r\n').rsplit(',', 1)[-1], []
+            lines.append(line)
+    if lines:
+        yield img_name, class_name, lines
+
+
+def _assign_split(img_name, class_name, ratios, split_counts, seed=0):
+    """
+    index of the split of an image
+    :param ratios: list of the ratios of the splits, summing to 1
+    :param split_counts: None to draw the split from the hash of img_name only (stateless), or a dict
+    class_name -> number of images already assigned to each split (updated): the split lagging the most behind its
+    ratio among the images of the class is chosen (running stratification), ties broken by the hash of img_name
+    """
+    u = _split_hash(img_name, seed)
+    if split_counts is None:
+        cumulative = 0.
+        for split_idx, ratio in enumerate(ratios):
+            cumulative += ratio
+            if u < cumulative:
+                return split_idx
+        return len(ratios) - 1
+    counts = split_counts.setdefault(class_name, [0] * len(ratios))
+    nb_imgs = sum(counts) + 1
+    deficits = [ratio * nb_imgs - count for ratio, count in zip(ratios, counts)]
+    max_deficit = max(deficits)
+    candidates = [split_idx for split_idx, deficit in enumerate(deficits) if deficit >= max_deficit - 1e-9]
+    split_idx = candidates[int(u * len(candidates))]
+    counts[split_idx] += 1
+    return split_idx
+
+
+def split_bbox_info(bbox_info_file, split_files, ratios, stratify=False, seed=0):
+    """
+    split a bbox info file by image (all the boxes of an image go to the same split) in one streaming pass,
+    the split of an image comes from a stable hash of its name, so it does not depend on the other images
+    (except with stratify) and adding images to the dataset does not move the others
+    :param split_files: a file for each split, e.g. ['train_val.txt', 'test.txt']
+    :param ratios: ratio of the images of each split, e.g. [0.9, 0.1], normalized to sum to 1
+    :param stratify: keep the ratios within each class (class of the first box of an image) with running counts
+    :param seed: another seed gives another split
+    :return: number of images and number of lines of each split
+    """
+    if len(split_files) != len(ratios):
+        raise ValueError('one ratio is needed for each split file')
+    ratios = [float(ratio) / sum(ratios) for ratio in ratios]
+    split_counts = {} if stratify else None
+    nb_imgs = [0] * len(split_files)
+    nb_lines = [0] * len(split_files)
+    outputs = [open(split_file, mode='w') for split_file in split_files]
+    try:
+        for img_name, class_name, lines in _iter_img_lines(bbox_info_file):
+            split_idx = _assign_split(img_name, class_name, ratios, split_counts, seed)
+            outputs[split_idx].write(''.join(lines))
+            nb_imgs[split_idx] += 1
+            nb_lines[split_idx] += len(lines)
+    finally:
+        for output in outputs:
+            output.close()
+    for split_idx, split_file in enumerate(split_files):
+        instrumentation.count('split.imgs.%s' % os.path.basename(split_file), nb_imgs[split_idx])
+    return nb_imgs, nb_lines
+
+
+def kfold_bbox_info(bbox_info_file, nb_folds, train_file_pattern='train_%d.txt', test_file_pattern='test_%d.txt',
+                    stratify=False, seed=0):
+    """
+    k-fold split of a bbox info file by image in one streaming pass: each image goes to one fold (as in
+    split_bbox_info with nb_folds equal ratios), the lines of fold k are written to test_file_pattern % k and to the
+    train files of every other fold
+    :return: number of images of each fold
+    """
+    ratios = [1. / nb_folds] * nb_folds
+    split_counts = {} if stratify else None
+    nb_imgs = [0] * nb_folds
+    train_files = [open(train_file_pattern % fold, mode='w') for fold in range(nb_folds)]
+    test_files = [open(test_file_pattern % fold, mode='w') for fold in range(nb_folds)]
+    try:
+        for img_name, class_name, lines in _iter_img_lines(bbox_info_file):
+            img_fold = _assign_split(img_name, class_name, ratios, split_counts, seed)
+            img_lines = ''.join(lines)
+            test_files[img_fold].write(img_lines)
+            for fold in range(nb_folds):
+                if fold != img_fold:
+                    train_files[fold].write(img_lines)
+            nb_imgs[img_fold] += 1
+    finally:
+        for output in train_files + test_files:
+            output.close()
+    return nb_imgs
+
+
+def clean_data(path_to_all_imgs, bbox_info_file, clean_bbox_info_file, dry_run=False, manifest_file=None):
+    """remove images without bbox and write the bbox info of the images found in path_to_all_imgs.
+    With dry_run nothing is removed or written except manifest_file, listing the images to remove and to drop.
+    path_to_all_imgs can be an uncompressed .tar of the images, nothing is removed from it"""
+    img_index = index_img_dir(path_to_all_imgs)
+    manifest = open(manifest_file, mode='w') if manifest_file is not None else None
+    try:
+        print('removing images without bbox')
+        nb_removed = remove_no_bbox_imgs(path_to_all_imgs, bbox_info_file, dry_run, manifest, img_index)
+        print('write clean bbox info file')
+        nb_lacking = write_clean_img_bbox(path_to_all_imgs, bbox_info_file, clean_bbox_info_file, dry_run, manifest,
+                                          img_index)
+    finally:
+        if manifest is not None:
+            manifest.close()
+    print('%s %d images without bbox, %d annotated images lacking'
+          % ('would remove' if dry_run or tar_source.is_archive(path_to_all_imgs) else 'removed', nb_removed,
+             nb_lacking))
 
 
 def get_class_name_dict(class_name_file='class_name.txt'):
@@ -204,4 +596,4 @@ if __name__ == '__main__':
     dest_clean_file = 'clean_bbox_v2.txt'
     # generate_img_bbox(annot_path, dest_file, dict_wnid_name, include_width_height=False, prefix_path=data_path)
     # clean_data(data_path, dest_file, dest_clean_file)
-    split_trainval_test('clean_bbox_v2.txt', 'train_val.txt', 'test.txt')
\ No newline at end of file
+    split_bbox_info('clean_bbox_v2.txt', ['train_val.txt', 'test.txt'], [0.9, 0.1])
\ No newline at end of file
@@ -0,0 +1,137 @@
+"""
+Compact columnar store of a bbox info file (e.g. clean_bbox.txt), an alternative to parsing the csv with bbox_parser.
+A store is a directory of .npy arrays that are memory-mapped when loaded, so processes reading the same store share
+their pages instead of each holding the whole dataset as dicts:
+    boxes.npy        int32 (nb_boxes, 4) xmin, ymin, xmax, ymax, grouped by image
+    class_ids.npy    uint16 (nb_boxes,) index of the class of each box in classes.txt
+    img_offsets.npy  int64 (nb_imgs + 1,) boxes of image i are boxes[img_offsets[i]:img_offsets[i + 1]]
+    img_width.npy    int32 (nb_imgs,)
+    img_height.npy   int32 (nb_imgs,)
+    names.npy        uint8 utf-8 bytes of all file names concatenated
+    name_offsets.npy int64 (nb_imgs + 1,) file name of image i is names[name_offsets[i]:name_offsets[i + 1]]
+    classes.txt      class names, one per line, in the order of class_to_idx of bbox_parser
+Images and classes keep the order of their first appearance in the csv file, like bbox_parser.
+"""
+
+import os
+import numpy as np
+
+_ARRAY_NAMES = ['boxes', 'class_ids', 'img_offsets', 'img_width', 'img_height', 'names', 'name_offsets']
+
+
+def compile_bbox_store(bbox_info_file, store_path):
+    """
+    convert a bbox info file into a store
+    :param bbox_info_file: csv file_name, width, height, xmin, ymin, xmax, ymax, class_name (format read by bbox_parser)
+    :param store_path: directory of the store, created if needed
+    :return: number of images, number of boxes
+    """
+    img_to_idx = {}  # file name -> image index, in order of first appearance
+    img_width = []
+    img_height = []
+    class_to_idx = {}
+    line_img = []
+    line_class = []
+    line_boxes = []
+    with open(bbox_info_file, mode='r') as f:
+        for line in f:
+            if line == '' or line == '\n':
+                continue
+            info_list = line.replace('\n', '').split(',')
+            file_name = info_list[0]
+            if file_name not in img_to_idx:
+                img_to_idx[file_name] = len(img_to_idx)
+                img_width.append(int(info_list[1]))
+                img_height.append(int(info_list[2]))
+            class_name = info_list[7]
+            if class_name not in class_to_idx:
+                class_to_idx[class_name] = len(class_to_idx)
+            line_img.append(img_to_idx[file_name])
+            line_class.append(class_to_idx[class_name])
+            line_boxes.append((int(info_list[3]), int(info_list[4]), int(info_list[5]), int(info_list[6])))
+
+    if len(class_to_idx) > np.iinfo(np.uint16).max:
+        raise ValueError('too many classes for uint16 class ids: %d' % len(class_to_idx))
+    # group boxes by image, a stable sort keeps the order of the lines inside an image
+    order = np.argsort(np.array(line_img, dtype=np.int64), kind='stable')
+    boxes = np.array(line_boxes, dtype=np.int32).reshape(-1, 4)[order]
+    class_ids = np.array(line_class, dtype=np.uint16)[order]
+    img_offsets = np.zeros(len(img_to_idx) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(np.array(line_img, dtype=np.int64), minlength=len(img_to_idx)), out=img_offsets[1:])
+
+    encoded_names = [name.encode('utf-8') for name in img_to_idx]  # dict keeps the image order
+    name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+    names = np.frombuffer(b''.join(encoded_names), dtype=np.uint8)
+
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+    arrays = {'boxes': boxes, 'class_ids': class_ids, 'img_offsets': img_offsets,
+              'img_width': np.array(img_width, dtype=np.int32), 'img_height': np.array(img_height, dtype=np.int32),
+              'names': names, 'name_offsets': name_offsets}
+    for array_name in _ARRAY_NAMES:
+        np.save(os.path.join(store_path, array_name + '.npy'), arrays[array_name])
+    with open(os.path.join(store_path, 'classes.txt'), mode='w') as f:
+        for class_name in class_to_idx:
+            f.write(class_name + '\n')
+    return len(img_to_idx), len(boxes)
+
+
+class BBoxStore(object):
+    """read-only view of a store compiled by compile_bbox_store, arrays are memory-mapped (np.load mmap_mode='r')"""
+
+    def __init__(self, store_path, data_dir_path='/data/hav16/imagenet/'):
+        if data_dir_path[-1] != '/':
+            data_dir_path += '/'
+        self.data_dir_path = data_dir_path
+        for array_name in _ARRAY_NAMES:
+            setattr(self, array_name, np.load(os.path.join(store_path, array_name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(store_path, 'classes.txt')) as f:
+            self.class_names = [line.replace('\n', '') for line in f if line != '\n']
+
+    def __len__(self):
+        return len(self.img_width)
+
+    def file_name(self, img_idx):
+        return self.names[self.name_offsets[img_idx]:self.name_offsets[img_idx + 1]].tobytes().decode('utf-8')
+
+    def img_boxes(self, img_idx):
+        """boxes (view on the store) and class ids of an image"""
+        start, end = self.img_offsets[img_idx], self.img_offsets[img_idx + 1]
+        return self.boxes[start:end], self.class_ids[start:end]
+
+    def img_info(self, img_idx):
+        """info of an image in the format of bbox_parser"""
+        boxes, class_ids = self.img_boxes(img_idx)
+        bbox = [{'class': self.class_names[class_id], 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
+                for (xmin, ymin, xmax, ymax), class_id in zip(boxes.tolist(), class_ids.tolist())]
+        return {'width': int(self.img_width[img_idx]), 'height': int(self.img_height[img_idx]),
+                'file_path': self.data_dir_path + self.file_name(img_idx), 'bbox': bbox}
+
+    def all_info(self):
+        return [self.img_info(i) for i in range(len(self))]
+
+    def nb_img_per_class(self):
+        """number of boxes of each class, as nb_img_per_class of bbox_parser"""
+        counts = np.bincount(self.class_ids, minlength=len(self.class_names))
+        return dict(zip(self.class_names, counts.tolist()))
+
+    def class_to_idx(self):
+        """class name to label, the background 'bg' is added at the end as in bbox_parser"""
+        class_to_idx = dict((class_name, idx) for idx, class_name in enumerate(self.class_names))
+        class_to_idx['bg'] = len(class_to_idx)
+        return class_to_idx
+
+
+def bbox_store_parser(store_path, data_dir_path='/data/hav16/imagenet/'):
+    """same outputs as bbox_parser, read from a compiled store
+    :return: a list of dictionary's value, a dict of nb img per class, a dict of class to idx"""
+    store = BBoxStore(store_path, data_dir_path)
+    return store.all_info(), store.nb_img_per_class(), store.class_to_idx()
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python bbox_store.py bbox_info_file store_path
+    nb_imgs, nb_boxes = compile_bbox_store(sys.argv[1], sys.argv[2])
+    print('compiled %d images, %d boxes into %s' % (nb_imgs, nb_boxes, sys.argv[2]))
@@ -0,0 +1,319 @@
+"""
+Benchmarks of the data preparation hot paths, they run offline on synthetic data.
+usage: python benchmarks.py [--results-dir=dir] [benchmark_name ...] (run all benchmarks when no name is given)
+the pipeline benchmark saves its results to --results-dir, default to benchmark_results in the current directory
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import numpy as np
+from PIL import Image
+import rpn_helper
+from rpn_helper import get_resized_img_size, get_bbox_list_resized, compute_feat_size_resnet, get_anchor_grid, \
+    _label_anchors_loop, _label_anchors_vectorized, compute_rpn_of_img
+from bbox_helper import get_hflip_img, bbox_parser
+import bbox_reader
+from synthetic_data import generate_synthetic_dataset, write_synthetic_bbox_file
+from img_utils import resize_img, load_img, load_img_resized
+from box_geometry import iou, iou_matrix, nms
+import augmentation
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'samples')
+
+DEFAULT_CONFIG = {'down_scale': 16, 'anchor_sizes': [64, 128, 256], 'anchor_ratios': [[1, 1], [1, 2], [2, 1], [2, 2]],
+                  'upper_bound_iou': 0.65, 'lower_bound_iou': 0.3}
+# anchor corners that are not multiples of 0.5, the vectorized labelling must still match the loop exactly
+FRACTIONAL_RATIO_CONFIG = dict(DEFAULT_CONFIG, anchor_ratios=[[1, 1], [0.7, 1.4], [1.4, 0.7],
+                                                              [3 ** -0.5, 3 ** 0.5]])
+
+
+def random_img_info(rng, max_nb_bbox=4, min_size=200, max_size=500):
+    """an image info as returned by bbox_parser, with random size and random bboxes"""
+    width = rng.randint(min_size, max_size)
+    height = rng.randint(min_size, max_size)
+    bbox = []
+    for _ in range(rng.randint(1, max_nb_bbox)):
+        xmin = rng.randint(0, width - 20)
+        ymin = rng.randint(0, height - 20)
+        bbox.append({'class': 'synthetic', 'xmin': xmin, 'ymin': ymin,
+                     'xmax': rng.randint(xmin + 10, width), 'ymax': rng.randint(ymin + 10, height)})
+    return {'file_path': 'synthetic.JPEG', 'width': width, 'height': height, 'bbox': bbox}
+
+
+def _best_time(func, repeat):
+    best = float('inf')
+    res = None
+    for _ in range(repeat):
+        start = time.time()
+        res = func()
+        best = min(best, time.time() - start)
+    return best, res
+
+
+def bench_rpn_labelling(nb_imgs=10, repeat=3, configs=(DEFAULT_CONFIG, FRACTIONAL_RATIO_CONFIG), seed=0):
+    """compare per image time of the python loop and the vectorized anchor labelling of compute_rpn_of_img"""
+    for config in configs:
+        rng = random.Random(seed)
+        total_loop = 0.
+        total_vectorized = 0.
+        for _ in range(nb_imgs):
+            img_info = random_img_info(rng)
+            resized_width, resized_height = get_resized_img_size(img_info['width'], img_info['height'], 600)
+            feat_width, feat_height = compute_feat_size_resnet(resized_width, resized_height)
+            gt_bb_list = get_bbox_list_resized(img_info['bbox'], img_info['width'], img_info['height'],
+                                               resized_width, resized_height)
+            args = (gt_bb_list, config, resized_width, resized_height, feat_width, feat_height)
+
+            def label_vectorized():
+                anchors, anchor_idx = get_anchor_grid(resized_width, resized_height, config)
+                return _label_anchors_vectorized(gt_bb_list, config, anchors, anchor_idx, feat_width, feat_height)
+
+            time_loop, res_loop = _best_time(lambda: _label_anchors_loop(*args), repeat)
+            time_vectorized, res_vectorized = _best_time(label_vectorized, repeat)
+            for y_loop, y_vectorized in zip(res_loop, res_vectorized):
+                assert np.array_equal(y_loop, y_vectorized), \
+                    'vectorized labelling differs from the loop (anchor ratios %s)' % config['anchor_ratios']
+            total_loop += time_loop
+            total_vectorized += time_vectorized
+        print('rpn labelling, anchor ratios %s: loop %.2f ms/img, vectorized %.2f ms/img, speedup x%.1f'
+              % (config['anchor_ratios'], 1000 * total_loop / nb_imgs, 1000 * total_vectorized / nb_imgs,
+                 total_loop / total_vectorized))
+
+
+def bench_augmentation(nb_imgs=32, max_nb_bbox=20, repeat=3, seed=0):
+    """hflip, scale and min side resize of a batch: per box dict functions vs augmentation on box arrays"""
+    rng = random.Random(seed)
+    img_infos = [random_img_info(rng, max_nb_bbox) for _ in range(nb_imgs)]
+    imgs = [np.random.RandomState(i).randint(0, 256, (info['height'], info['width'], 3)).astype(np.uint8)
+            for i, info in enumerate(img_infos)]
+    boxes_list = [np.array([[bb['xmin'], bb['ymin'], bb['xmax'], bb['ymax']] for bb in info['bbox']])
+                  for info in img_infos]
+    width_r, height_r = 0.8, 0.6
+
+    def with_dicts():
+        res = []
+        for img, info in zip(imgs, img_infos):
+            img, bbox = get_hflip_img(img, info['bbox'])
+            height, width = img.shape[:2]
+            new_width, new_height = int(width * width_r), int(height * height_r)
+            img = resize_img(img, (new_height, new_width))  # what get_scaled_img does
+            bbox = get_bbox_list_resized(bbox, width, height, new_width, new_height)
+            resized_width, resized_height = get_resized_img_size(new_width, new_height, 600)
+            img = resize_img(img, (resized_height, resized_width))
+            res.append((img, get_bbox_list_resized(bbox, new_width, new_height, resized_width, resized_height)))
+        return res
+
+    augment_batch = augmentation.compose(augmentation.hflip(), augmentation.scale(width_r, height_r),
+                                         augmentation.resize_min_side(600))
+    time_dicts, res_dicts = _best_time(with_dicts, repeat)
+    time_arrays, (res_imgs, res_boxes) = _best_time(lambda: augment_batch(imgs, boxes_list), repeat)
+    for (img, bbox), new_img, new_boxes in zip(res_dicts, res_imgs, res_boxes):
+        assert img.shape == new_img.shape
+        assert [[bb['xmin'], bb['ymin'], bb['xmax'], bb['ymax']] for bb in bbox] == new_boxes.tolist()
+    print('augmentation: dicts %.2f ms/img, box arrays %.2f ms/img, speedup x%.1f'
+          % (1000 * time_dicts / nb_imgs, 1000 * time_arrays / nb_imgs, time_dicts / time_arrays))
+
+
+def bench_jpeg_decode(min_sizes=(600, 300, 150), upscales=(1, 4), repeat=5):
+    """decode + min side resize of the samples jpegs: full decode then resize vs draft (reduced resolution) decode.
+    The samples are ~500px like most of ImageNet, upscaled copies stand for large images"""
+    sample_files = sorted(os.path.join(SAMPLES_DIR, f) for f in os.listdir(SAMPLES_DIR) if f.endswith('.JPEG'))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for upscale in upscales:
+            files = []
+            for f in sample_files:
+                if upscale == 1:
+                    files.append(f)
+                    continue
+                with Image.open(f) as img:
+                    big = img.resize((img.size[0] * upscale, img.size[1] * upscale), resample=Image.BILINEAR)
+                files.append(os.path.join(tmp_dir, '%dx_%s' % (upscale, os.path.basename(f))))
+                big.save(files[-1], quality=90)
+            sizes = [Image.open(f).size for f in files]
+            for min_size in min_sizes:
+                resized_sizes = [get_resized_img_size(width, height, min_size) for width, height in sizes]
+
+                def full_decode():
+                    return [resize_img(load_img(f), (h, w)) for f, (w, h) in zip(files, resized_sizes)]
+
+                def draft_decode():
+                    return [load_img_resized(f, w, h) for f, (w, h) in zip(files, resized_sizes)]
+
+                time_full, res_full = _best_time(full_decode, repeat)
+                time_draft, res_draft = _best_time(draft_decode, repeat)
+                assert [img.shape for img in res_full] == [img.shape for img in res_draft]
+                print('jpeg decode x%d samples to min side %d: full %.1f imgs/s, draft %.1f imgs/s, speedup x%.1f'
+                      % (upscale, min_size, len(files) / time_full, len(files) / time_draft, time_full / time_draft))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _nms_one_by_one(boxes, scores, iou_threshold, max_output):
+    # the usual numpy nms: compare the best remaining box to all the other remaining boxes, one kept box at a time
+    order = np.argsort(-scores, kind='stable')
+    keep = []
+    while len(order) > 0 and len(keep) < max_output:
+        keep.append(order[0])
+        order = order[1:][iou(boxes[order[0]], boxes[order[1:]]) <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def bench_nms(nb_boxes_list=(6000, 20000, 40000), max_output=300, iou_threshold=0.7, repeat=3, seed=0):
+    """nms of random boxes around a few objects, like rpn outputs: one kept box at a time vs blocks of boxes"""
+    rng = np.random.RandomState(seed)
+    for nb_boxes in nb_boxes_list:
+        centers = rng.uniform(0, 1000, (30, 2))
+        sizes = rng.uniform(30, 300, (30, 2))
+        obj = rng.randint(0, 30, nb_boxes)
+        xy = centers[obj] + rng.normal(0, 10, (nb_boxes, 2))
+        boxes = np.concatenate([xy, xy + sizes[obj] * rng.uniform(0.8, 1.25, (nb_boxes, 2))], axis=1)
+        scores = rng.random_sample(nb_boxes)
+        time_loop, keep_loop = _best_time(lambda: _nms_one_by_one(boxes, scores, iou_threshold, max_output), repeat)
+        time_blocks, keep_blocks = _best_time(lambda: nms(boxes, scores, iou_threshold, max_output), repeat)
+        assert np.array_equal(keep_loop, keep_blocks)
+        print('nms %d boxes (max %d kept): one by one %.1f ms, blocks %.1f ms, speedup x%.1f'
+              % (nb_boxes, max_output, 1000 * time_loop, 1000 * time_blocks, time_loop / time_blocks))
+
+
+def _measure(func, nb_items, unit):
+    """time of a first run of func and peak python memory (tracemalloc, numpy included) of a second run,
+    stdout of func is dropped"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {'seconds': elapsed, 'throughput': nb_items / max(elapsed, 1e-9), 'unit': unit, 'nb_items': nb_items,
+            'peak_mb': peak / 1024. ** 2}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.STDOUT,
+                                       cwd=os.path.dirname(os.path.realpath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _pipeline_stages(data_dir, nb_imgs, nb_rpn_imgs, nb_iou_pairs, seed):
+    """(stage name, function, number of items, unit) of the data preparation stages on a synthetic dataset"""
+    dataset = generate_synthetic_dataset(data_dir, nb_imgs, seed=seed)
+    class_name_dict = bbox_reader.get_class_name_dict(dataset['class_name_file'])
+    xml_files = [os.path.join(dataset['annotation_path'], d, f) for d in sorted(os.listdir(dataset['annotation_path']))
+                 for f in sorted(os.listdir(os.path.join(dataset['annotation_path'], d)))]
+    all_bbox_file = os.path.join(data_dir, 'all_bbox.txt')
+    clean_bbox_file = os.path.join(data_dir, 'clean_bbox.txt')
+    csv_file = os.path.join(data_dir, 'synthetic_bbox.txt')
+    nb_lines = write_synthetic_bbox_file(csv_file, nb_imgs, seed=seed)
+    with contextlib.redirect_stdout(io.StringIO()):
+        bbox_reader.generate_img_bbox(dataset['annotation_path'], all_bbox_file, class_name_dict)
+    with open(all_bbox_file) as f:
+        nb_bbox_lines = sum(1 for _ in f)
+    rpn_infos = bbox_parser(csv_file, data_dir)[0][:nb_rpn_imgs]
+    rng = np.random.RandomState(seed)
+    corners = rng.uniform(0, 500, (2, nb_iou_pairs, 2))
+    boxes = np.concatenate([corners[..., :1].min(axis=0), corners[..., 1:].min(axis=0),
+                            corners[..., :1].max(axis=0), corners[..., 1:].max(axis=0)], axis=1)
+    box_lists = boxes.tolist()
+    nb_matrix_rows = max(1, nb_iou_pairs // 1000)
+
+    def xml_stage():
+        for xml_file in xml_files:
+            bbox_reader.process_xml_annotation(xml_file, class_name_dict)
+
+    def rpn_stage():
+        for img_info in rpn_infos:
+            width, height = img_info['width'], img_info['height']
+            resized_width, resized_height = get_resized_img_size(width, height, 600)
+            compute_rpn_of_img(img_info, DEFAULT_CONFIG, width, height, resized_width, resized_height,
+                               compute_feat_size_resnet)
+
+    return [('process_xml_annotation', xml_stage, len(xml_files), 'xml/s'),
+            ('generate_img_bbox', lambda: bbox_reader.generate_img_bbox(dataset['annotation_path'], all_bbox_file,
+                                                                        class_name_dict), len(xml_files), 'xml/s'),
+            ('bbox_parser', lambda: bbox_parser(csv_file, data_dir), nb_lines, 'lines/s'),
+            ('remove_no_bbox_imgs', lambda: bbox_reader.remove_no_bbox_imgs(data_dir, all_bbox_file, dry_run=True),
+             dataset['nb_jpeg'], 'imgs/s'),
+            ('write_clean_img_bbox', lambda: bbox_reader.write_clean_img_bbox(data_dir, all_bbox_file,
+                                                                              clean_bbox_file), nb_bbox_lines,
+             'lines/s'),
+            ('iou', lambda: [rpn_helper.iou(box_lists[i], box_lists[i - 1]) for i in range(len(box_lists))],
+             nb_iou_pairs, 'pairs/s'),
+            ('iou_matrix', lambda: iou_matrix(boxes[:nb_matrix_rows], boxes), nb_matrix_rows * nb_iou_pairs,
+             'pairs/s'),
+            ('compute_rpn_of_img', rpn_stage, len(rpn_infos), 'imgs/s')]
+
+
+def _latest_results(results_dir, prefix, exclude):
+    files = sorted(f for f in os.listdir(results_dir) if f.startswith(prefix) and f.endswith('.json') and
+                   f != exclude) if os.path.isdir(results_dir) else []
+    if len(files) == 0:
+        return None
+    with open(os.path.join(results_dir, files[-1])) as f:
+        return json.load(f)
+
+
+def bench_pipeline(sizes=(100, 1000, 5000), nb_rpn_imgs=50, nb_iou_pairs=100000, seed=0,
+                   results_dir='benchmark_results'):
+    """
+    throughput and peak memory of each data preparation stage on synthetic datasets (synthetic_data.py) of several
+    numbers of images. Results are saved to results_dir/pipeline_<time>_<git revision>.json and compared with the
+    previous results found there
+    """
+    results = {'revision': _git_revision(), 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+               'python': sys.version.split()[0], 'numpy': np.__version__, 'stages': []}
+    for nb_imgs in sizes:
+        data_dir = tempfile.mkdtemp()
+        try:
+            for stage, func, nb_items, unit in _pipeline_stages(data_dir, nb_imgs, nb_rpn_imgs, nb_iou_pairs, seed):
+                res = _measure(func, nb_items, unit)
+                res.update({'stage': stage, 'nb_imgs': nb_imgs})
+                results['stages'].append(res)
+        finally:
+            shutil.rmtree(data_dir)
+
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    results_file = 'pipeline_%s_%s.json' % (time.strftime('%Y%m%d_%H%M%S'), results['revision'])
+    previous = _latest_results(results_dir, 'pipeline_', results_file)
+    with open(os.path.join(results_dir, results_file), mode='w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    previous_stages = {} if previous is None else dict(((r['stage'], r['nb_imgs']), r) for r in previous['stages'])
+    for res in results['stages']:
+        line = 'pipeline %-22s %6d imgs: %12.1f %-7s peak %8.1f MB' % (res['stage'], res['nb_imgs'], res['throughput'],
+                                                                      res['unit'], res['peak_mb'])
+        old = previous_stages.get((res['stage'], res['nb_imgs']))
+        if old is not None:
+            line += '  (x%.2f throughput vs %s)' % (res['throughput'] / max(old['throughput'], 1e-9),
+                                                    previous['revision'])
+        print(line)
+    print('results saved to %s' % os.path.join(results_dir, results_file))
+
+
+ALL_BENCHMARKS = {'rpn_labelling': bench_rpn_labelling, 'augmentation': bench_augmentation,
+                  'jpeg_decode': bench_jpeg_decode, 'nms': bench_nms, 'pipeline': bench_pipeline}
+
+
+if __name__ == '__main__':
+    results_dirs = [a.split('=', 1)[1] for a in sys.argv[1:] if a.startswith('--results-dir=')]
+    names = [a for a in sys.argv[1:] if not a.startswith('--results-dir=')] or sorted(ALL_BENCHMARKS)
+    for name in names:
+        if name == 'pipeline' and results_dirs:
+            bench_pipeline(results_dir=results_dirs[-1])
+        else:
+            ALL_BENCHMARKS[name]()
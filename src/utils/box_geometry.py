@@ -0,0 +1,248 @@
+"""
+Vectorized bounding box geometry over numpy arrays.
+A box is represented by xmin, ymin, xmax, ymax: boxes are arrays of shape (N, 4).
+Elementwise functions (area, intersection, union, iou) broadcast over the leading dimensions,
+pairwise functions (iou_matrix, max_iou) compare every box of a (N, 4) array to every box of a (M, 4) array.
+The arithmetic follows the scalar functions of rpn_helper so both give the same values.
+"""
+
+import numpy as np
+
+# max number of elements of the temporaries of a pairwise computation, bigger matrices are processed by chunks of rows
+MAX_CHUNK_ELEMENTS = 1 << 22
+
+
+def bbox_list_to_array(bbox_list, dtype=np.float64):
+    """convert a list of bbox dicts (as in bbox_parser) to a (N, 4) array of xmin, ymin, xmax, ymax"""
+    boxes = np.array([[bb['xmin'], bb['ymin'], bb['xmax'], bb['ymax']] for bb in bbox_list], dtype=dtype)
+    return boxes.reshape(len(bbox_list), 4)
+
+
+def area(boxes):
+    boxes = np.asarray(boxes)
+    return (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+
+
+def intersection(boxes1, boxes2):
+    boxes1 = np.asarray(boxes1)
+    boxes2 = np.asarray(boxes2)
+    # top left corner of the intersection, bottom right subtracted by top left to get width, height size
+    width_intersection = np.minimum(boxes1[..., 2], boxes2[..., 2]) - np.maximum(boxes1[..., 0], boxes2[..., 0])
+    height_intersection = np.minimum(boxes1[..., 3], boxes2[..., 3]) - np.maximum(boxes1[..., 1], boxes2[..., 1])
+    return np.where((width_intersection < 0) | (height_intersection < 0), 0, width_intersection * height_intersection)
+
+
+def union(boxes1, boxes2):
+    # union = area1 + area2 - intersection
+    return area(boxes1) + area(boxes2) - intersection(boxes1, boxes2)
+
+
+def iou(boxes1, boxes2):
+    # intersection over union
+    return intersection(boxes1, boxes2) / (union(boxes1, boxes2) + 1e-7)  # avoid dividing by zero
+
+
+def _row_chunks(n_rows, n_cols, max_chunk_elements):
+    rows_per_chunk = max(1, max_chunk_elements // max(1, n_cols))
+    for start in range(0, n_rows, rows_per_chunk):
+        yield start, min(n_rows, start + rows_per_chunk)
+
+
+def iou_matrix(boxes1, boxes2, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    """
+    iou of every pair of boxes
+    :param boxes1: (N, 4) array
+    :param boxes2: (M, 4) array
+    :param max_chunk_elements: bound on the size of the temporaries, rows of boxes1 are processed by chunks
+    :return: (N, M) float64 array
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    res = np.empty((len(boxes1), len(boxes2)), dtype=np.float64)
+    for start, end in _row_chunks(len(boxes1), len(boxes2), max_chunk_elements):
+        res[start:end] = iou(boxes1[start:end, np.newaxis, :], boxes2[np.newaxis, :, :])
+    return res
+
+
+def max_iou(boxes1, boxes2, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    """
+    best iou of every box of boxes1 over boxes2 without keeping the whole (N, M) matrix in memory
+    :return: max iou (N,) and index in boxes2 of the first box reaching it (N,), -1 when boxes2 is empty
+    """
+    boxes1 = np.asarray(boxes1, dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.asarray(boxes2, dtype=np.float64).reshape(-1, 4)
+    best = np.zeros(len(boxes1), dtype=np.float64)
+    best_idx = -1 * np.ones(len(boxes1), dtype=np.int64)
+    if len(boxes2) == 0:
+        return best, best_idx
+    for start, end in _row_chunks(len(boxes1), len(boxes2), max_chunk_elements):
+        chunk = iou(boxes1[start:end, np.newaxis, :], boxes2[np.newaxis, :, :])
+        best_idx[start:end] = np.argmax(chunk, axis=1)
+        best[start:end] = chunk[np.arange(end - start), best_idx[start:end]]
+    return best, best_idx
+
+
+def encode_regr(anchor_boxes, gt_boxes):
+    """
+    regression targets of gt_boxes against anchor_boxes (second part of equation 2 in Faster-RCNN paper)
+    :param anchor_boxes: (N, 4) array
+    :param gt_boxes: (N, 4) array
+    :return: (N, 4) float64 array of tx, ty, tw, th
+    """
+    anchor_boxes = np.asarray(anchor_boxes)
+    gt_boxes = np.asarray(gt_boxes)
+    anchor_width = anchor_boxes[..., 2] - anchor_boxes[..., 0]
+    anchor_height = anchor_boxes[..., 3] - anchor_boxes[..., 1]
+    gt_center_x = 0.5 * (gt_boxes[..., 0] + gt_boxes[..., 2])
+    gt_center_y = 0.5 * (gt_boxes[..., 1] + gt_boxes[..., 3])
+    anchor_center_x = 0.5 * (anchor_boxes[..., 0] + anchor_boxes[..., 2])
+    anchor_center_y = 0.5 * (anchor_boxes[..., 1] + anchor_boxes[..., 3])
+
+    tx_star = (gt_center_x - anchor_center_x) / anchor_width
+    ty_star = (gt_center_y - anchor_center_y) / anchor_height
+    tw_star = np.log((gt_boxes[..., 2] - gt_boxes[..., 0]) / anchor_width)
+    th_star = np.log((gt_boxes[..., 3] - gt_boxes[..., 1]) / anchor_height)
+    return np.stack([tx_star, ty_star, tw_star, th_star], axis=-1)
+
+
+def decode_regr(anchor_boxes, regr):
+    """
+    inverse of encode_regr: apply regression parameters tx, ty, tw, th to anchor_boxes
+    :param anchor_boxes: (N, 4) array
+    :param regr: (N, 4) array of tx, ty, tw, th
+    :return: (N, 4) float64 array of xmin, ymin, xmax, ymax
+    """
+    anchor_boxes = np.asarray(anchor_boxes, dtype=np.float64)
+    regr = np.asarray(regr, dtype=np.float64)
+    anchor_width = anchor_boxes[..., 2] - anchor_boxes[..., 0]
+    anchor_height = anchor_boxes[..., 3] - anchor_boxes[..., 1]
+    center_x = regr[..., 0] * anchor_width + 0.5 * (anchor_boxes[..., 0] + anchor_boxes[..., 2])
+    center_y = regr[..., 1] * anchor_height + 0.5 * (anchor_boxes[..., 1] + anchor_boxes[..., 3])
+    width = np.exp(regr[..., 2]) * anchor_width
+    height = np.exp(regr[..., 3]) * anchor_height
+    return np.stack([center_x - 0.5 * width, center_y - 0.5 * height,
+                     center_x + 0.5 * width, center_y + 0.5 * height], axis=-1)
+
+
+def clip_boxes(boxes, width, height):
+    """clip (N, 4) boxes to the image [0, width] x [0, height]"""
+    boxes = np.asarray(boxes)
+    return np.stack([np.clip(boxes[..., 0], 0, width), np.clip(boxes[..., 1], 0, height),
+                     np.clip(boxes[..., 2], 0, width), np.clip(boxes[..., 3], 0, height)], axis=-1)
+
+
+def _overlap_matrix(boxes1, areas1, boxes2, areas2, iou_threshold):
+    """(N, M) bool, iou of each pair above iou_threshold, computed as iou() but with a single intersection"""
+    width_intersection = np.minimum(boxes1[:, 2, None], boxes2[None, :, 2]) - \
+        np.maximum(boxes1[:, 0, None], boxes2[None, :, 0])
+    np.maximum(width_intersection, 0, out=width_intersection)
+    height_intersection = np.minimum(boxes1[:, 3, None], boxes2[None, :, 3]) - \
+        np.maximum(boxes1[:, 1, None], boxes2[None, :, 1])
+    np.maximum(height_intersection, 0, out=height_intersection)
+    inter = width_intersection * height_intersection
+    return inter / (areas1[:, None] + areas2[None, :] - inter + 1e-7) > iou_threshold
+
+
+def _any_overlap(boxes1, areas1, boxes2, areas2, iou_threshold, max_chunk_elements=MAX_CHUNK_ELEMENTS):
+    """(M,) bool, True for the boxes of boxes2 overlapping any box of boxes1 above iou_threshold"""
+    overlapped = np.zeros(len(boxes2), dtype=bool)
+    if len(boxes1) == 0:
+        return overlapped
+    for start, end in _row_chunks(len(boxes2), len(boxes1), max_chunk_elements):
+        overlapped[start:end] = _overlap_matrix(boxes1, areas1, boxes2[start:end], areas2[start:end],
+                                                iou_threshold).any(axis=0)
+    return overlapped
+
+
+def nms(boxes, scores, iou_threshold=0.7, max_output=None, block_size=256):
+    """
+    greedy non-maximum suppression: visit boxes by decreasing score, keep a box unless its iou with an already kept
+    box is above iou_threshold.
+    Boxes are resolved by blocks of block_size: a block is first checked against all the boxes kept so far, then the
+    greedy order inside the block is solved on its (block_size, block_size) overlap matrix. Nothing after the block
+    reaching max_output kept boxes is looked at, so with a max_output (the usual rpn case) the cost is bounded by
+    about max_output x (number of boxes visited), whatever the number of input boxes.
+    :param boxes: (N, 4) array
+    :param scores: (N,) array
+    :param max_output: stop once that many boxes are kept
+    :return: int64 indexes of the kept boxes, by decreasing score (ties keep the order of boxes)
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind='stable')
+    if max_output is None:
+        max_output = len(order)
+    sorted_boxes = boxes[order]
+    sorted_areas = area(sorted_boxes)
+    kept = []
+    nb_kept = 0
+    kept_boxes = np.zeros((0, 4))
+    kept_areas = np.zeros(0)
+    for start in range(0, len(order), block_size):
+        if nb_kept >= max_output:
+            break
+        block = np.arange(start, min(start + block_size, len(order)))  # positions in order
+        block = block[~_any_overlap(kept_boxes, kept_areas, sorted_boxes[block], sorted_areas[block], iou_threshold)]
+        block_boxes = sorted_boxes[block]
+        block_areas = sorted_areas[block]
+        # box j of the block is kept iff no kept box i < j suppresses it: iterate to the fixed point, box i is right
+        # after as many iterations as the length of its chain of suppressions
+        suppresses = np.triu(_overlap_matrix(block_boxes, block_areas, block_boxes, block_areas, iou_threshold), k=1)
+        is_kept = np.ones(len(block), dtype=bool)
+        while True:
+            new_is_kept = ~(suppresses & is_kept[:, np.newaxis]).any(axis=0)
+            if np.array_equal(new_is_kept, is_kept):
+                break
+            is_kept = new_is_kept
+        kept.append(block[is_kept])
+        nb_kept += int(is_kept.sum())
+        kept_boxes = np.concatenate([kept_boxes, block_boxes[is_kept]])
+        kept_areas = np.concatenate([kept_areas, block_areas[is_kept]])
+    return order[np.concatenate(kept + [np.zeros(0, dtype=np.int64)])[:max_output]]
+
+
+def _greedy_nms_reference(boxes, scores, iou_threshold, max_output):
+    """plain greedy nms, one pair of boxes at a time"""
+    keep = []
+    for i in np.argsort(-scores, kind='stable'):
+        if len(keep) == max_output:
+            break
+        if all(iou(boxes[i], boxes[j]) <= iou_threshold for j in keep):
+            keep.append(i)
+    return np.array(keep, dtype=np.int64)
+
+
+def _self_check(seed=0):
+    """small deterministic checks of the chunked pairwise functions and of the blocked nms"""
+    # hand computed: half overlapping boxes, a box inside another, touching boxes
+    boxes1 = np.array([[0, 0, 10, 10], [0, 0, 10, 10], [0, 0, 10, 10]], dtype=np.float64)
+    boxes2 = np.array([[5, 0, 15, 10], [0, 0, 10, 6.25], [10, 0, 20, 10]], dtype=np.float64)
+    assert np.allclose(intersection(boxes1, boxes2), [50, 62.5, 0])
+    assert np.allclose(iou(boxes1, boxes2), [50 / 150., 0.625, 0])
+
+    rng = np.random.RandomState(seed)
+    xy = rng.uniform(0, 100, (300, 2))
+    boxes = np.concatenate([xy, xy + rng.uniform(5, 40, (300, 2))], axis=1)
+    others = boxes[:120] + rng.normal(0, 3, (120, 4))
+    dense = iou(boxes[:, np.newaxis, :], others[np.newaxis, :, :])
+    for max_chunk_elements in (1, 7, 120, 1000, MAX_CHUNK_ELEMENTS):
+        assert np.array_equal(iou_matrix(boxes, others, max_chunk_elements), dense)
+        best, best_idx = max_iou(boxes, others, max_chunk_elements)
+        assert np.array_equal(best, dense.max(axis=1)) and np.array_equal(best_idx, dense.argmax(axis=1))
+        overlapped = _any_overlap(others, area(others), boxes, area(boxes), 0.5, max_chunk_elements)
+        assert np.array_equal(overlapped, (dense > 0.5).any(axis=1))
+    assert np.array_equal(max_iou(boxes, np.zeros((0, 4)))[1], -np.ones(len(boxes), dtype=np.int64))
+
+    # ties in the scores keep the order of the boxes
+    scores = rng.randint(0, 50, len(boxes)).astype(np.float64)
+    for iou_threshold in (0.3, 0.7):
+        for max_output in (None, 1, 25):
+            reference = _greedy_nms_reference(boxes, scores, iou_threshold, max_output)
+            for block_size in (1, 3, 16, 256):
+                assert np.array_equal(nms(boxes, scores, iou_threshold, max_output, block_size), reference)
+    assert len(nms(np.zeros((0, 4)), np.zeros(0))) == 0
+
+
+if __name__ == '__main__':
+    # usage: python box_geometry.py, runs the self checks
+    _self_check()
+    print('box_geometry self check ok')
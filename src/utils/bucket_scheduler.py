@@ -0,0 +1,211 @@
+"""
+Aspect ratio bucketed batches: images resized to the min side (get_resized_img_size) only share their feature map
+size and anchor grid (get_anchor_grid) when they have the same resized (width, height), otherwise a batch is zero
+padded to its largest image (collate_rpn_samples). BucketBatchScheduler groups the images by resized size and only
+makes batches within a group, so the images and rpn targets of a batch stack without padding.
+Since the min side is fixed, the long side takes many values, which makes small groups and partial batches.
+Groups can be merged by snapping images to a few bucket sizes (make_bucket_sizes):
+    snap='pad':    an image goes to the smallest bucket containing it, batches are padded to their largest image
+    snap='resize': an image is resized to the bucket of the closest aspect ratio (slightly changing its aspect
+                   ratio), batches share one size, pass the scheduler as batch_sampler of RPNDataLoader so images
+                   are loaded at the size of their bucket
+report() gives the padding waste (padded pixels and feature map cells), the bucket occupancy (filled batch slots)
+and, as a baseline, the padding of the plain shuffled batches.
+"""
+
+import numpy as np
+from rpn_helper import compute_feat_size_resnet
+
+SNAP_MODES = (None, 'pad', 'resize')
+
+
+def get_resized_img_sizes(widths, heights, resized_img_min_size):
+    """vectorized get_resized_img_size, int64 (N,) resized widths and heights"""
+    widths = np.asarray(widths, dtype=np.int64)
+    heights = np.asarray(heights, dtype=np.int64)
+    portrait = widths < heights
+    resized_widths = np.where(portrait, resized_img_min_size,
+                              (widths * float(resized_img_min_size) / heights).astype(np.int64))
+    resized_heights = np.where(portrait, (heights * float(resized_img_min_size) / widths).astype(np.int64),
+                               resized_img_min_size)
+    return resized_widths, resized_heights
+
+
+def make_bucket_sizes(resized_widths, resized_heights, nb_buckets=4):
+    """
+    bucket sizes (width, height) of the landscape and of the portrait images: the long sides of each orientation are
+    cut in nb_buckets groups of about the same number of images, a bucket is the largest size of its group
+    (so with snap='pad' every image fits in a bucket)
+    """
+    bucket_sizes = set()
+    for is_portrait in (False, True):
+        mask = (resized_widths < resized_heights) == is_portrait
+        if not mask.any():
+            continue
+        long_sides = np.sort(np.where(is_portrait, resized_heights, resized_widths)[mask])
+        short_side = int(np.where(is_portrait, resized_widths, resized_heights)[mask][0])
+        group_ends = np.unique(np.ceil(np.linspace(0, len(long_sides), nb_buckets + 1)[1:]).astype(np.int64) - 1)
+        for long_side in long_sides[group_ends]:
+            bucket_sizes.add((short_side, int(long_side)) if is_portrait else (int(long_side), short_side))
+    return sorted(bucket_sizes)
+
+
+def _snap_to_buckets(resized_widths, resized_heights, bucket_sizes, snap):
+    """(width, height) of the bucket of each image"""
+    if len(resized_widths) == 0:  # no image (and no bucket with make_bucket_sizes)
+        return resized_widths, resized_heights
+    bucket_widths = np.array([size[0] for size in bucket_sizes], dtype=np.int64)
+    bucket_heights = np.array([size[1] for size in bucket_sizes], dtype=np.int64)
+    if snap == 'pad':
+        fits = (bucket_widths[np.newaxis, :] >= resized_widths[:, np.newaxis]) & \
+               (bucket_heights[np.newaxis, :] >= resized_heights[:, np.newaxis])
+        areas = np.where(fits, bucket_widths * bucket_heights, np.iinfo(np.int64).max)
+        best = np.argmin(areas, axis=1)
+        has_bucket = fits[np.arange(len(best)), best]
+        # images larger than every bucket keep their own size
+        return (np.where(has_bucket, bucket_widths[best], resized_widths),
+                np.where(has_bucket, bucket_heights[best], resized_heights))
+    log_ratio_dist = np.abs(np.log(resized_widths / resized_heights.astype(np.float64))[:, np.newaxis]
+                            - np.log(bucket_widths / bucket_heights.astype(np.float64))[np.newaxis, :])
+    best = np.argmin(log_ratio_dist, axis=1)
+    return bucket_widths[best], bucket_heights[best]
+
+
+def _padding_stats(batches, widths, heights, compute_feature_sizes):
+    """padded pixels and padded feature map cells of batches padded to their largest image, as ratios"""
+    feat_sizes = {}
+
+    def feat_area(width, height):
+        if (width, height) not in feat_sizes:
+            feat_width, feat_height = compute_feature_sizes(int(width), int(height))
+            feat_sizes[(width, height)] = feat_width * feat_height
+        return feat_sizes[(width, height)]
+
+    nb_pixels = nb_padded_pixels = nb_cells = nb_padded_cells = 0
+    for img_ids in batches:
+        batch_width, batch_height = widths[img_ids].max(), heights[img_ids].max()
+        pixels = int((widths[img_ids] * heights[img_ids]).sum())
+        cells = sum(feat_area(w, h) for w, h in zip(widths[img_ids], heights[img_ids]))
+        nb_pixels += len(img_ids) * batch_width * batch_height
+        nb_padded_pixels += len(img_ids) * batch_width * batch_height - pixels
+        nb_cells += len(img_ids) * feat_area(batch_width, batch_height)
+        nb_padded_cells += len(img_ids) * feat_area(batch_width, batch_height) - cells
+    return {'pixel_padding': nb_padded_pixels / float(max(1, nb_pixels)),
+            'feature_padding': nb_padded_cells / float(max(1, nb_cells))}
+
+
+class BucketBatchScheduler(object):
+    """
+    iterate over the batches (int64 arrays of positions in img_infos) of an epoch, all the images of a batch have
+    the same bucket size. Images are shuffled within their bucket and batches are shuffled at every epoch
+    (seeded by seed + epoch index when a seed is given), as in RPNDataLoader.
+    :param img_infos: list of image dicts of bbox_parser
+    :param bucket_sizes: list of (width, height), default to make_bucket_sizes(nb_buckets) when snapping
+    :param snap: one of SNAP_MODES, None to group images by their exact resized size
+    resized_sizes: int64 (N, 2) width and height each image is loaded at (its bucket size with snap='resize')
+    """
+
+    def __init__(self, img_infos, batch_size, resized_img_min_size=600, bucket_sizes=None, nb_buckets=4, snap=None,
+                 shuffle=True, seed=None, drop_last=False, compute_feature_sizes=compute_feat_size_resnet):
+        if snap not in SNAP_MODES:
+            raise ValueError('snap must be one of %s' % (SNAP_MODES,))
+        self.batch_size = batch_size
+        self.snap = snap
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.compute_feature_sizes = compute_feature_sizes
+        self.epoch = 0
+        widths = np.array([img_info['width'] for img_info in img_infos], dtype=np.int64)
+        heights = np.array([img_info['height'] for img_info in img_infos], dtype=np.int64)
+        self.img_widths, self.img_heights = get_resized_img_sizes(widths, heights, resized_img_min_size)
+        if snap is None:
+            self.bucket_sizes = None
+            bucket_widths, bucket_heights = self.img_widths, self.img_heights
+        else:
+            if bucket_sizes is None:
+                bucket_sizes = make_bucket_sizes(self.img_widths, self.img_heights, nb_buckets)
+            self.bucket_sizes = list(bucket_sizes)
+            bucket_widths, bucket_heights = _snap_to_buckets(self.img_widths, self.img_heights, self.bucket_sizes,
+                                                             snap)
+        if snap == 'resize':
+            self.resized_sizes = np.stack([bucket_widths, bucket_heights], axis=1)
+        else:
+            self.resized_sizes = np.stack([self.img_widths, self.img_heights], axis=1)
+
+        # images of each bucket, in the order of img_infos
+        if len(img_infos) == 0:  # no bucket, no batch
+            self.buckets = []
+            self.bucket_img_ids = []
+            return
+        keys = bucket_widths * (bucket_heights.max() + 1) + bucket_heights
+        unique_keys, bucket_of_img, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        order = np.argsort(bucket_of_img, kind='stable')
+        first_imgs = order[np.concatenate([[0], np.cumsum(counts)[:-1]])]
+        self.buckets = [(int(bucket_widths[img_id]), int(bucket_heights[img_id])) for img_id in first_imgs]
+        self.bucket_img_ids = np.split(order, np.cumsum(counts)[:-1])
+
+    def _nb_batches(self, nb_imgs):
+        if self.drop_last:
+            return nb_imgs // self.batch_size
+        return (nb_imgs + self.batch_size - 1) // self.batch_size
+
+    def __len__(self):
+        return sum(self._nb_batches(len(img_ids)) for img_ids in self.bucket_img_ids)
+
+    def _batches(self, epoch):
+        rng = np.random.RandomState(None if self.seed is None else self.seed + epoch)
+        batches = []
+        for img_ids in self.bucket_img_ids:
+            if self.shuffle:
+                img_ids = img_ids[rng.permutation(len(img_ids))]
+            batches.extend(img_ids[i * self.batch_size: (i + 1) * self.batch_size]
+                           for i in range(self._nb_batches(len(img_ids))))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        batches = self._batches(self.epoch)
+        self.epoch += 1
+        return iter(batches)
+
+    def batch_size_of(self, img_ids):
+        """(width, height) of the padded images of a batch, its feature map size is compute_feature_sizes of it"""
+        return int(self.resized_sizes[img_ids, 0].max()), int(self.resized_sizes[img_ids, 1].max())
+
+    def report(self, epoch=0):
+        """padding waste and bucket occupancy of the batches of an epoch, and the padding of plain shuffled batches"""
+        batches = self._batches(epoch)
+        widths, heights = self.resized_sizes[:, 0], self.resized_sizes[:, 1]
+        nb_imgs = sum(len(img_ids) for img_ids in batches)
+        baseline_order = np.random.RandomState(epoch).permutation(len(widths))
+        baseline = [baseline_order[i: i + self.batch_size] for i in range(0, len(widths), self.batch_size)]
+        report = {'nb_imgs': nb_imgs, 'nb_batches': len(batches), 'nb_buckets': len(self.buckets),
+                  'nb_feature_sizes': len(set(self.compute_feature_sizes(*size) for size in self.buckets)),
+                  'occupancy': nb_imgs / float(max(1, len(batches) * self.batch_size)),
+                  'nb_partial_batches': sum(len(img_ids) < self.batch_size for img_ids in batches),
+                  'shuffled_batches': _padding_stats(baseline, self.img_widths, self.img_heights,
+                                                     self.compute_feature_sizes)}
+        report.update(_padding_stats(batches, widths, heights, self.compute_feature_sizes))
+        if self.snap == 'resize':
+            # relative change of the aspect ratio of the images resized to their bucket
+            distortion = np.abs(np.log(widths * self.img_heights / (heights * self.img_widths).astype(np.float64)))
+            report['max_aspect_distortion'] = float(np.expm1(distortion.max())) if len(distortion) > 0 else 0.
+        report['buckets'] = [{'size': size, 'nb_imgs': len(img_ids), 'nb_batches': self._nb_batches(len(img_ids))}
+                             for size, img_ids in zip(self.buckets, self.bucket_img_ids)]
+        return report
+
+
+if __name__ == '__main__':
+    import sys
+    from bbox_helper import bbox_parser
+    img_infos, _, _ = bbox_parser(sys.argv[1])
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    for snap in SNAP_MODES:
+        report = BucketBatchScheduler(img_infos, batch_size, snap=snap).report()
+        print('snap %s: %d buckets, %d feature map sizes, occupancy %.2f, pixel padding %.3f, feature padding %.3f '
+              '(shuffled batches: %.3f, %.3f)'
+              % (snap, report['nb_buckets'], report['nb_feature_sizes'], report['occupancy'],
+                 report['pixel_padding'], report['feature_padding'], report['shuffled_batches']['pixel_padding'],
+                 report['shuffled_batches']['feature_padding']))
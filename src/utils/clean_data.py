@@ -1,20 +1,50 @@
 import sys
 import bbox_reader
+import instrumentation
 import os
-# get the argument
+# get the argument, --dry-run only writes a manifest of the images that would be removed or dropped
+# --incremental only parses annotation files added or modified since the last run
+# --report writes the timers and counters of every stage to data_path/clean_data_report.json
+dry_run = '--dry-run' in sys.argv
+incremental = '--incremental' in sys.argv
+report = '--report' in sys.argv
+args = [a for a in sys.argv[1:] if a not in ('--dry-run', '--incremental', '--report')]
 try:
-    data_path = sys.argv[1]
+    data_path = args[0]
 except IndexError:
     print('use default')
     data_path = '/data/hav16/imagenet/'
 print('data path is %s' % data_path)
+# optional second argument: number of worker processes to parse the annotations, default to a single process
+try:
+    nb_workers = int(args[1])
+except IndexError:
+    nb_workers = 1
 
+recorder = instrumentation.StatsRecorder() if report else None
+instrumentation.set_recorder(recorder)
 cur_dir = os.path.dirname(os.path.realpath(__file__))
 dict_wnid_name = bbox_reader.get_class_name_dict(cur_dir + '/class_name.txt')
 annot_path = data_path + '/Annotation/'
+if not os.path.isdir(annot_path):
+    # annotations not extracted: stream them from their archive
+    for archive_name in ('Annotation.tar.gz', 'Annotation.tgz', 'Annotation.tar'):
+        if os.path.isfile(data_path + '/' + archive_name):
+            annot_path = data_path + '/' + archive_name
+            break
 dest_file = data_path + '/all_bbox.txt'
 dest_clean_file = data_path + '/clean_bbox.txt'
-bbox_reader.generate_img_bbox(annot_path, dest_file, dict_wnid_name)
-bbox_reader.clean_data(data_path, dest_file, dest_clean_file)
+with instrumentation.timer('generate_img_bbox'):
+    if incremental:
+        bbox_reader.generate_img_bbox_incremental(annot_path, dest_file, dict_wnid_name,
+                                                  manifest_file=data_path + '/annotation_manifest.pkl')
+    else:
+        bbox_reader.generate_img_bbox(annot_path, dest_file, dict_wnid_name, nb_workers=nb_workers)
+manifest_file = data_path + '/clean_manifest.txt' if dry_run else None
+with instrumentation.timer('clean_data'):
+    bbox_reader.clean_data(data_path, dest_file, dest_clean_file, dry_run, manifest_file)
+if recorder is not None:
+    recorder.write_report(data_path + '/clean_data_report.json')
+    print('report written to %s' % (data_path + '/clean_data_report.json'))
 
 print('\ncleaning data done\n')
\ No newline at end of file
@@ -0,0 +1,232 @@
+"""
+Prefetching data loader feeding the RPN training: images of bbox_parser are loaded, resized to the min side
+and their rpn targets computed by a pool of workers (threads or processes) while the trainer consumes batches.
+A producer thread submits batches to the pool and puts them in a bounded queue (at most queue_size batches ahead),
+the consumer gets them in order.
+"""
+
+import time
+import queue
+import threading
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from img_utils import get_resized_img_size, resize_img, load_img_resized
+from rpn_helper import compute_rpn_of_img, compute_feat_size_resnet
+from rpn_targets import compute_rpn_targets, sample_rpn_targets, expand_rpn_targets
+
+
+def load_rpn_sample(img_info, config, resized_img_min_size=600, load_img=None,
+                    compute_feature_sizes=compute_feat_size_resnet, compact_targets=False, resized_size=None):
+    """
+    load an image of bbox_parser, resize it to the min side and compute its rpn targets
+    :param load_img: function(file_path) -> image, resized here if needed. By default the image is decoded
+    directly near the resized size (load_img_resized)
+    :param compact_targets: return the sampled RPNTargets (rpn_targets.py) instead of the dense targets
+    :param resized_size: (width, height) to resize to instead of the min side size (e.g. a bucket size)
+    :return: resized image (height, width, 3), y_rpn_class (1, 2A, feat_height, feat_width),
+    y_rpn_regr (1, 8A, feat_height, feat_width) (or resized image, RPNTargets)
+    """
+    width, height = img_info['width'], img_info['height']
+    if resized_size is None:
+        resized_width, resized_height = get_resized_img_size(width, height, resized_img_min_size)
+    else:
+        resized_width, resized_height = int(resized_size[0]), int(resized_size[1])
+    if load_img is None:
+        img = load_img_resized(img_info['file_path'], resized_width, resized_height)
+    else:
+        img = resize_img(load_img(img_info['file_path']), (resized_height, resized_width))
+    if compact_targets:
+        return img, sample_rpn_targets(compute_rpn_targets(img_info, config, width, height, resized_width,
+                                                           resized_height, compute_feature_sizes))
+    y_rpn_class, y_rpn_regr = compute_rpn_of_img(img_info, config, width, height, resized_width, resized_height,
+                                                 compute_feature_sizes)
+    return img, y_rpn_class, y_rpn_regr
+
+
+def _pad_to(arrays, shape_axes):
+    """zero pad (at the end) the given axes of each array to the max size among arrays"""
+    max_sizes = [max(a.shape[axis] for a in arrays) for axis in shape_axes]
+    padded = []
+    for a in arrays:
+        pad = [(0, 0)] * a.ndim
+        for axis, max_size in zip(shape_axes, max_sizes):
+            pad[axis] = (0, max_size - a.shape[axis])
+        padded.append(np.pad(a, pad, mode='constant') if any(p[1] for p in pad) else a)
+    return padded
+
+
+def collate_rpn_samples(samples):
+    """
+    make a batch of samples of load_rpn_sample, images and targets of different sizes are zero padded at the
+    bottom/right (padded anchors have y_is_box_valid = 0 so they do not participate to the objective)
+    :return: image_batch (B, height, width, 3), y_rpn_class (B, 2A, fh, fw), y_rpn_regr (B, 8A, fh, fw)
+    """
+    imgs, y_classes, y_regrs = zip(*samples)
+    image_batch = np.stack(_pad_to(imgs, (0, 1)), axis=0)
+    y_rpn_class = np.concatenate(_pad_to(y_classes, (2, 3)), axis=0)
+    y_rpn_regr = np.concatenate(_pad_to(y_regrs, (2, 3)), axis=0)
+    return image_batch, y_rpn_class, y_rpn_regr
+
+
+def collate_compact_rpn_samples(samples):
+    """
+    make a batch of samples of load_rpn_sample(compact_targets=True), targets are kept compact
+    :return: image_batch (B, height, width, 3), list of RPNTargets, see expand_rpn_targets
+    """
+    imgs, targets_list = zip(*samples)
+    return np.stack(_pad_to(imgs, (0, 1)), axis=0), list(targets_list)
+
+
+def load_rpn_batch(img_infos, config, resized_img_min_size=600, load_img=None,
+                   compute_feature_sizes=compute_feat_size_resnet, compact_targets=False, resized_sizes=None):
+    """task of a worker: load_rpn_sample on each image then collate_rpn_samples (or collate_compact_rpn_samples)"""
+    if resized_sizes is None:
+        resized_sizes = [None] * len(img_infos)
+    samples = [load_rpn_sample(img_info, config, resized_img_min_size, load_img, compute_feature_sizes,
+                               compact_targets, resized_size)
+               for img_info, resized_size in zip(img_infos, resized_sizes)]
+    if compact_targets:
+        return collate_compact_rpn_samples(samples)
+    return collate_rpn_samples(samples)
+
+
+class RPNDataLoader(object):
+    """
+    iterate over (image_batch, y_rpn_class, y_rpn_regr) of an epoch, prepared in advance by a pool of workers.
+    Images are shuffled at every epoch (seeded by seed + epoch index when a seed is given).
+    After (or during) an epoch, stats holds the queue depth seen by the consumer, the time it waited for batches
+    and the throughput: a consumer that waits a lot or a queue that is often empty means more workers are needed.
+    Pass load_img=ResizedImgCache(...).get to read images already resized from the on-disk cache (img_cache.py).
+    With compact_targets, workers return compact RPNTargets (much cheaper to send back from worker processes) and
+    the dense targets of a batch are only built by expand_rpn_targets when the consumer gets it.
+    A batch_sampler (e.g. ClassBalancedSampler of batch_sampler.py, built on the same img_infos) replaces the
+    shuffle: its batches of image ids are loaded in order. If it has resized_sizes (BucketBatchScheduler of
+    bucket_scheduler.py), images are resized to them instead of to the min side.
+    """
+
+    def __init__(self, img_infos, config, batch_size=1, nb_workers=4, use_processes=False, queue_size=8,
+                 shuffle=True, seed=None, drop_last=False, resized_img_min_size=600, load_img=None,
+                 compute_feature_sizes=compute_feat_size_resnet, compact_targets=False, batch_sampler=None):
+        self.img_infos = img_infos
+        self.config = config
+        self.batch_size = batch_size
+        self.nb_workers = nb_workers
+        self.use_processes = use_processes
+        self.queue_size = queue_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.resized_img_min_size = resized_img_min_size
+        self.load_img = load_img
+        self.compute_feature_sizes = compute_feature_sizes
+        self.compact_targets = compact_targets
+        if batch_sampler is not None:
+            # the sampler makes the batches, its settings must be the ones of the loader
+            if getattr(batch_sampler, 'batch_size', batch_size) != batch_size:
+                raise ValueError('batch_size %d differs from the batch_size %d of batch_sampler'
+                                 % (batch_size, batch_sampler.batch_size))
+            if getattr(batch_sampler, 'drop_last', drop_last) != drop_last:
+                raise ValueError('drop_last %s differs from the drop_last %s of batch_sampler'
+                                 % (drop_last, batch_sampler.drop_last))
+        self.batch_sampler = batch_sampler
+        self.epoch = 0
+        self.stats = {}
+
+    def __len__(self):
+        if self.batch_sampler is not None:
+            return len(self.batch_sampler)
+        if self.drop_last:
+            return len(self.img_infos) // self.batch_size
+        return (len(self.img_infos) + self.batch_size - 1) // self.batch_size
+
+    def _batch_indexes(self):
+        if self.batch_sampler is not None:
+            return list(self.batch_sampler)
+        if self.shuffle:
+            rng = np.random.RandomState(None if self.seed is None else self.seed + self.epoch)
+            order = rng.permutation(len(self.img_infos))
+        else:
+            order = np.arange(len(self.img_infos))
+        return [order[i * self.batch_size: (i + 1) * self.batch_size] for i in range(len(self))]
+
+    def __iter__(self):
+        batch_indexes = self._batch_indexes()
+        self.epoch += 1
+        self.stats = {'nb_batches': 0, 'nb_imgs': 0, 'elapsed': 0., 'consumer_wait': 0., 'queue_depth_sum': 0,
+                      'max_queue_depth': 0}
+        pending = queue.Queue(maxsize=self.queue_size)  # futures of the batches, in order
+        stop = threading.Event()
+        executor_class = ProcessPoolExecutor if self.use_processes else ThreadPoolExecutor
+        executor = executor_class(max_workers=self.nb_workers)
+
+        def put(item):
+            # block while queue_size batches are waiting, give up when the consumer stops
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        resized_sizes = getattr(self.batch_sampler, 'resized_sizes', None)
+
+        def produce():
+            try:
+                for indexes in batch_indexes:
+                    future = executor.submit(load_rpn_batch, [self.img_infos[i] for i in indexes], self.config,
+                                             self.resized_img_min_size, self.load_img, self.compute_feature_sizes,
+                                             self.compact_targets,
+                                             None if resized_sizes is None else resized_sizes[indexes].tolist())
+                    if not put(future):
+                        future.cancel()
+                        return
+            except Exception as e:
+                # e.g. a broken pool or a bad image id: a failed future raises it in the consumer
+                failed = Future()
+                failed.set_exception(e)
+                put(failed)
+            finally:
+                put(None)  # end of epoch, the consumer never waits for a producer that is gone
+
+        producer = threading.Thread(target=produce)
+        producer.daemon = True
+        producer.start()
+        start_time = time.time()
+        try:
+            while True:
+                depth = pending.qsize()
+                wait_start = time.time()
+                future = pending.get()
+                if future is None:
+                    break
+                batch = future.result()
+                if self.compact_targets:
+                    batch = (batch[0],) + expand_rpn_targets(batch[1])
+                self.stats['consumer_wait'] += time.time() - wait_start
+                self.stats['queue_depth_sum'] += depth
+                self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], depth)
+                self.stats['nb_batches'] += 1
+                self.stats['nb_imgs'] += len(batch[0])
+                self.stats['elapsed'] = time.time() - start_time
+                yield batch
+        finally:
+            stop.set()
+            while True:  # unblock the producer and drop batches not consumed
+                try:
+                    future = pending.get_nowait()
+                except queue.Empty:
+                    break
+                if future is not None:
+                    future.cancel()
+            producer.join()
+            executor.shutdown(wait=True)
+
+    def report(self):
+        """print the stats of the current/last epoch"""
+        nb_batches = max(1, self.stats.get('nb_batches', 0))
+        elapsed = max(1e-9, self.stats.get('elapsed', 0.))
+        print('%d batches, %d imgs in %.1fs: %.1f imgs/s, mean queue depth %.1f (max %d/%d), consumer waited %.1fs'
+              % (self.stats.get('nb_batches', 0), self.stats.get('nb_imgs', 0), elapsed,
+                 self.stats.get('nb_imgs', 0) / elapsed, self.stats.get('queue_depth_sum', 0) / float(nb_batches),
+                 self.stats.get('max_queue_depth', 0), self.queue_size, self.stats.get('consumer_wait', 0.)))
@@ -0,0 +1,306 @@
+"""
+Detection evaluation (per class AP and mAP) of a test split, e.g. test.txt of split_trainval_test.
+Ground truth is read with bbox_parser, detections are given as arrays:
+    det_img_ids (D,) index of the image of each detection in gt.file_paths (see get_img_ids)
+    det_class_ids (D,) label of each detection in gt.class_to_idx
+    det_boxes (D, 4) xmin, ymin, xmax, ymax in original image coordinates
+    det_scores (D,)
+Detections are matched to the ground truth of the same image and class on the ious of all (detection, ground truth)
+pairs at once, classes are evaluated in parallel by a pool of processes.
+    VOC: a detection is a true positive if its best ground truth (iou > 0.5) was not already matched by a better
+    detection, AP is the area under the interpolated precision / recall curve (11 recall points with use_07_metric)
+    COCO: a detection is matched to the best ground truth not matched yet with iou >= threshold, for thresholds 0.5,
+    0.55, ..., 0.95, at most max_dets detections per image, AP is the mean interpolated precision over 101 recall
+    points, averaged over thresholds (AP50 and AP75 are reported too)
+"""
+
+import time
+import numpy as np
+from collections import namedtuple
+from multiprocessing import Pool
+from bbox_helper import bbox_parser
+from box_geometry import bbox_list_to_array, iou
+
+GroundTruth = namedtuple('GroundTruth', ['file_paths', 'class_to_idx', 'img_ids', 'class_ids', 'boxes'])
+
+COCO_IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+COCO_RECALL_POINTS = np.linspace(0., 1., 101)
+
+
+def load_ground_truth(bbox_info_file, data_dir_path='/data/hav16/imagenet/', class_to_idx=None):
+    """
+    :param class_to_idx: labels used by the detections (e.g. the one of the training set), by default the one of
+    bbox_parser on bbox_info_file. Boxes of classes it does not have are ignored
+    :return: GroundTruth, img_ids, class_ids and boxes (float64 (G, 4)) of every ground truth box
+    """
+    all_info, _, gt_class_to_idx = bbox_parser(bbox_info_file, data_dir_path)
+    if class_to_idx is None:
+        class_to_idx = gt_class_to_idx
+    img_ids = []
+    class_ids = []
+    bbox_list = []
+    for img_id, img_info in enumerate(all_info):
+        for bb in img_info['bbox']:
+            if bb['class'] in class_to_idx:
+                img_ids.append(img_id)
+                class_ids.append(class_to_idx[bb['class']])
+                bbox_list.append(bb)
+    return GroundTruth([img_info['file_path'] for img_info in all_info], class_to_idx,
+                       np.array(img_ids, dtype=np.int32), np.array(class_ids, dtype=np.int32),
+                       bbox_list_to_array(bbox_list))
+
+
+def get_img_ids(gt, file_paths):
+    """index in gt.file_paths of each file path (-1 if not in the ground truth)"""
+    path_to_id = dict((file_path, img_id) for img_id, file_path in enumerate(gt.file_paths))
+    return np.array([path_to_id.get(file_path, -1) for file_path in file_paths], dtype=np.int32)
+
+
+def _det_gt_pairs(det_img_ids, gt_img_ids):
+    """
+    all (detection, ground truth) pairs of the same image
+    :param gt_img_ids: sorted
+    :return: pair_det, pair_gt indexes, grouped by detection
+    """
+    starts = np.searchsorted(gt_img_ids, det_img_ids, side='left')
+    counts = np.searchsorted(gt_img_ids, det_img_ids, side='right') - starts
+    pair_det = np.repeat(np.arange(len(det_img_ids)), counts)
+    pair_offsets = np.cumsum(counts) - counts
+    pair_gt = starts[pair_det] + np.arange(len(pair_det)) - pair_offsets[pair_det]
+    return pair_det, pair_gt
+
+
+def voc_ap(recall, precision, use_07_metric=False):
+    """area under the precision / recall curve, precision made monotonically decreasing (VOC devkit)"""
+    if use_07_metric:
+        # max precision at recall >= t for t in 0, 0.1, ..., 1
+        max_precision = np.maximum.accumulate(np.concatenate([precision, [0.]])[::-1])[::-1]
+        idx = np.searchsorted(recall, np.linspace(0., 1., 11), side='left')
+        return float(np.mean(max_precision[idx]))
+    mrec = np.concatenate([[0.], recall, [1.]])
+    mpre = np.concatenate([[0.], precision, [0.]])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
+    changes = np.flatnonzero(mrec[1:] != mrec[:-1])
+    return float(np.sum((mrec[changes + 1] - mrec[changes]) * mpre[changes + 1]))
+
+
+def _voc_match(ious, pair_det, pair_gt, nb_dets, iou_threshold):
+    """true positive flag of each detection (sorted by decreasing score)"""
+    best_iou = np.full(nb_dets, -np.inf)
+    np.maximum.at(best_iou, pair_det, ious)
+    # first ground truth reaching the best iou of each detection, as np.argmax
+    is_best = ious == best_iou[pair_det]
+    best_dets, first_best = np.unique(pair_det[is_best], return_index=True)
+    best_gt = np.full(nb_dets, -1)
+    best_gt[best_dets] = pair_gt[is_best][first_best]
+    candidates = np.flatnonzero(best_iou > iou_threshold)
+    # only the first (best scored) detection of a ground truth is a true positive
+    _, first_det = np.unique(best_gt[candidates], return_index=True)
+    tp = np.zeros(nb_dets, dtype=bool)
+    tp[candidates[first_det]] = True
+    return tp
+
+
+def _coco_match(ious, pair_det, pair_gt, det_img_ids, nb_gt, iou_thresholds):
+    """
+    true positive flags (nb_thresholds, nb_dets) of the detections (sorted by decreasing score).
+    Detections of different images are independent: round k matches the k-th detection of every image at once
+    """
+    nb_dets = len(det_img_ids)
+    tp = np.zeros((len(iou_thresholds), nb_dets), dtype=bool)
+    if len(ious) == 0:
+        return tp
+    order = np.argsort(det_img_ids, kind='stable')  # by image then score
+    sorted_img_ids = det_img_ids[order]
+    rank = np.empty(nb_dets, dtype=np.int64)
+    rank[order] = np.arange(nb_dets) - np.searchsorted(sorted_img_ids, sorted_img_ids, side='left')
+    matched = np.zeros((len(iou_thresholds), nb_gt), dtype=bool)
+    pair_rank = rank[pair_det]
+    threshold_idx = np.arange(len(iou_thresholds))[:, np.newaxis]
+    for k in range(pair_rank.max() + 1):
+        in_round = np.flatnonzero(pair_rank == k)
+        round_dets, round_gts, round_ious = pair_det[in_round], pair_gt[in_round], ious[in_round]
+        # (nb_thresholds, nb_pairs) iou of the pairs still available, -1 otherwise
+        available = np.where((round_ious >= iou_thresholds[:, np.newaxis]) & ~matched[:, round_gts], round_ious, -1.)
+        best = np.full((len(iou_thresholds), nb_dets), -1.)
+        np.maximum.at(best, (np.broadcast_to(threshold_idx, available.shape), np.broadcast_to(round_dets,
+                                                                                            available.shape)),
+                      available)
+        # the last ground truth reaching the best iou, as pycocotools
+        is_best = (available >= 0) & (available == best[threshold_idx, round_dets])
+        t_idx, pair_idx = np.nonzero(is_best)
+        _, last = np.unique((t_idx * nb_dets + round_dets[pair_idx])[::-1], return_index=True)
+        t_idx, pair_idx = t_idx[::-1][last], pair_idx[::-1][last]
+        matched[t_idx, round_gts[pair_idx]] = True
+        tp[t_idx, round_dets[pair_idx]] = True
+    return tp
+
+
+def _coco_ap(tp, nb_gt):
+    """mean interpolated precision over COCO_RECALL_POINTS, for each threshold"""
+    aps = np.zeros(len(tp))
+    for t_idx in range(len(tp)):
+        tp_cumsum = np.cumsum(tp[t_idx])
+        fp_cumsum = np.cumsum(~tp[t_idx])
+        recall = tp_cumsum / float(nb_gt)
+        precision = np.maximum.accumulate((tp_cumsum / np.maximum(tp_cumsum + fp_cumsum, 1e-12))[::-1])[::-1]
+        idx = np.searchsorted(recall, COCO_RECALL_POINTS, side='left')
+        aps[t_idx] = np.mean(np.where(idx < len(precision), np.concatenate([precision, [0.]])[idx], 0.))
+    return aps
+
+
+def _evaluate_class(args):
+    """AP of a class, task of a worker"""
+    gt_img_ids, gt_boxes, det_img_ids, det_boxes, det_scores, use_07_metric, max_dets = args
+    nb_gt = len(gt_img_ids)
+    if nb_gt == 0:
+        return None
+    order = np.argsort(-det_scores, kind='stable')
+    det_img_ids, det_boxes = det_img_ids[order], det_boxes[order]
+    gt_order = np.argsort(gt_img_ids, kind='stable')
+    gt_img_ids, gt_boxes = gt_img_ids[gt_order], gt_boxes[gt_order]
+    pair_det, pair_gt = _det_gt_pairs(det_img_ids, gt_img_ids)
+    ious = iou(det_boxes[pair_det], gt_boxes[pair_gt])
+
+    tp = _voc_match(ious, pair_det, pair_gt, len(det_img_ids), 0.5)
+    tp_cumsum = np.cumsum(tp)
+    fp_cumsum = np.cumsum(~tp)
+    voc = voc_ap(tp_cumsum / float(nb_gt), tp_cumsum / np.maximum(tp_cumsum + fp_cumsum, 1e-12), use_07_metric)
+
+    # COCO: at most max_dets detections per image
+    img_order = np.argsort(det_img_ids, kind='stable')
+    sorted_img_ids = det_img_ids[img_order]
+    rank = np.empty(len(det_img_ids), dtype=np.int64)
+    rank[img_order] = np.arange(len(det_img_ids)) - np.searchsorted(sorted_img_ids, sorted_img_ids, side='left')
+    kept = rank < max_dets
+    new_idx = np.cumsum(kept) - 1
+    kept_pairs = kept[pair_det]
+    coco_tp = _coco_match(ious[kept_pairs], new_idx[pair_det[kept_pairs]], pair_gt[kept_pairs],
+                          det_img_ids[kept], nb_gt, COCO_IOU_THRESHOLDS)
+    return voc, _coco_ap(coco_tp, nb_gt), nb_gt
+
+
+def evaluate_detections(gt, det_img_ids, det_class_ids, det_boxes, det_scores, use_07_metric=False, max_dets=100,
+                        nb_workers=1):
+    """
+    :param gt: GroundTruth of load_ground_truth
+    :param nb_workers: number of processes, classes are evaluated in parallel
+    :return: dict with per class (class name -> value, only classes having ground truth) 'voc_ap', 'coco_ap',
+    'coco_ap50', 'coco_ap75', 'nb_gt' and their means 'voc_map', 'coco_map', 'coco_map50', 'coco_map75'
+    """
+    det_img_ids = np.asarray(det_img_ids, dtype=np.int64).reshape(-1)
+    det_class_ids = np.asarray(det_class_ids, dtype=np.int64).reshape(-1)
+    det_boxes = np.asarray(det_boxes, dtype=np.float64).reshape(-1, 4)
+    det_scores = np.asarray(det_scores, dtype=np.float64).reshape(-1)
+    idx_to_class = dict((idx, class_name) for class_name, idx in gt.class_to_idx.items() if class_name != 'bg')
+    class_ids = sorted(idx_to_class)
+    tasks = []
+    for class_id in class_ids:
+        gt_mask = gt.class_ids == class_id
+        det_mask = det_class_ids == class_id
+        tasks.append((gt.img_ids[gt_mask].astype(np.int64), gt.boxes[gt_mask], det_img_ids[det_mask],
+                      det_boxes[det_mask], det_scores[det_mask], use_07_metric, max_dets))
+    if nb_workers > 1:
+        pool = Pool(nb_workers)
+        try:
+            results = pool.map(_evaluate_class, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_evaluate_class(task) for task in tasks]
+
+    res = {'voc_ap': {}, 'coco_ap': {}, 'coco_ap50': {}, 'coco_ap75': {}, 'nb_gt': {}}
+    for class_id, class_res in zip(class_ids, results):
+        if class_res is None:
+            continue
+        voc, coco_aps, nb_gt = class_res
+        class_name = idx_to_class[class_id]
+        res['voc_ap'][class_name] = voc
+        res['coco_ap'][class_name] = float(np.mean(coco_aps))
+        res['coco_ap50'][class_name] = float(coco_aps[0])
+        res['coco_ap75'][class_name] = float(coco_aps[5])
+        res['nb_gt'][class_name] = nb_gt
+    for key in ['voc_ap', 'coco_ap', 'coco_ap50', 'coco_ap75']:
+        res[key.replace('_ap', '_map')] = float(np.mean(list(res[key].values()))) if len(res[key]) > 0 else 0.
+    return res
+
+
+def evaluate_detections_file(bbox_info_file, detections_file, data_dir_path='/data/hav16/imagenet/',
+                             use_07_metric=False, nb_workers=1):
+    """
+    evaluate a csv of detections: file_name, xmin, ymin, xmax, ymax, class_name, score (one detection per line)
+    """
+    gt = load_ground_truth(bbox_info_file, data_dir_path)
+    if data_dir_path[-1] != '/':
+        data_dir_path += '/'
+    file_paths, class_ids, boxes, scores = [], [], [], []
+    with open(detections_file, mode='r') as f:
+        for line in f:
+            if line == '' or line == '\n':
+                continue
+            info_list = line.replace('\n', '').split(',')
+            if info_list[5] not in gt.class_to_idx:
+                continue
+            file_paths.append(data_dir_path + info_list[0])
+            boxes.append([float(v) for v in info_list[1:5]])
+            class_ids.append(gt.class_to_idx[info_list[5]])
+            scores.append(float(info_list[6]))
+    img_ids = get_img_ids(gt, file_paths)
+    in_gt = img_ids >= 0
+    return evaluate_detections(gt, img_ids[in_gt], np.array(class_ids)[in_gt], np.array(boxes).reshape(-1, 4)[in_gt],
+                               np.array(scores)[in_gt], use_07_metric, nb_workers=nb_workers)
+
+
+def _self_check():
+    """APs of toy sets computed by hand"""
+    # one image, 3 ground truth boxes of class 'a', detections by decreasing score: gt 0 (tp), a box away from the
+    # ground truth (fp), gt 1 (tp), then a box of iou 0.625 with gt 2 (tp up to the 0.6 threshold)
+    gt = GroundTruth(['img'], {'a': 0, 'bg': 1}, np.zeros(3, dtype=np.int32), np.zeros(3, dtype=np.int32),
+                     np.array([[0, 0, 10, 10], [20, 0, 30, 10], [40, 0, 50, 10]], dtype=np.float64))
+    det_boxes = np.array([[100, 100, 110, 110], [0, 0, 10, 10], [40, 0, 50, 6.25], [20, 0, 30, 10]])
+    det_scores = np.array([0.8, 0.9, 0.6, 0.7])  # not given in score order
+    det_img_ids, det_class_ids = np.zeros(4), np.zeros(4)
+
+    # VOC: recall 1/3, 1/3, 2/3, 1, precision 1, 1/2, 2/3, 3/4, interpolated 1, 3/4, 3/4, 3/4
+    res = evaluate_detections(gt, det_img_ids, det_class_ids, det_boxes, det_scores)
+    assert np.isclose(res['voc_ap']['a'], 1 / 3. + 2 / 3. * 3 / 4.)
+    # 11 points: recall 0 to 0.3 -> 1, 0.4 to 1 -> 3/4
+    res_07 = evaluate_detections(gt, det_img_ids, det_class_ids, det_boxes, det_scores, use_07_metric=True)
+    assert np.isclose(res_07['voc_ap']['a'], (4 + 7 * 3 / 4.) / 11)
+    # COCO, 101 recall points: 34 at recall <= 1/3, thresholds 0.5 to 0.6 -> the 67 others at 3/4, thresholds
+    # 0.65 to 0.95 (last detection fp) -> 33 at 2/3 (recall <= 2/3) and 34 at 0
+    coco_ap_low = (34 + 67 * 3 / 4.) / 101
+    coco_ap_high = (34 + 33 * 2 / 3.) / 101
+    assert np.isclose(res['coco_ap50']['a'], coco_ap_low) and np.isclose(res['coco_ap75']['a'], coco_ap_high)
+    assert np.isclose(res['coco_ap']['a'], (3 * coco_ap_low + 7 * coco_ap_high) / 10)
+    assert np.isclose(res['voc_map'], res['voc_ap']['a']) and res['nb_gt']['a'] == 3
+
+    # a duplicate of a matched ground truth is a fp, a detection of another image never matches
+    gt = GroundTruth(['img0', 'img1'], {'a': 0, 'b': 1}, np.array([0, 1], dtype=np.int32),
+                     np.array([0, 1], dtype=np.int32), np.array([[0, 0, 10, 10], [0, 0, 10, 10]], dtype=np.float64))
+    det_boxes = np.array([[0, 0, 10, 10], [0, 0, 10, 9.5], [0, 0, 10, 10]])
+    res = evaluate_detections(gt, [0, 0, 1], [0, 0, 0], det_boxes, [0.9, 0.8, 0.95])
+    # class a: fp (image 1), tp, fp (duplicate): recall 0, 1, 1, precision 0, 1/2, 1/3
+    assert np.isclose(res['voc_ap']['a'], 0.5) and np.isclose(res['coco_ap50']['a'], 0.5)
+    assert res['voc_ap']['b'] == 0. and res['coco_ap']['b'] == 0.
+    assert np.isclose(res['voc_map'], 0.25)
+
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['--self-check']:
+        _self_check()
+        print('evaluation self check ok')
+        sys.exit(0)
+    # usage: python evaluation.py bbox_info_file detections_file [data_dir_path] [nb_workers]
+    #        python evaluation.py --self-check
+    data_dir_path = sys.argv[3] if len(sys.argv) > 3 else '/data/hav16/imagenet/'
+    nb_workers = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    start_time = time.time()
+    res = evaluate_detections_file(sys.argv[1], sys.argv[2], data_dir_path, nb_workers=nb_workers)
+    for class_name in sorted(res['voc_ap']):
+        print('%s: VOC AP %.4f, COCO AP %.4f (%d gt)' % (class_name, res['voc_ap'][class_name],
+                                                         res['coco_ap'][class_name], res['nb_gt'][class_name]))
+    print('VOC mAP %.4f, COCO mAP %.4f, mAP50 %.4f, mAP75 %.4f (%.1fs)'
+          % (res['voc_map'], res['coco_map'], res['coco_map50'], res['coco_map75'], time.time() - start_time))
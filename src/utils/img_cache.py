@@ -0,0 +1,161 @@
+"""
+Persistent on-disk cache of images already decoded and resized to the min side (get_resized_img_size),
+so that the jpeg of an image is decoded only once across epochs and processes.
+Each image is a .npy uint8 array named by a hash of its file path and the resize config,
+it is read back with np.load(mmap_mode='r') (no decoding, no copy until the pages are used).
+The cache is bounded by max_bytes: when a new image does not fit, the least recently used images are evicted down to
+low_water (a fraction of max_bytes), so the directory is only scanned once every (1 - low_water) * max_bytes written.
+Recency is kept in memory by each process (an LRU index loaded from the file mtimes, the order images were written
+in); at eviction a process also indexes the images written by the others, as older than the ones it used.
+usage to warm up: python img_cache.py bbox_info_file cache_dir [data_dir_path] [max_gb] [nb_workers]
+"""
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from img_utils import get_resized_img_size, resize_img, load_img_min_side
+
+
+class ResizedImgCache(object):
+
+    def __init__(self, cache_dir, resized_img_min_size=600, max_bytes=50 * 1024 ** 3, load_img=None, low_water=0.9):
+        self.cache_dir = cache_dir
+        self.resized_img_min_size = resized_img_min_size
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.load_img = load_img
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self._lru = None  # cache file -> size, least recently used first, loaded on first use
+        self.total_bytes = 0
+
+    def __getstate__(self):
+        # the cache can be sent to worker processes, each one keeps its own counters and LRU index
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_lru'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """(mtime, size, path) of the images of the cache directory, oldest first"""
+        entries = []
+        for e in os.scandir(self.cache_dir):
+            if e.name.endswith('.npy'):
+                try:
+                    stat = e.stat()
+                except OSError:  # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, e.path))
+        entries.sort()
+        return entries
+
+    def _load_lru(self):
+        if self._lru is None:
+            self._lru = OrderedDict((path, size) for _, size, path in self._scan())
+            self.total_bytes = sum(self._lru.values())
+
+    def _cache_file(self, file_path):
+        key = '%s|%d' % (file_path, self.resized_img_min_size)
+        return os.path.join(self.cache_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + '.npy')
+
+    def get(self, file_path):
+        """resized image of file_path as an uint8 (height, width, 3) array, decoded and stored on a miss"""
+        cache_file = self._cache_file(file_path)
+        try:
+            img = np.load(cache_file, mmap_mode='r')
+            with self._lock:
+                self.hits += 1
+                self._load_lru()
+                if cache_file in self._lru:
+                    self._lru.move_to_end(cache_file)  # most recently used
+                else:  # written by another process
+                    self._lru[cache_file] = img.nbytes + 128
+                    self.total_bytes += img.nbytes + 128
+            return img
+        except (IOError, OSError, ValueError):
+            pass
+        if self.load_img is None:
+            img = load_img_min_side(file_path, self.resized_img_min_size)
+        else:
+            img = self.load_img(file_path)
+            height, width = img.shape[:2]
+            resized_width, resized_height = get_resized_img_size(width, height, self.resized_img_min_size)
+            img = resize_img(img, (resized_height, resized_width))
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        with self._lock:
+            self.misses += 1
+        self._store(cache_file, img)
+        return img
+
+    def _store(self, cache_file, img):
+        nb_bytes = img.nbytes + 128  # npy header
+        if nb_bytes > self.max_bytes:
+            return
+        with self._lock:
+            self._load_lru()
+            self.total_bytes -= self._lru.pop(cache_file, 0)
+            if self.total_bytes + nb_bytes > self.max_bytes:
+                self._evict(int(self.low_water * self.max_bytes) - nb_bytes)
+            self._lru[cache_file] = nb_bytes
+            self.total_bytes += nb_bytes
+        # write then rename so that readers never see a partial file
+        tmp_file = '%s.%d.%d.tmp' % (cache_file, os.getpid(), threading.current_thread().ident)
+        with open(tmp_file, mode='wb') as f:
+            np.save(f, img)
+        os.replace(tmp_file, cache_file)
+
+    def _evict(self, target_bytes):
+        """remove least recently used images until the cache holds at most target_bytes"""
+        # sync the index with the directory: images of other processes go first, evicted ones are dropped
+        on_disk = OrderedDict((path, size) for _, size, path in self._scan())
+        lru = OrderedDict((path, size) for path, size in on_disk.items() if path not in self._lru)
+        lru.update((path, on_disk[path]) for path in self._lru if path in on_disk)
+        self._lru = lru
+        self.total_bytes = sum(lru.values())
+        while self._lru and self.total_bytes > target_bytes:
+            path, size = self._lru.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(path)
+            except OSError:  # evicted by another process
+                continue
+            self.evictions += 1
+
+    def warm_up(self, file_paths, nb_workers=8):
+        """decode and store every image of file_paths that is not cached yet"""
+        with ThreadPoolExecutor(max_workers=nb_workers) as executor:
+            for _ in executor.map(self.get, file_paths):
+                pass
+
+    def stats(self):
+        with self._lock:
+            self._load_lru()
+        nb_requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / float(nb_requests) if nb_requests > 0 else 0., 'total_bytes': self.total_bytes}
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    from bbox_helper import bbox_parser
+    bbox_info_file, cache_dir = sys.argv[1], sys.argv[2]
+    data_dir_path = sys.argv[3] if len(sys.argv) > 3 else '/data/hav16/imagenet/'
+    max_bytes = int(float(sys.argv[4]) * 1024 ** 3) if len(sys.argv) > 4 else 50 * 1024 ** 3
+    nb_workers = int(sys.argv[5]) if len(sys.argv) > 5 else 8
+    all_info, _, _ = bbox_parser(bbox_info_file, data_dir_path)
+    cache = ResizedImgCache(cache_dir, max_bytes=max_bytes)
+    start_time = time.time()
+    cache.warm_up([info['file_path'] for info in all_info], nb_workers)
+    print('warmed up %d images in %.1fs: %s' % (len(all_info), time.time() - start_time, cache.stats()))
@@ -0,0 +1,60 @@
+"""
+Image helpers shared by the data pipeline: output size of the min side resize, image decoding and resizing.
+load_img and resize_img replace scipy.misc.imread and scipy.misc.imresize, which were removed from scipy
+(they were wrappers around PIL). load_img_resized decodes jpeg files directly at a reduced resolution.
+"""
+
+import numpy as np
+from PIL import Image
+
+
+def get_resized_img_size(width, height, resized_img_min_size):
+    if width < height:
+        new_height = int(height * float(resized_img_min_size) / width)
+        new_width = resized_img_min_size
+    else:
+        new_width = int(width * float(resized_img_min_size) / height)
+        new_height = resized_img_min_size
+    return new_width, new_height
+
+
+def resize_img(img, size, resample=Image.BILINEAR):
+    """
+    resize an uint8 image, same as scipy.misc.imresize(img, size) with its default bilinear interpolation
+    :param img: uint8 array (height, width) or (height, width, n_channel)
+    :param size: (new_height, new_width)
+    :return: resized uint8 array
+    """
+    new_height, new_width = size
+    if img.shape[0] == new_height and img.shape[1] == new_width:
+        return img
+    return np.asarray(Image.fromarray(img).resize((new_width, new_height), resample=resample))
+
+
+def load_img(file_path):
+    """decode an image file into an uint8 (height, width, 3) RGB array"""
+    with Image.open(file_path) as img:
+        return np.asarray(img.convert('RGB'))
+
+
+def load_img_resized(file_path, resized_width, resized_height):
+    """
+    decode an image file directly at (resized_width, resized_height) into an uint8 (height, width, 3) RGB array.
+    For jpeg files the decoder draft mode scales the DCT by 1/2, 1/4 or 1/8 so that only a size close to
+    (and not smaller than) the target is decoded, the exact size is then given by a bilinear resize.
+    Boxes of the original image are rescaled with get_bbox_list_resized(bbox, width, height, resized_width, resized_height)
+    """
+    with Image.open(file_path) as img:
+        img.draft('RGB', (resized_width, resized_height))  # no-op for non jpeg files
+        img = img.convert('RGB')
+        if img.size != (resized_width, resized_height):
+            img = img.resize((resized_width, resized_height), resample=Image.BILINEAR)
+        return np.asarray(img)
+
+
+def load_img_min_side(file_path, resized_img_min_size=600):
+    """decode an image file resized to the size given by get_resized_img_size, see load_img_resized"""
+    with Image.open(file_path) as img:
+        width, height = img.size  # read from the header, nothing decoded yet
+    resized_width, resized_height = get_resized_img_size(width, height, resized_img_min_size)
+    return load_img_resized(file_path, resized_width, resized_height)
@@ -0,0 +1,117 @@
+"""
+Stage timers and counters of the data preparation pipeline (bbox_reader, rpn_helper).
+Instrumented code calls count(name, value) and timer(name). Nothing is recorded until a recorder is plugged with
+set_recorder: with no recorder both calls return right after a global lookup, so instrumentation stays in the
+hot paths. A recorder is any object with count(name, value) and add_time(name, seconds) methods, StatsRecorder
+keeps them in memory and writes a JSON report:
+    recorder = instrumentation.StatsRecorder()
+    instrumentation.set_recorder(recorder)
+    ... run the pipeline ...
+    recorder.write_report('report.json')
+"""
+
+import json
+import time
+import threading
+
+_recorder = None
+
+
+def set_recorder(recorder):
+    """plug a recorder (None disables instrumentation), return the previous one"""
+    global _recorder
+    previous = _recorder
+    _recorder = recorder
+    return previous
+
+
+def get_recorder():
+    return _recorder
+
+
+def count(name, value=1):
+    if _recorder is not None:
+        _recorder.count(name, value)
+
+
+class _Timer(object):
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.recorder.add_time(self.name, time.time() - self.start)
+        return False
+
+
+class _NoTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+def timer(name):
+    """context manager adding its elapsed time to the timer name"""
+    if _recorder is None:
+        return _NO_TIMER
+    return _Timer(_recorder, name)
+
+
+class StatsRecorder(object):
+    """counters (sums) and timers (total seconds and number of calls) kept in memory, thread safe"""
+
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+        self._lock = threading.Lock()
+        self.start_time = time.time()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            total, calls = self.timers.get(name, (0., 0))
+            self.timers[name] = (total + seconds, calls + 1)
+
+    def merge(self, stats):
+        """add the counters and timers of stats (a report of another recorder, e.g. of a worker process)"""
+        for name, value in stats['counters'].items():
+            self.count(name, value)
+        with self._lock:
+            for name, timer_stats in stats['timers'].items():
+                total, calls = self.timers.get(name, (0., 0))
+                self.timers[name] = (total + timer_stats['seconds'], calls + timer_stats['calls'])
+
+    def report(self):
+        with self._lock:
+            return {'elapsed': time.time() - self.start_time,
+                    'counters': dict(self.counters),
+                    'timers': dict((name, {'seconds': total, 'calls': calls})
+                                   for name, (total, calls) in self.timers.items())}
+
+    def write_report(self, report_file):
+        with open(report_file, mode='w') as f:
+            json.dump(self.report(), f, indent=1, sort_keys=True)
@@ -10,14 +10,22 @@ classification and tightened bounding boxes.
 """
 
 from bbox_helper import get_bbox_list_resized, bbox_parser, random_visualize_bbox_img, show_img_with_bbox, show_img_from_file
+from box_geometry import bbox_list_to_array, iou_matrix, encode_regr
+from img_utils import get_resized_img_size
+import instrumentation
 import numpy as np
 import random
+from functools import lru_cache
 np.set_printoptions(threshold=np.inf)  # set this to force numpy to fully print
 
 # Note that bbox represented by xmin, ymin, xmax, ymax
 # use list instead of dict for faster comptutation -> bb_list has form xmin, ymin, xmax, ymax
 
 
+# scalar versions of the box_geometry functions (same arithmetic) for a single pair of boxes, plain python is much
+# faster than numpy on one box
+
+
 def area(bb):
     return (bb[2] - bb[0]) * (bb[3] - bb[1])
 
@@ -46,18 +54,8 @@ def iou(bb1, bb2):
 
 def iou_dict(bb1_dict, bb2_dict):
     # note that list form is the following: xmin, ymin, xmax, ymax
-    bb1 = [bb1_dict['xmin'], bb1_dict['ymin'], bb1_dict['xmax'], bb1_dict['ymax']]
-    bb2 = [bb2_dict['xmin'], bb2_dict['ymin'], bb2_dict['xmax'], bb2_dict['ymax']]
-    return iou(bb1, bb2)
-
-def get_resized_img_size(width, height, resized_img_min_size):
-    if width < height:
-        new_height = int(height * float(resized_img_min_size) / width)
-        new_width = resized_img_min_size
-    else:
-        new_width = int(width * float(resized_img_min_size) / height)
-        new_height = resized_img_min_size
-    return new_width, new_height
+    return iou((bb1_dict['xmin'], bb1_dict['ymin'], bb1_dict['xmax'], bb1_dict['ymax']),
+               (bb2_dict['xmin'], bb2_dict['ymin'], bb2_dict['xmax'], bb2_dict['ymax']))
 
 
 def compute_feat_size_resnet(width, height):
@@ -89,48 +87,32 @@ def compute_regr(anchor_box, gt_box):
     return tx_star, ty_star, tw_star, th_star
 
 
-def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_height, compute_feature_sizes):
+def _label_anchors_loop(ground_truth_bb_list, config, resized_width, resized_height, feat_width, feat_height):
     """
-    
-    :param img_info: all_info from bbox_parser but for each image only
-    :param config: a dict contain some attribute for configuration
-    :param width: original width of the image
-    :param height: original height of the image
-    :param resized_width: resized width of the image
-    :param resized_height: resized height of the image
-    :param compute_feature_sizes: width and height of the output when passing resized image through the conv layers
-    :return: rpn of that image
+    reference implementation of the anchor labelling: visit every (anchor, ground truth box) pair in python
+    :return: y_is_box_valid, y_rpn_overlap, y_rpn_regr of shape (feat_height, feat_width, n_anchors (* 4 for regr))
     """
-    # step 0.1: get info from config file
-    down_scale = config['down_scale']  # scale downed after conv layers (4 time 2-stride = 2^4 = 16)
+    down_scale = config['down_scale']
     anchor_sizes = config['anchor_sizes']
     anchor_ratios = config['anchor_ratios']
     n_anchors = len(anchor_sizes) * len(anchor_ratios)
 
-    # step 0.2: prepare data from img_info
-    n_bbs = len(img_info['bbox'])  # number of bboxes in this image
+    n_bbs = len(ground_truth_bb_list)  # number of bboxes in this image
     best_iou_for_bb = np.zeros(n_bbs, dtype=np.float32)
-    n_anchor_ratios = len(config['anchor_ratios'])
+    n_anchor_ratios = len(anchor_ratios)
 
-    # step 0.3 init some buffers
+    # init some buffers
     best_anchor_for_bb = -1 * np.ones((n_bbs, 4), dtype=np.int32)
     best_corner_for_bb = np.ones((n_bbs, 4), dtype=np.int32)
     best_param_for_bb = np.ones((n_bbs, 4), dtype=np.float32)
     num_anchor_for_bb = np.zeros(n_bbs, dtype=np.int32)
 
-    # step 0.4: resize bbox:
-    ground_truth_bb_list = get_bbox_list_resized(img_info['bbox'], width, height, resized_width, resized_height)
-
-    # step 1: compute a number of anchors for each pixel in the output mapget_bbox_list_resized
-    # step 1.1: get feature map size (after conv layers), note that image input is the resized one
-    feat_width, feat_height = compute_feature_sizes(resized_width, resized_height)
-
-    # step 1.2: init output objectives at every pixel of feature map, consider n anchors
+    # init output objectives at every pixel of feature map, consider n anchors
     y_is_box_valid = np.zeros((feat_height, feat_width, n_anchors))  # take binary value, 1 means anchor is in image
     y_rpn_overlap = np.zeros((feat_height, feat_width, n_anchors))  # take binary value, 1 means anchor is positive
     y_rpn_regr = np.zeros((feat_height, feat_width, n_anchors * 4))  # describe 4 params for regression (tx, ty, th, tw)
 
-    # step 1.3: for each pixel in feature map, compute valid anchors
+    # for each pixel in feature map, compute valid anchors
     for anchor_size_idx in range(len(anchor_sizes)):
         for anchor_ratio_idx in range(len(anchor_ratios)):
             anchor_width = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
@@ -191,17 +173,15 @@ def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_h
                         y_rpn_overlap[feat_y, feat_x, anchor_ratio_idx + n_anchor_ratios * anchor_size_idx] = 1
                         # because of 4 params for regression
                         start_idx = 4 * (anchor_ratio_idx + n_anchor_ratios * anchor_size_idx)
-                        print(best_regression)
                         y_rpn_regr[feat_y, feat_x, start_idx: start_idx + 4] = best_regression
                     else:
                         y_is_box_valid[feat_y, feat_x, anchor_ratio_idx + n_anchor_ratios * anchor_size_idx] = 0
                         y_rpn_overlap[feat_y, feat_x, anchor_ratio_idx + n_anchor_ratios * anchor_size_idx] = 0
 
-
     # every ground truth bbox must have at least one positive anchor:
     for bb_idx in range(n_bbs):
         if num_anchor_for_bb[bb_idx] == 0:
-            print('bbox with no positive anchor')
+            instrumentation.count('rpn.bbox_no_positive_anchor')
             if best_anchor_for_bb[bb_idx, 0] == -1:
                 continue
             feat_y, feat_x, anchor_ratio_idx, anchor_size_idx = best_anchor_for_bb[bb_idx]
@@ -210,6 +190,195 @@ def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_h
             start_idx = 4 * (anchor_ratio_idx + n_anchor_ratios * anchor_size_idx)
             y_rpn_regr[feat_y, feat_x, start_idx: start_idx + 4] = best_param_for_bb[bb_idx]
 
+    return y_is_box_valid, y_rpn_overlap, y_rpn_regr
+
+
+# number of (resized image size, anchor config) grids kept by get_anchor_grid, resized ImageNet images only have a few
+# distinct sizes so a small cache is enough to never rebuild a grid during training
+ANCHOR_GRID_CACHE_SIZE = 64
+
+
+def get_anchor_grid(resized_width, resized_height, config, compute_feature_sizes=compute_feat_size_resnet):
+    """
+    all anchors lying inside the resized image, in the same order as the labelling loop visits them
+    (anchor size, anchor ratio, feat_x, feat_y). Grids are cached (LRU) by resized size and anchor config,
+    the returned arrays are shared between calls so they are read-only.
+    :param resized_width: resized width of the image
+    :param resized_height: resized height of the image
+    :param config: a dict containing down_scale, anchor_sizes and anchor_ratios
+    :param compute_feature_sizes: width and height of the output when passing resized image through the conv layers
+    :return: anchors float64 (N, 4) as xmin, ymin, xmax, ymax, the corners computed by _label_anchors_loop
+    and their index int32 (N, 4) as feat_y, feat_x, anchor_ratio_idx, anchor_size_idx
+    """
+    return _build_anchor_grid(resized_width, resized_height, config['down_scale'], tuple(config['anchor_sizes']),
+                              tuple(tuple(ratio) for ratio in config['anchor_ratios']), compute_feature_sizes)
+
+
+@lru_cache(maxsize=ANCHOR_GRID_CACHE_SIZE)
+def _build_anchor_grid(resized_width, resized_height, down_scale, anchor_sizes, anchor_ratios, compute_feature_sizes):
+    feat_width, feat_height = compute_feature_sizes(resized_width, resized_height)
+    centers_x = down_scale * (np.arange(feat_width) + 0.5)
+    centers_y = down_scale * (np.arange(feat_height) + 0.5)
+    anchors = []
+    anchor_idx = []
+    for anchor_size_idx in range(len(anchor_sizes)):
+        for anchor_ratio_idx in range(len(anchor_ratios)):
+            anchor_width = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
+            anchor_height = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][1]
+            feat_xs = np.nonzero((centers_x - anchor_width / 2. >= 0) &
+                                 (centers_x + anchor_width / 2. <= resized_width))[0]
+            feat_ys = np.nonzero((centers_y - anchor_height / 2. >= 0) &
+                                 (centers_y + anchor_height / 2. <= resized_height))[0]
+            # feat_y runs fastest, like the innermost loop
+            grid_x, grid_y = np.meshgrid(feat_xs, feat_ys, indexing='ij')
+            grid_x = grid_x.ravel()
+            grid_y = grid_y.ravel()
+            anchors.append(np.stack([centers_x[grid_x] - anchor_width / 2., centers_y[grid_y] - anchor_height / 2.,
+                                     centers_x[grid_x] + anchor_width / 2., centers_y[grid_y] + anchor_height / 2.],
+                                    axis=1))
+            anchor_idx.append(np.stack([grid_y, grid_x, np.full_like(grid_x, anchor_ratio_idx),
+                                        np.full_like(grid_x, anchor_size_idx)], axis=1))
+    anchors = np.ascontiguousarray(np.concatenate(anchors, axis=0), dtype=np.float64).reshape(-1, 4)
+    anchor_idx = np.ascontiguousarray(np.concatenate(anchor_idx, axis=0), dtype=np.int32).reshape(-1, 4)
+    anchors.setflags(write=False)
+    anchor_idx.setflags(write=False)
+    return anchors, anchor_idx
+
+
+def anchor_grid_cache_info():
+    """hits, misses, maxsize and currsize of the anchor grid cache"""
+    return _build_anchor_grid.cache_info()
+
+
+# the loop compares a python float iou with the float32 running best of each bbox, the precision of that comparison
+# follows numpy's scalar promotion rules (float64 before NEP 50, float32 after), the vectorized path must do the same
+_BEST_IOU_CMP_DTYPE = (np.float32(0) + 0.).dtype
+
+
+def _label_anchors_sparse(ground_truth_bb_list, config, anchors, anchor_idx, feat_width, feat_height):
+    """
+    same labelling as _label_anchors_loop but computed on the whole anchors x ground truth iou matrix at once,
+    only positive and negative anchors are returned, as flat indexes in the (anchor_idx, feat_y, feat_x) layout
+    of y_rpn_class
+    :param anchors, anchor_idx: the anchor grid of the resized image, see get_anchor_grid
+    :return: pos_idx int64 (nb_pos,) sorted, pos_regr float64 (nb_pos, 4), neg_idx int64 (nb_neg,) sorted
+    """
+    n_anchor_ratios = len(config['anchor_ratios'])
+    upper_bound_iou = config['upper_bound_iou']
+    lower_bound_iou = config['lower_bound_iou']
+
+    anchors = np.asarray(anchors, dtype=np.float64)
+    n_valid = len(anchors)
+    n_bbs = len(ground_truth_bb_list)
+    if n_valid == 0:
+        instrumentation.count('rpn.bbox_no_positive_anchor', n_bbs)
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    channels = anchor_idx[:, 2] + n_anchor_ratios * anchor_idx[:, 3]
+    flat_idx = (channels.astype(np.int64) * feat_height + anchor_idx[:, 0]) * feat_width + anchor_idx[:, 1]
+
+    gt_boxes = bbox_list_to_array(ground_truth_bb_list)
+    ious = iou_matrix(anchors, gt_boxes)  # (n_valid, n_bbs)
+
+    # best iou of each bbox before visiting each anchor, kept in float32 like best_iou_for_bb in the loop
+    best_iou_before = np.zeros((n_valid, n_bbs), dtype=np.float32)
+    best_iou_before[1:] = np.maximum.accumulate(ious[:-1].astype(np.float32), axis=0)
+    improves = ious.astype(_BEST_IOU_CMP_DTYPE) > best_iou_before
+    positive = ious > upper_bound_iou
+    neutral = improves & (lower_bound_iou < ious) & (ious < upper_bound_iou)
+
+    # the type of an anchor is set by the last bbox that marks it positive or neutral, negative if none does
+    marks = np.where(positive, 2, np.where(neutral, 1, 0))  # 0: negative, 1: neutral, 2: positive
+    last_marking_bb = np.where(marks != 0, np.arange(n_bbs), -1).max(axis=1, initial=-1)
+    # a leading column of 0 gives negative to anchors not marked by any bbox (last_marking_bb == -1)
+    marks = np.concatenate([np.zeros((n_valid, 1), dtype=marks.dtype), marks], axis=1)
+    anchor_type = marks[np.arange(n_valid), last_marking_bb + 1]
+
+    # every ground truth bbox must have at least one positive anchor:
+    fallback_regr = {}  # anchor -> regression, a later bbox overwrites an earlier one as in the loop
+    num_anchor_for_bb = positive.sum(axis=0)
+    for bb_idx in range(n_bbs):
+        if num_anchor_for_bb[bb_idx] == 0:
+            instrumentation.count('rpn.bbox_no_positive_anchor')
+            if not improves[:, bb_idx].any():
+                continue
+            # the loop keeps the last anchor that improved the best iou of this bbox
+            best_anchor = n_valid - 1 - np.argmax(improves[::-1, bb_idx])
+            anchor_type[best_anchor] = 2
+            fallback_regr[best_anchor] = encode_regr(anchors[best_anchor], gt_boxes[bb_idx]).astype(np.float32)
+
+    pos_anchors = np.flatnonzero(anchor_type == 2)
+    pos_regr = np.zeros((len(pos_anchors), 4))
+    if len(pos_anchors) > 0:
+        # regress a positive anchor to the first bbox with the highest iou among those making it positive
+        best_bb_for_loc = np.argmax(np.where(positive[pos_anchors], ious[pos_anchors], -1.), axis=1)
+        pos_regr[:] = encode_regr(anchors[pos_anchors], gt_boxes[best_bb_for_loc])
+    for anchor, regr in fallback_regr.items():
+        pos_regr[np.searchsorted(pos_anchors, anchor)] = regr
+
+    pos_order = np.argsort(flat_idx[pos_anchors])
+    neg_idx = np.sort(flat_idx[anchor_type == 0])
+    if instrumentation.get_recorder() is not None:
+        instrumentation.count('rpn.anchors_positive', len(pos_anchors))
+        instrumentation.count('rpn.anchors_negative', len(neg_idx))
+        instrumentation.count('rpn.anchors_neutral', n_valid - len(pos_anchors) - len(neg_idx))
+    return flat_idx[pos_anchors][pos_order], pos_regr[pos_order], neg_idx
+
+
+def _label_anchors_vectorized(ground_truth_bb_list, config, anchors, anchor_idx, feat_width, feat_height):
+    """
+    _label_anchors_sparse scattered into the dense outputs of _label_anchors_loop
+    :return: y_is_box_valid, y_rpn_overlap, y_rpn_regr of shape (feat_height, feat_width, n_anchors (* 4 for regr))
+    """
+    n_anchors = len(config['anchor_sizes']) * len(config['anchor_ratios'])
+    pos_idx, pos_regr, neg_idx = _label_anchors_sparse(ground_truth_bb_list, config, anchors, anchor_idx,
+                                                       feat_width, feat_height)
+    nb_locs = feat_height * feat_width
+    y_is_box_valid = np.zeros(n_anchors * nb_locs)
+    y_rpn_overlap = np.zeros(n_anchors * nb_locs)
+    y_rpn_regr = np.zeros((n_anchors, 4, nb_locs))
+    y_is_box_valid[pos_idx] = 1
+    y_is_box_valid[neg_idx] = 1
+    y_rpn_overlap[pos_idx] = 1
+    pos_channels, pos_locs = np.divmod(pos_idx, nb_locs)
+    y_rpn_regr[pos_channels, :, pos_locs] = pos_regr
+
+    # (anchor_idx, feat_y, feat_x) -> (feat_y, feat_x, anchor_idx)
+    y_is_box_valid = np.transpose(y_is_box_valid.reshape(n_anchors, feat_height, feat_width), (1, 2, 0))
+    y_rpn_overlap = np.transpose(y_rpn_overlap.reshape(n_anchors, feat_height, feat_width), (1, 2, 0))
+    y_rpn_regr = np.transpose(y_rpn_regr.reshape(4 * n_anchors, feat_height, feat_width), (1, 2, 0))
+    return y_is_box_valid, y_rpn_overlap, y_rpn_regr
+
+
+def compute_rpn_labels(img_info, config, width, height, resized_width, resized_height, compute_feature_sizes,
+                       vectorized=True):
+    """
+    deterministic part of compute_rpn_of_img: label every anchor as positive, neutral or negative (every bbox having
+    at least one positive anchor) and compute the regression of positive anchors
+    :param vectorized: label anchors on the whole anchors x bboxes iou matrix instead of the python loop
+    :return: y_is_box_valid, y_rpn_overlap (feat_height, feat_width, n_anchors) and
+    y_rpn_regr (feat_height, feat_width, 4 * n_anchors)
+    """
+    # step 0: resize bbox:
+    ground_truth_bb_list = get_bbox_list_resized(img_info['bbox'], width, height, resized_width, resized_height)
+
+    # step 1: compute a number of anchors for each pixel in the output map
+    # step 1.1: get feature map size (after conv layers), note that image input is the resized one
+    feat_width, feat_height = compute_feature_sizes(resized_width, resized_height)
+
+    # step 1.2: label every anchor of the feature map as positive, neutral or negative
+    if vectorized:
+        anchors, anchor_idx = get_anchor_grid(resized_width, resized_height, config, compute_feature_sizes)
+        return _label_anchors_vectorized(ground_truth_bb_list, config, anchors, anchor_idx, feat_width, feat_height)
+    return _label_anchors_loop(ground_truth_bb_list, config, resized_width, resized_height, feat_width, feat_height)
+
+
+def sample_rpn_regions(y_is_box_valid, y_rpn_overlap, y_rpn_regr, num_regions=256):
+    """
+    random part of compute_rpn_of_img: keep at most num_regions valid anchors, at most half of them positive,
+    and stack the outputs (y_is_box_valid is modified)
+    :param y_is_box_valid, y_rpn_overlap, y_rpn_regr: outputs of compute_rpn_labels
+    :return: y_rpn_class (1, 2 * n_anchors, feat_height, feat_width), y_rpn_regr (1, 8 * n_anchors, feat_height, feat_width)
+    """
     # arrange output by (anchor_idx, feat_y, feat_x) (i.e.: anchor_idx, row_idx, col_idx)
     y_rpn_overlap = np.transpose(y_rpn_overlap, (2, 0, 1))
     y_is_box_valid = np.transpose(y_is_box_valid, (2, 0, 1))
@@ -224,24 +393,22 @@ def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_h
     neg_locs = np.where(np.logical_and(y_rpn_overlap[0, :, :, :] == 0, y_is_box_valid[0, :, :, :] == 1))
 
     num_pos = len(pos_locs[0])
-    print('num pos = ', num_pos)
-    # print(pos_locs[0])
     # one issue is that the RPN has many more negative than positive regions, so we turn off some of the negative
     # regions. We also limit it to 256 regions. (see part 3.1.3 in paper)
-    num_regions = 256
 
-    if len(pos_locs[0]) > num_regions / 2:
-        to_ignore_locs = random.sample(range(len(pos_locs[0])), len(pos_locs[0]) - num_regions / 2)
+    if len(pos_locs[0]) > num_regions // 2:
+        to_ignore_locs = random.sample(range(len(pos_locs[0])), len(pos_locs[0]) - num_regions // 2)
         y_is_box_valid[0, pos_locs[0][to_ignore_locs], pos_locs[1][to_ignore_locs], pos_locs[2][to_ignore_locs]] = 0
-        num_pos = num_regions / 2
+        num_pos = num_regions // 2
 
     if len(neg_locs[0]) + num_pos > num_regions:
         to_ignore_locs = random.sample(range(len(neg_locs[0])), len(neg_locs[0]) + num_pos - num_regions)
         y_is_box_valid[0, neg_locs[0][to_ignore_locs], neg_locs[1][to_ignore_locs], neg_locs[2][to_ignore_locs]] = 0
+    instrumentation.count('rpn.sampled_positive', num_pos)
+    instrumentation.count('rpn.sampled_negative', min(len(neg_locs[0]), num_regions - num_pos))
 
     y_rpn_class = np.concatenate([y_is_box_valid, y_rpn_overlap], axis=1)
     y_rpn_regr = np.concatenate([np.repeat(y_rpn_overlap, 4, axis=1), y_rpn_regr], axis=1)
-    print(np.repeat(y_rpn_overlap, 4, axis=1))
     # y_rpn_class: 1, 2 * nb_anchors, feat_height, feat_width
     # y_rpn_regr: 1, 8 * nb_anchors, feat_height, feat_width
     # TODO: check why stack like this?
@@ -252,34 +419,32 @@ def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_h
     return y_rpn_class, y_rpn_regr
 
 
+def compute_rpn_of_img(img_info, config, width, height, resized_width, resized_height, compute_feature_sizes,
+                       vectorized=True):
+    """
+    
+    :param img_info: all_info from bbox_parser but for each image only
+    :param config: a dict contain some attribute for configuration
+    :param width: original width of the image
+    :param height: original height of the image
+    :param resized_width: resized width of the image
+    :param resized_height: resized height of the image
+    :param compute_feature_sizes: width and height of the output when passing resized image through the conv layers
+    :param vectorized: label anchors on the whole anchors x bboxes iou matrix instead of the python loop
+    :return: rpn of that image
+    """
+    with instrumentation.timer('rpn.labels'):
+        y_is_box_valid, y_rpn_overlap, y_rpn_regr = compute_rpn_labels(img_info, config, width, height, resized_width,
+                                                                       resized_height, compute_feature_sizes,
+                                                                       vectorized)
+    with instrumentation.timer('rpn.sampling'):
+        return sample_rpn_regions(y_is_box_valid, y_rpn_overlap, y_rpn_regr)
+
+
 def get_all_anchor(resized_img_width, resized_img_height, config):
-    # first get feature map sizes:
-    feat_width, feat_height = compute_feat_size_resnet(resized_img_width, resized_img_height)
-    down_scale = config['down_scale']
-    anchor_sizes = config['anchor_sizes']
-    anchor_ratios = config['anchor_ratios']
-    # n_anchors = len(anchor_sizes) * len(anchor_ratios)
-    anchors = []
-    for anchor_size_idx in range(len(anchor_sizes)):
-        for anchor_ratio_idx in range(len(anchor_ratios)):
-            anchor_width = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][0]
-            anchor_height = anchor_sizes[anchor_size_idx] * anchor_ratios[anchor_ratio_idx][1]
-            for feat_x in range(feat_width):
-                # from center of the anchor box, up_scale and +- anchor_width/2 to get xmin, xmax
-                # + 0.5 since idx starts from 0
-                anchor_xmin = down_scale * (feat_x + 0.5) - (anchor_width / 2)
-                anchor_xmax = down_scale * (feat_x + 0.5) + (anchor_width / 2)
-                if anchor_xmin < 0 or anchor_xmax > resized_img_width:
-                    continue
-                for feat_y in range(feat_height):
-                    anchor_ymin = down_scale * (feat_y + 0.5) - (anchor_height / 2)
-                    anchor_ymax = down_scale * (feat_y + 0.5) + (anchor_height / 2)
-                    if anchor_ymin < 0 or anchor_ymax > resized_img_height:
-                        continue
-                    cur_anchor = {'class': 'anchor', 'xmin': anchor_xmin, 'ymin': anchor_ymin,
-                                  'xmax': anchor_xmax, 'ymax': anchor_ymax}
-                    anchors.append(cur_anchor)
-    return anchors
+    anchors, _ = get_anchor_grid(resized_img_width, resized_img_height, config)
+    return [{'class': 'anchor', 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
+            for xmin, ymin, xmax, ymax in anchors.tolist()]
 
 
 if __name__ == '__main__':
@@ -295,7 +460,7 @@ if __name__ == '__main__':
     all_anchors = get_all_anchor(resized_width, resized_height, config)
 
     print(len(all_anchors))
-    all_ious = [iou_dict(gt_bbs[0], all_anchors[i]) for i in range(len(all_anchors))]
+    all_ious = iou_matrix(get_anchor_grid(resized_width, resized_height, config)[0], bbox_list_to_array(gt_bbs))[:, 0]
     idx_sorted = np.argsort(all_ious)
 
     print(idx_sorted[-3:])
@@ -0,0 +1,79 @@
+"""
+Proposal stage between the rpn and the Fast R-CNN head: turn the rpn outputs of an image into a fixed number of
+region proposals (the inverse of the targets of compute_rpn_of_img).
+rpn outputs use the layout of the second half of the targets:
+    rpn_class (n_anchors, feat_height, feat_width) objectness score of each anchor
+    rpn_regr (4 * n_anchors, feat_height, feat_width) tx, ty, tw, th of each anchor
+where anchor index = anchor_ratio_idx + len(anchor_ratios) * anchor_size_idx. Only the anchors labelled during
+training, those of the cached anchor grid (get_anchor_grid), are decoded.
+"""
+
+import numpy as np
+from box_geometry import decode_regr, clip_boxes, nms
+from rpn_helper import get_anchor_grid, compute_feat_size_resnet
+
+
+def rpn_to_proposals(rpn_class, rpn_regr, resized_width, resized_height, config, pre_nms_top_k=6000,
+                     post_nms_top_k=300, nms_iou_threshold=0.7, min_size=16,
+                     compute_feature_sizes=compute_feat_size_resnet):
+    """
+    decode the rpn outputs of an image into proposals: decode the regression of each anchor, clip to the resized
+    image, drop boxes smaller than min_size, keep the pre_nms_top_k best scores then the post_nms_top_k first boxes
+    kept by the nms
+    :param rpn_class: (n_anchors, fh, fw) or (1, n_anchors, fh, fw) scores, fh, fw may be larger than the feature map
+    of the image (padded batch)
+    :param rpn_regr: (4 * n_anchors, fh, fw) or (1, 4 * n_anchors, fh, fw)
+    :param resized_width: width of the resized image given to the rpn
+    :param resized_height: height of the resized image given to the rpn
+    :param config: a dict containing down_scale, anchor_sizes and anchor_ratios
+    :param min_size: min width and height of a proposal, in resized image pixels
+    :return: proposals float32 (post_nms_top_k, 4) xmin, ymin, xmax, ymax in resized image coordinates,
+    scores float32 (post_nms_top_k,) by decreasing score, number of valid proposals (the rest is zero padding)
+    """
+    rpn_class = np.asarray(rpn_class)
+    rpn_regr = np.asarray(rpn_regr)
+    if rpn_class.ndim == 4:
+        rpn_class, rpn_regr = rpn_class[0], rpn_regr[0]
+    n_anchor_ratios = len(config['anchor_ratios'])
+    anchors, anchor_idx = get_anchor_grid(resized_width, resized_height, config, compute_feature_sizes)
+    feat_ys, feat_xs = anchor_idx[:, 0], anchor_idx[:, 1]
+    channels = anchor_idx[:, 2] + n_anchor_ratios * anchor_idx[:, 3]
+
+    scores = rpn_class[channels, feat_ys, feat_xs]
+    regr_channels = 4 * channels[:, np.newaxis] + np.arange(4)
+    regr = rpn_regr[regr_channels, feat_ys[:, np.newaxis], feat_xs[:, np.newaxis]]
+    boxes = clip_boxes(decode_regr(anchors, regr), resized_width, resized_height)
+
+    big_enough = ((boxes[:, 2] - boxes[:, 0]) >= min_size) & ((boxes[:, 3] - boxes[:, 1]) >= min_size)
+    boxes, scores = boxes[big_enough], scores[big_enough]
+    if len(scores) > pre_nms_top_k:
+        top_k = np.argpartition(-scores, pre_nms_top_k - 1)[:pre_nms_top_k]
+        top_k.sort()  # keep the anchor order between equal scores
+        boxes, scores = boxes[top_k], scores[top_k]
+    keep = nms(boxes, scores, nms_iou_threshold, post_nms_top_k)
+
+    proposals = np.zeros((post_nms_top_k, 4), dtype=np.float32)
+    proposal_scores = np.zeros(post_nms_top_k, dtype=np.float32)
+    proposals[:len(keep)] = boxes[keep]
+    proposal_scores[:len(keep)] = scores[keep]
+    return proposals, proposal_scores, len(keep)
+
+
+def rpn_batch_to_proposals(rpn_class, rpn_regr, resized_sizes, config, pre_nms_top_k=6000, post_nms_top_k=300,
+                           nms_iou_threshold=0.7, min_size=16, compute_feature_sizes=compute_feat_size_resnet):
+    """
+    rpn_to_proposals on each image of a (zero padded) batch
+    :param rpn_class: (B, n_anchors, fh, fw)
+    :param rpn_regr: (B, 4 * n_anchors, fh, fw)
+    :param resized_sizes: (resized_width, resized_height) of each image
+    :return: proposals float32 (B, post_nms_top_k, 4), scores float32 (B, post_nms_top_k),
+    number of valid proposals int32 (B,)
+    """
+    proposals = np.zeros((len(resized_sizes), post_nms_top_k, 4), dtype=np.float32)
+    scores = np.zeros((len(resized_sizes), post_nms_top_k), dtype=np.float32)
+    nb_proposals = np.zeros(len(resized_sizes), dtype=np.int32)
+    for img_idx, (resized_width, resized_height) in enumerate(resized_sizes):
+        proposals[img_idx], scores[img_idx], nb_proposals[img_idx] = rpn_to_proposals(
+            rpn_class[img_idx], rpn_regr[img_idx], resized_width, resized_height, config, pre_nms_top_k,
+            post_nms_top_k, nms_iou_threshold, min_size, compute_feature_sizes)
+    return proposals, scores, nb_proposals
@@ -0,0 +1,378 @@
+"""
+Offline store of the deterministic part of the rpn targets (compute_rpn_targets) of every image of a bbox info file.
+Only the random 256 regions subsampling (sample_rpn_targets) is left to run at training time.
+A store is a directory named by a hash of the config and of the bbox info file (path, size and mtime), holding the
+compact RPNTargets (rpn_targets.py) of every image:
+    feat_sizes.npy   int32 (nb_imgs, 2) feat_width, feat_height
+    pos_offsets.npy  int64 (nb_imgs + 1,) positive anchors of image i are pos_idx[pos_offsets[i]:pos_offsets[i + 1]]
+    pos_idx.npy      int32 (nb_pos,)
+    pos_regr.npy     float32 (nb_pos, 4) tx, ty, tw, th
+    neg_offsets.npy  int64 (nb_imgs + 1,)
+    neg_idx.npy      int32 (nb_neg,)
+    names.npy, name_offsets.npy  file names of the images (string table as in bbox_store)
+    config.json      the config the targets were computed with, written last (a store without it is incomplete)
+    stats.json       dataset statistics of the targets (rpn_target_stats)
+Since anchors are kept in the order of y_rpn_class, sampling the stored targets with the same random state gives
+the same outputs as compute_rpn_of_img (up to the float32 rounding of the regression).
+The targets are appended to the .npy files chunk by chunk as they are computed, the build never holds the targets of
+the whole dataset in memory.
+"""
+
+import os
+import json
+import time
+import struct
+import hashlib
+import binascii
+import multiprocessing
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+import instrumentation
+from bbox_helper import bbox_parser
+from img_utils import get_resized_img_size
+from rpn_helper import compute_feat_size_resnet
+from rpn_targets import make_rpn_targets, compute_rpn_targets, sample_rpn_targets, expand_rpn_targets
+
+_ARRAY_NAMES = ['feat_sizes', 'pos_offsets', 'pos_idx', 'pos_regr', 'neg_offsets', 'neg_idx', 'names', 'name_offsets']
+
+
+def config_hash(config, resized_img_min_size=600, compute_feature_sizes=compute_feat_size_resnet, bbox_info_file=None,
+                data_dir_path=None):
+    """
+    hash of everything the deterministic targets depend on
+    :param bbox_info_file: the annotations, identified by their absolute path, size and mtime (so a store is never
+    reused for an edited file), and the data_dir_path of the file paths stored with the targets
+    """
+    key = {'config': config, 'resized_img_min_size': resized_img_min_size,
+           'compute_feature_sizes': compute_feature_sizes.__name__}
+    if bbox_info_file is not None:
+        stat = os.stat(bbox_info_file)
+        key['bbox_info_file'] = [os.path.abspath(bbox_info_file), stat.st_size, stat.st_mtime_ns]
+        key['data_dir_path'] = data_dir_path
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+def get_store_path(store_dir, config, resized_img_min_size=600, compute_feature_sizes=compute_feat_size_resnet,
+                   bbox_info_file=None, data_dir_path=None):
+    return os.path.join(store_dir, 'rpn_targets_' + config_hash(config, resized_img_min_size, compute_feature_sizes,
+                                                                bbox_info_file, data_dir_path))
+
+
+def compute_img_rpn_targets(img_info, config, resized_img_min_size=600, compute_feature_sizes=compute_feat_size_resnet):
+    """compute_rpn_targets of an image of bbox_parser"""
+    width, height = img_info['width'], img_info['height']
+    resized_width, resized_height = get_resized_img_size(width, height, resized_img_min_size)
+    return compute_rpn_targets(img_info, config, width, height, resized_width, resized_height, compute_feature_sizes)
+
+
+def _flatten_targets(targets_list):
+    """RPNTargets of images concatenated into the flat arrays of a store (counts instead of offsets)"""
+    return {'feat_sizes': np.array([(targets.feat_width, targets.feat_height) for targets in targets_list],
+                                   dtype=np.int32).reshape(-1, 2),
+            'pos_counts': np.array([len(targets.pos_idx) for targets in targets_list], dtype=np.int64),
+            'pos_idx': np.concatenate([targets.pos_idx for targets in targets_list] + [np.zeros(0, dtype=np.int32)]),
+            'pos_regr': np.concatenate([targets.pos_regr for targets in targets_list] +
+                                       [np.zeros((0, 4), dtype=np.float32)]),
+            'neg_counts': np.array([len(targets.neg_idx) for targets in targets_list], dtype=np.int64),
+            'neg_idx': np.concatenate([targets.neg_idx for targets in targets_list] + [np.zeros(0, dtype=np.int32)])}
+
+
+_NPY_HEADER_SIZE = 128  # header of the .npy files written chunk by chunk, aligned for the memory maps
+
+
+class _NpyAppender(object):
+    """.npy file written by appending arrays of rows, the header (with the final number of rows) is written on close"""
+
+    def __init__(self, path, dtype, row_shape=()):
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.nb_rows = 0
+        self._file = open(path, mode='wb')
+        self._file.write(b'\0' * _NPY_HEADER_SIZE)
+
+    def append(self, array):
+        self._file.write(np.ascontiguousarray(array, dtype=self.dtype).tobytes())
+        self.nb_rows += len(array)
+
+    def close(self):
+        magic = np.lib.format.magic(1, 0)
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                       'shape': (self.nb_rows,) + self.row_shape})
+        # padded with spaces up to the data, as np.save does
+        header = header.ljust(_NPY_HEADER_SIZE - len(magic) - 3) + '\n'
+        self._file.seek(0)
+        self._file.write(magic + struct.pack('<H', len(header)) + header.encode('latin1'))
+        self._file.close()
+
+
+class _StoreWriter(object):
+    """write the arrays of a store from the flat targets of consecutive chunks of images"""
+
+    def __init__(self, store_path):
+        if not os.path.isdir(store_path):
+            os.makedirs(store_path)
+        self.store_path = store_path
+        config_file = os.path.join(store_path, 'config.json')
+        if os.path.isfile(config_file):  # rebuilt: incomplete until config.json is written again
+            os.remove(config_file)
+        self._arrays = dict((array_name, _NpyAppender(os.path.join(store_path, array_name + '.npy'), dtype, row_shape))
+                            for array_name, dtype, row_shape in [('feat_sizes', np.int32, (2,)),
+                                                                 ('pos_offsets', np.int64, ()),
+                                                                 ('pos_idx', np.int32, ()),
+                                                                 ('pos_regr', np.float32, (4,)),
+                                                                 ('neg_offsets', np.int64, ()),
+                                                                 ('neg_idx', np.int32, ())])
+        self._arrays['pos_offsets'].append(np.zeros(1, dtype=np.int64))
+        self._arrays['neg_offsets'].append(np.zeros(1, dtype=np.int64))
+        self.pos_counts = []
+        self.neg_counts = []
+
+    def add(self, flat_targets):
+        for array_name in ('feat_sizes', 'pos_idx', 'pos_regr', 'neg_idx'):
+            self._arrays[array_name].append(flat_targets[array_name])
+        for kind, counts in (('pos', self.pos_counts), ('neg', self.neg_counts)):
+            # the offsets of the chunk follow the anchors written before it
+            nb_written = self._arrays[kind + '_idx'].nb_rows - len(flat_targets[kind + '_idx'])
+            self._arrays[kind + '_offsets'].append(nb_written + np.cumsum(flat_targets[kind + '_counts']))
+            counts.append(flat_targets[kind + '_counts'])
+
+    def close(self, config, file_names):
+        """
+        write the file names and the config
+        :return: int64 number of positive and negative anchors of each image
+        """
+        for array in self._arrays.values():
+            array.close()
+        encoded_names = [name.encode('utf-8') for name in file_names]
+        name_offsets = np.zeros(len(encoded_names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in encoded_names], out=name_offsets[1:])
+        np.save(os.path.join(self.store_path, 'names.npy'), np.frombuffer(b''.join(encoded_names), dtype=np.uint8))
+        np.save(os.path.join(self.store_path, 'name_offsets.npy'), name_offsets)
+        with open(os.path.join(self.store_path, 'config.json'), mode='w') as f:
+            json.dump(config, f, sort_keys=True)
+        return (np.concatenate(self.pos_counts + [np.zeros(0, dtype=np.int64)]),
+                np.concatenate(self.neg_counts + [np.zeros(0, dtype=np.int64)]))
+
+
+def write_rpn_target_store(store_path, config, file_names, targets_list):
+    """write the store from the RPNTargets of each image"""
+    writer = _StoreWriter(store_path)
+    writer.add(_flatten_targets(targets_list))
+    writer.close(config, file_names)
+
+
+def _compute_flat_targets(img_infos, config, resized_img_min_size, compute_feature_sizes):
+    """flat targets of a chunk of images and the report of the rpn counters (instrumentation) of the chunk"""
+    recorder = instrumentation.StatsRecorder()
+    previous_recorder = instrumentation.set_recorder(recorder)
+    try:
+        targets_list = [compute_img_rpn_targets(img_info, config, resized_img_min_size, compute_feature_sizes)
+                        for img_info in img_infos]
+    finally:
+        instrumentation.set_recorder(previous_recorder)
+    return _flatten_targets(targets_list), recorder.report()
+
+
+_worker_args = None  # (all_info, config, resized_img_min_size, compute_feature_sizes) of a worker process
+
+
+def _init_rpn_targets_worker(all_info, config, resized_img_min_size, compute_feature_sizes):
+    global _worker_args
+    _worker_args = (all_info, config, resized_img_min_size, compute_feature_sizes)
+
+
+def _rpn_targets_worker(chunk):
+    """
+    worker of build_rpn_target_store: compute the targets of the images all_info[start:end], the arrays are sent
+    back in the shared memory block shm_name (created here, unlinked by the parent) instead of being pickled
+    :return: layout (array name, dtype, shape, offset) of the arrays in the block, counters report
+    """
+    start, end, shm_name = chunk
+    all_info, config, resized_img_min_size, compute_feature_sizes = _worker_args
+    flat_targets, report = _compute_flat_targets(all_info[start:end], config, resized_img_min_size,
+                                                 compute_feature_sizes)
+    layout = []
+    nb_bytes = 0
+    for array_name in sorted(flat_targets):
+        array = flat_targets[array_name]
+        layout.append((array_name, array.dtype.str, array.shape, nb_bytes))
+        nb_bytes += (array.nbytes + 7) // 8 * 8  # keep every array 8 bytes aligned
+    shm = shared_memory.SharedMemory(name=shm_name, create=True, size=max(1, nb_bytes))
+    try:
+        for array_name, dtype, shape, offset in layout:
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[...] = flat_targets[array_name]
+        return layout, report
+    finally:
+        shm.close()
+
+
+def _read_shared_targets(shm_name, layout):
+    """copy the arrays of a worker out of its shared memory block, then free the block"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        return dict((array_name, np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset).copy())
+                    for array_name, dtype, shape, offset in layout)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def _unlink_shared_targets(shm_name):
+    """free the block of a chunk that was not read (failed build), if its worker got to create it"""
+    try:
+        shm = shared_memory.SharedMemory(name=shm_name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def rpn_target_stats(pos_counts, neg_counts, nb_gt_boxes, counters):
+    """
+    dataset statistics of the targets
+    :param pos_counts, neg_counts: number of positive and negative anchors of each image
+    :param counters: rpn counters (instrumentation) of the computation, e.g. rpn.bbox_no_positive_anchor
+    """
+    pos_counts = np.asarray(pos_counts, dtype=np.int64)
+    neg_counts = np.asarray(neg_counts, dtype=np.int64)
+    stats = {'nb_imgs': len(pos_counts), 'nb_gt_boxes': int(nb_gt_boxes),
+             'nb_gt_boxes_no_positive_anchor': int(counters.get('rpn.bbox_no_positive_anchor', 0)),
+             'nb_anchors': {'positive': int(pos_counts.sum()), 'negative': int(neg_counts.sum()),
+                            'neutral': int(counters.get('rpn.anchors_neutral', 0))}}
+    if len(pos_counts) > 0:
+        percentiles = [0, 5, 25, 50, 75, 95, 100]
+        stats['positive_anchors_per_img'] = {
+            'mean': float(pos_counts.mean()),
+            'percentiles': dict(zip([str(p) for p in percentiles],
+                                    np.percentile(pos_counts, percentiles).tolist())),
+            'nb_imgs_without_positive': int((pos_counts == 0).sum()),
+            'histogram': np.bincount(pos_counts).tolist()}
+        stats['negative_anchors_per_img'] = {'mean': float(neg_counts.mean()), 'min': int(neg_counts.min()),
+                                             'max': int(neg_counts.max())}
+    return stats
+
+
+def build_rpn_target_store(bbox_info_file, store_dir, config, resized_img_min_size=600,
+                           compute_feature_sizes=compute_feat_size_resnet, data_dir_path='/data/hav16/imagenet/',
+                           nb_workers=1, chunk_size=256):
+    """
+    batch job: compute the deterministic rpn targets of every image of bbox_info_file (e.g. clean_bbox.txt)
+    and their statistics (stats.json of the store, see rpn_target_stats)
+    :param nb_workers: with nb_workers > 1 chunks of chunk_size images are computed by a pool of processes, which
+    send their targets back through shared memory. The store is the same as with a single process.
+    None uses all cpus. Either way the targets are written to the store chunk by chunk.
+    :return: path of the store, store_dir/rpn_targets_<hash of the config and of bbox_info_file>
+    """
+    start_time = time.time()
+    all_info, _, _ = bbox_parser(bbox_info_file, data_dir_path)
+    store_path = get_store_path(store_dir, config, resized_img_min_size, compute_feature_sizes, bbox_info_file,
+                                data_dir_path)
+    if nb_workers is None:
+        nb_workers = multiprocessing.cpu_count()
+    chunks = [(start, min(start + chunk_size, len(all_info))) for start in range(0, len(all_info), chunk_size)]
+    nb_workers = max(1, min(nb_workers, len(chunks)))
+
+    writer = _StoreWriter(store_path)
+    recorder = instrumentation.StatsRecorder()
+    if nb_workers == 1:
+        for start, end in chunks:
+            flat_targets, report = _compute_flat_targets(all_info[start:end], config, resized_img_min_size,
+                                                         compute_feature_sizes)
+            writer.add(flat_targets)
+            recorder.merge(report)
+    else:
+        # the blocks are named by the parent, so the ones not read yet can be freed whatever happens to the workers.
+        # The resource tracker is started before the pool so the workers share it with the parent: a worker
+        # starting its own tracker would unlink its blocks (with a leak warning) when it exits
+        resource_tracker.ensure_running()
+        shm_prefix = 'rpn_%d_%s_' % (os.getpid(), binascii.hexlify(os.urandom(4)).decode('ascii'))
+        chunks = [(start, end, shm_prefix + str(chunk_idx)) for chunk_idx, (start, end) in enumerate(chunks)]
+        pool = multiprocessing.Pool(nb_workers, initializer=_init_rpn_targets_worker,
+                                    initargs=(all_info, config, resized_img_min_size, compute_feature_sizes))
+        nb_read = 0
+        try:
+            # in order, the parent writes the finished chunks out of shared memory while the workers go on
+            for layout, report in pool.imap(_rpn_targets_worker, chunks):
+                nb_read += 1  # the block is unlinked by _read_shared_targets even if the copy fails
+                writer.add(_read_shared_targets(chunks[nb_read - 1][2], layout))
+                recorder.merge(report)
+        except BaseException:
+            pool.terminate()  # stop the remaining chunks
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            for _, _, shm_name in chunks[nb_read:]:
+                _unlink_shared_targets(shm_name)
+    pos_counts, neg_counts = writer.close(config, [img_info['file_path'] for img_info in all_info])
+
+    counters = recorder.report()['counters']
+    if hasattr(instrumentation.get_recorder(), 'merge'):
+        instrumentation.get_recorder().merge(recorder.report())
+    stats = rpn_target_stats(pos_counts, neg_counts, sum(len(img_info['bbox']) for img_info in all_info), counters)
+    stats['elapsed'] = time.time() - start_time
+    stats['nb_workers'] = nb_workers
+    with open(os.path.join(store_path, 'stats.json'), mode='w') as f:
+        json.dump(stats, f, indent=1, sort_keys=True)
+    print('rpn targets of %d images with %d worker(s) in %.1fs: %.1f positive anchors per image, '
+          '%d gt boxes without positive anchor'
+          % (len(all_info), nb_workers, stats['elapsed'], stats.get('positive_anchors_per_img', {}).get('mean', 0.),
+             stats['nb_gt_boxes_no_positive_anchor']))
+    return store_path
+
+
+class RPNTargetStore(object):
+    """read a store built by build_rpn_target_store (memory-mapped) and sample the rpn targets of an image"""
+
+    def __init__(self, store_path):
+        for array_name in _ARRAY_NAMES:
+            setattr(self, array_name, np.load(os.path.join(store_path, array_name + '.npy'), mmap_mode='r'))
+        with open(os.path.join(store_path, 'config.json')) as f:
+            self.config = json.load(f)
+        self.n_anchors = len(self.config['anchor_sizes']) * len(self.config['anchor_ratios'])
+        stats_file = os.path.join(store_path, 'stats.json')
+        self.stats = None
+        if os.path.isfile(stats_file):
+            with open(stats_file) as f:
+                self.stats = json.load(f)
+        self._file_to_idx = None
+
+    def __len__(self):
+        return len(self.feat_sizes)
+
+    def file_path(self, img_idx):
+        return self.names[self.name_offsets[img_idx]:self.name_offsets[img_idx + 1]].tobytes().decode('utf-8')
+
+    def img_idx(self, file_path):
+        if self._file_to_idx is None:
+            self._file_to_idx = dict((self.file_path(i), i) for i in range(len(self)))
+        return self._file_to_idx[file_path]
+
+    def targets(self, img_idx):
+        """RPNTargets of an image (views on the store)"""
+        pos_start, pos_end = self.pos_offsets[img_idx], self.pos_offsets[img_idx + 1]
+        neg_start, neg_end = self.neg_offsets[img_idx], self.neg_offsets[img_idx + 1]
+        feat_width, feat_height = self.feat_sizes[img_idx]
+        return make_rpn_targets(feat_width, feat_height, self.n_anchors, self.pos_idx[pos_start:pos_end],
+                                self.pos_regr[pos_start:pos_end], self.neg_idx[neg_start:neg_end])
+
+    def sampled_targets(self, img_idx, num_regions=256):
+        """the only part of the targets computed at train time"""
+        return sample_rpn_targets(self.targets(img_idx), num_regions)
+
+    def rpn_of_img(self, img_idx, num_regions=256):
+        """same outputs as compute_rpn_of_img: y_rpn_class, y_rpn_regr"""
+        return expand_rpn_targets([self.sampled_targets(img_idx, num_regions)])
+
+
+if __name__ == '__main__':
+    import sys
+    # usage: python rpn_target_store.py bbox_info_file store_dir [data_dir_path] [nb_workers]
+    default_config = {'down_scale': 16, 'anchor_sizes': [64, 128, 256],
+                      'anchor_ratios': [[1, 1], [1, 2], [2, 1], [2, 2]], 'upper_bound_iou': 0.65,
+                      'lower_bound_iou': 0.3}
+    data_dir_path = sys.argv[3] if len(sys.argv) > 3 else '/data/hav16/imagenet/'
+    nb_workers = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    print(build_rpn_target_store(sys.argv[1], sys.argv[2], default_config, data_dir_path=data_dir_path,
+                                 nb_workers=nb_workers))
@@ -0,0 +1,102 @@
+"""
+Compact rpn targets: instead of the dense float64 (feat_height, feat_width, n_anchors) arrays of compute_rpn_of_img,
+an image only keeps the flat indexes (int32, in the (anchor_idx, feat_y, feat_x) layout of y_rpn_class, sorted) of
+its positive and negative anchors and the float32 regression of its positive anchors, i.e. a few KB instead of a few
+MB, cheap to store or to send between processes. The dense y_rpn_class and y_rpn_regr are only built for a whole
+batch by expand_rpn_targets, when the model needs them.
+compute_rpn_targets -> sample_rpn_targets -> expand_rpn_targets gives the same outputs as compute_rpn_of_img
+(up to the float32 rounding of the regression) for the same random state.
+"""
+
+import random
+import numpy as np
+from collections import namedtuple
+from bbox_helper import get_bbox_list_resized
+from rpn_helper import get_anchor_grid, _label_anchors_sparse
+import instrumentation
+
+# pos_is_valid: bool (nb_pos,), False for positive anchors turned off by sample_rpn_targets, they stay in y_rpn_overlap
+# and y_rpn_regr but not in y_is_box_valid, as in sample_rpn_regions
+RPNTargets = namedtuple('RPNTargets', ['feat_width', 'feat_height', 'n_anchors', 'pos_idx', 'pos_regr', 'neg_idx',
+                                       'pos_is_valid'])
+
+
+def make_rpn_targets(feat_width, feat_height, n_anchors, pos_idx, pos_regr, neg_idx):
+    return RPNTargets(int(feat_width), int(feat_height), int(n_anchors), np.asarray(pos_idx, dtype=np.int32),
+                      np.asarray(pos_regr, dtype=np.float32).reshape(-1, 4), np.asarray(neg_idx, dtype=np.int32),
+                      np.ones(len(pos_idx), dtype=bool))
+
+
+def compute_rpn_targets(img_info, config, width, height, resized_width, resized_height, compute_feature_sizes):
+    """
+    deterministic part of compute_rpn_of_img (as compute_rpn_labels) in compact form
+    :param img_info: all_info from bbox_parser but for each image only
+    :return: RPNTargets
+    """
+    ground_truth_bb_list = get_bbox_list_resized(img_info['bbox'], width, height, resized_width, resized_height)
+    feat_width, feat_height = compute_feature_sizes(resized_width, resized_height)
+    anchors, anchor_idx = get_anchor_grid(resized_width, resized_height, config, compute_feature_sizes)
+    pos_idx, pos_regr, neg_idx = _label_anchors_sparse(ground_truth_bb_list, config, anchors, anchor_idx,
+                                                       feat_width, feat_height)
+    n_anchors = len(config['anchor_sizes']) * len(config['anchor_ratios'])
+    return make_rpn_targets(feat_width, feat_height, n_anchors, pos_idx, pos_regr, neg_idx)
+
+
+def sample_rpn_targets(targets, num_regions=256):
+    """
+    random part of compute_rpn_of_img (as sample_rpn_regions): keep at most num_regions valid anchors,
+    at most half of them positive
+    :param targets: RPNTargets of compute_rpn_targets (not sampled yet)
+    :return: RPNTargets
+    """
+    num_pos = len(targets.pos_idx)
+    pos_is_valid = np.ones(num_pos, dtype=bool)
+    if num_pos > num_regions // 2:
+        pos_is_valid[random.sample(range(num_pos), num_pos - num_regions // 2)] = False
+        num_pos = num_regions // 2
+
+    neg_idx = targets.neg_idx
+    if len(neg_idx) + num_pos > num_regions:
+        neg_is_valid = np.ones(len(neg_idx), dtype=bool)
+        neg_is_valid[random.sample(range(len(neg_idx)), len(neg_idx) + num_pos - num_regions)] = False
+        neg_idx = neg_idx[neg_is_valid]
+    instrumentation.count('rpn.sampled_positive', num_pos)
+    instrumentation.count('rpn.sampled_negative', len(neg_idx))
+    return targets._replace(neg_idx=neg_idx, pos_is_valid=pos_is_valid)
+
+
+def expand_rpn_targets(targets_list, dtype=np.float64):
+    """
+    dense targets of a batch, images of different feature map sizes are zero padded at the bottom/right
+    (as collate_rpn_samples)
+    :param targets_list: RPNTargets of each image, with the same n_anchors
+    :return: y_rpn_class (B, 2 * n_anchors, feat_height, feat_width), y_rpn_regr (B, 8 * n_anchors, ...)
+    """
+    n_anchors = targets_list[0].n_anchors
+    max_feat_height = max(targets.feat_height for targets in targets_list)
+    max_feat_width = max(targets.feat_width for targets in targets_list)
+    y_rpn_class = np.zeros((len(targets_list), 2 * n_anchors, max_feat_height, max_feat_width), dtype=dtype)
+    y_rpn_regr = np.zeros((len(targets_list), 8 * n_anchors, max_feat_height, max_feat_width), dtype=dtype)
+    for img_idx, targets in enumerate(targets_list):
+        if targets.n_anchors != n_anchors:
+            raise ValueError('all images of a batch must have the same number of anchors')
+        nb_locs = targets.feat_height * targets.feat_width
+        valid_idx = np.concatenate([targets.pos_idx[targets.pos_is_valid], targets.neg_idx])
+        valid_channels, valid_locs = np.divmod(valid_idx, nb_locs)
+        valid_ys, valid_xs = np.divmod(valid_locs, targets.feat_width)
+        y_rpn_class[img_idx, valid_channels, valid_ys, valid_xs] = 1
+
+        pos_channels, pos_locs = np.divmod(targets.pos_idx, nb_locs)
+        pos_ys, pos_xs = np.divmod(pos_locs, targets.feat_width)
+        y_rpn_class[img_idx, n_anchors + pos_channels, pos_ys, pos_xs] = 1
+        # first half: y_rpn_overlap repeated 4 times, second half: the regression
+        regr_channels = 4 * pos_channels[:, np.newaxis] + np.arange(4)
+        pos_ys, pos_xs = pos_ys[:, np.newaxis], pos_xs[:, np.newaxis]
+        y_rpn_regr[img_idx, regr_channels, pos_ys, pos_xs] = 1
+        y_rpn_regr[img_idx, 4 * n_anchors + regr_channels, pos_ys, pos_xs] = targets.pos_regr
+    return y_rpn_class, y_rpn_regr
+
+
+def rpn_targets_nbytes(targets):
+    """memory used by the arrays of RPNTargets"""
+    return targets.pos_idx.nbytes + targets.pos_regr.nbytes + targets.neg_idx.nbytes + targets.pos_is_valid.nbytes
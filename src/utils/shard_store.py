@@ -0,0 +1,273 @@
+"""
+Packed shards of a dataset: the jpeg bytes of the images and their boxes (from a bbox info file, e.g.
+clean_bbox.txt) appended into a few large shard files, so training reads a few large files sequentially instead of
+millions of small files. A shard store is a directory of:
+    shard_00000.bin, ...  records, one per image, appended until a shard reaches max_shard_bytes:
+                          header (RECORD_HEADER: jpeg size, width, height, nb boxes, file name size),
+                          file name (utf-8), boxes int32 (nb boxes, 4) xmin, ymin, xmax, ymax,
+                          class ids uint16 (nb boxes,), jpeg bytes
+    index.npy             int64 (nb_imgs, 3) shard, offset and size of the record of each image
+    names.npy             uint8 utf-8 bytes of all file names concatenated
+    name_offsets.npy      int64 (nb_imgs + 1,) file name of image i is names[name_offsets[i]:name_offsets[i + 1]]
+    name_order.npy        int64 (nb_imgs,) indexes of the images sorted by file name, to find an image by its name
+    classes.txt           class names, one per line, in the order of class_to_idx of bbox_parser
+Records are self-describing, so a shard can be streamed without the index (ShardReader.iter_records), the index
+gives random access to an image through a memory map of its shard (ShardReader.record).
+usage: python shard_store.py bbox_info_file img_dir_or_tar shard_dir [max_shard_mb]
+"""
+
+import os
+import io
+import mmap
+import random
+import struct
+import numpy as np
+from bbox_helper import BBoxStream
+from img_utils import load_img, load_img_resized
+import tar_source
+import instrumentation
+
+RECORD_HEADER = struct.Struct('<IiiHH')
+SHARD_READ_BUFFER = 16 * 1024 ** 2
+
+
+def _shard_file(shard_dir, shard_idx):
+    return os.path.join(shard_dir, 'shard_%05d.bin' % shard_idx)
+
+
+def _encode_record(file_name, width, height, boxes, class_ids, jpeg_bytes):
+    encoded_name = file_name.encode('utf-8')
+    header = RECORD_HEADER.pack(len(jpeg_bytes), width, height, len(boxes), len(encoded_name))
+    return b''.join([header, encoded_name, np.asarray(boxes, dtype='<i4').tobytes(),
+                     np.asarray(class_ids, dtype='<u2').tobytes(), jpeg_bytes])
+
+
+def _decode_record(buffer, offset=0):
+    """file name, width, height, boxes int32 (n, 4), class ids uint16 (n,) and jpeg bytes of the record at offset
+    of buffer (bytes or mmap), and the size of the record"""
+    jpeg_size, width, height, nb_boxes, name_size = RECORD_HEADER.unpack_from(buffer, offset)
+    offset += RECORD_HEADER.size
+    file_name = bytes(buffer[offset:offset + name_size]).decode('utf-8')
+    offset += name_size
+    boxes = np.frombuffer(buffer[offset:offset + 16 * nb_boxes], dtype='<i4').reshape(-1, 4)
+    offset += 16 * nb_boxes
+    class_ids = np.frombuffer(buffer[offset:offset + 2 * nb_boxes], dtype='<u2')
+    offset += 2 * nb_boxes
+    jpeg_bytes = bytes(buffer[offset:offset + jpeg_size])
+    record_size = RECORD_HEADER.size + name_size + 18 * nb_boxes + jpeg_size
+    return (file_name, width, height, boxes, class_ids, jpeg_bytes), record_size
+
+
+class ShardWriter(object):
+    """append records to the shards of shard_dir, close() writes the index"""
+
+    def __init__(self, shard_dir, class_names, max_shard_bytes=1024 ** 3):
+        if not os.path.isdir(shard_dir):
+            os.makedirs(shard_dir)
+        self.shard_dir = shard_dir
+        self.class_names = list(class_names)
+        self.max_shard_bytes = max_shard_bytes
+        self.index = []
+        self.encoded_names = []
+        self.shard_idx = -1
+        self.shard_size = 0
+        self._file = None
+
+    def add(self, file_name, width, height, boxes, class_ids, jpeg_bytes):
+        record = _encode_record(file_name, width, height, boxes, class_ids, jpeg_bytes)
+        if self._file is None or (self.shard_size > 0 and self.shard_size + len(record) > self.max_shard_bytes):
+            if self._file is not None:
+                self._file.close()
+            self.shard_idx += 1
+            self.shard_size = 0
+            self._file = open(_shard_file(self.shard_dir, self.shard_idx), mode='wb')
+        self._file.write(record)
+        self.index.append((self.shard_idx, self.shard_size, len(record)))
+        self.encoded_names.append(file_name.encode('utf-8'))
+        self.shard_size += len(record)
+
+    def close(self, class_names=None):
+        """close the last shard and write the index, class_names replaces the ones given to the constructor"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if class_names is not None:
+            self.class_names = list(class_names)
+        name_offsets = np.zeros(len(self.encoded_names) + 1, dtype=np.int64)
+        np.cumsum([len(name) for name in self.encoded_names], out=name_offsets[1:])
+        np.save(os.path.join(self.shard_dir, 'index.npy'), np.array(self.index, dtype=np.int64).reshape(-1, 3))
+        np.save(os.path.join(self.shard_dir, 'names.npy'), np.frombuffer(b''.join(self.encoded_names), dtype=np.uint8))
+        np.save(os.path.join(self.shard_dir, 'name_offsets.npy'), name_offsets)
+        name_order = sorted(range(len(self.encoded_names)), key=self.encoded_names.__getitem__)
+        np.save(os.path.join(self.shard_dir, 'name_order.npy'), np.array(name_order, dtype=np.int64))
+        with open(os.path.join(self.shard_dir, 'classes.txt'), mode='w') as f:
+            for class_name in self.class_names:
+                f.write(class_name + '\n')
+        return self.shard_idx + 1
+
+
+def write_shards(bbox_info_file, img_dir, shard_dir, max_shard_bytes=1024 ** 3):
+    """
+    pack the images of a bbox info file and their boxes into shards, in the order of the file
+    :param img_dir: directory or uncompressed .tar (tar_source.py) of the jpegs, images not found are skipped
+    :return: number of images packed, number of images not found, number of shards
+    """
+    tar_reader = tar_source.TarReader(img_dir) if tar_source.is_archive(img_dir) else None
+    stream = BBoxStream(bbox_info_file, data_dir_path='/')  # file_path is then '/' + file name
+    writer = ShardWriter(shard_dir, [], max_shard_bytes)
+    nb_missing = 0
+    for img_info in stream:
+        file_name = img_info['file_path'][1:]
+        try:
+            if tar_reader is not None:
+                jpeg_bytes = tar_reader.read(file_name)
+            else:
+                with open(os.path.join(img_dir, file_name), mode='rb') as f:
+                    jpeg_bytes = f.read()
+        except (IOError, KeyError):
+            nb_missing += 1
+            continue
+        writer.add(file_name, img_info['width'], img_info['height'], img_info['boxes'], img_info['class_ids'],
+                   jpeg_bytes)
+    class_names = [class_name for class_name in stream.class_to_idx if class_name != 'bg']
+    if len(class_names) > np.iinfo(np.uint16).max:
+        raise ValueError('too many classes for uint16 class ids: %d' % len(class_names))
+    nb_shards = writer.close(class_names)
+    instrumentation.count('shards.imgs_packed', len(writer.index))
+    instrumentation.count('shards.imgs_missing', nb_missing)
+    return len(writer.index), nb_missing, nb_shards
+
+
+class ShardReader(object):
+    """
+    read the images of a shard store, either by index (record, through a memory map of each shard) or streaming
+    the shards sequentially (iter_records). Can be sent to worker processes: only the paths are pickled, the index
+    and the shards are mapped again in each one.
+    Images are returned as (img_info, jpeg bytes), img_info in the format of bbox_parser.
+    Use reader.load_img as load_img of RPNDataLoader to train from the shards of the bbox info file.
+    """
+
+    def __init__(self, shard_dir, data_dir_path='/data/hav16/imagenet/'):
+        if data_dir_path[-1] != '/':
+            data_dir_path += '/'
+        self.shard_dir = shard_dir
+        self.data_dir_path = data_dir_path
+        self.index = np.load(os.path.join(shard_dir, 'index.npy'), mmap_mode='r')
+        self.names = np.load(os.path.join(shard_dir, 'names.npy'), mmap_mode='r')
+        self.name_offsets = np.load(os.path.join(shard_dir, 'name_offsets.npy'), mmap_mode='r')
+        self.name_order = np.load(os.path.join(shard_dir, 'name_order.npy'), mmap_mode='r')
+        with open(os.path.join(shard_dir, 'classes.txt')) as f:
+            self.class_names = [line.replace('\n', '') for line in f if line != '\n']
+        self.nb_shards = int(self.index[:, 0].max()) + 1 if len(self.index) > 0 else 0
+        self._maps = {}
+
+    def __getstate__(self):
+        return {'shard_dir': self.shard_dir, 'data_dir_path': self.data_dir_path}
+
+    def __setstate__(self, state):
+        self.__init__(state['shard_dir'], state['data_dir_path'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def file_name(self, img_idx):
+        return self._encoded_name(img_idx).decode('utf-8')
+
+    def img_idx(self, file_path):
+        """index of an image from its file path (or file name), binary search in the names sorted by name_order"""
+        encoded_name = file_path.rsplit('/', 1)[-1].encode('utf-8')
+        low, high = 0, len(self.name_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self._encoded_name(self.name_order[middle]) < encoded_name:
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(self.name_order) or self._encoded_name(self.name_order[low]) != encoded_name:
+            raise KeyError('%s not found in %s' % (file_path, self.shard_dir))
+        return int(self.name_order[low])
+
+    def _encoded_name(self, img_idx):
+        return self.names[self.name_offsets[img_idx]:self.name_offsets[img_idx + 1]].tobytes()
+
+    def _to_img_info(self, file_name, width, height, boxes, class_ids):
+        bbox = [{'class': self.class_names[class_id], 'xmin': xmin, 'ymin': ymin, 'xmax': xmax, 'ymax': ymax}
+                for (xmin, ymin, xmax, ymax), class_id in zip(boxes.tolist(), class_ids.tolist())]
+        return {'width': width, 'height': height, 'file_path': self.data_dir_path + file_name, 'bbox': bbox}
+
+    def _shard_map(self, shard_idx):
+        if shard_idx not in self._maps:
+            with open(_shard_file(self.shard_dir, shard_idx), mode='rb') as f:
+                self._maps[shard_idx] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[shard_idx]
+
+    def record(self, img_idx):
+        """(img_info, jpeg bytes) of an image, read from the memory map of its shard"""
+        shard_idx, offset, _ = self.index[img_idx]
+        fields, _ = _decode_record(self._shard_map(int(shard_idx)), int(offset))
+        return self._to_img_info(*fields[:5]), fields[5]
+
+    def all_info(self):
+        """img_info of all images in the format of bbox_parser, in one sequential pass"""
+        return [img_info for img_info, _ in self.iter_records()]
+
+    def iter_records(self, shard_ids=None, shuffle_buffer=0, seed=None):
+        """
+        (img_info, jpeg bytes) of the images of the shards, read sequentially with large buffered reads
+        :param shard_ids: shards to read, in this order (e.g. a disjoint subset for each data loader worker),
+        default to all of them, shuffled when shuffle_buffer > 0
+        :param shuffle_buffer: shuffle the records within a buffer of that many records (0: file order), a
+        record is drawn from the buffer once it is full, the larger the buffer the closer to a full shuffle
+        """
+        rng = random.Random(seed)
+        if shard_ids is None:
+            shard_ids = list(range(self.nb_shards))
+            if shuffle_buffer > 0:
+                rng.shuffle(shard_ids)
+        buffer = []
+        for shard_idx in shard_ids:
+            with open(_shard_file(self.shard_dir, shard_idx), mode='rb', buffering=SHARD_READ_BUFFER) as f:
+                while True:
+                    header = f.read(RECORD_HEADER.size)
+                    if len(header) < RECORD_HEADER.size:
+                        break
+                    jpeg_size, _, _, nb_boxes, name_size = RECORD_HEADER.unpack(header)
+                    content = f.read(name_size + 18 * nb_boxes + jpeg_size)
+                    fields, _ = _decode_record(header + content)
+                    item = (self._to_img_info(*fields[:5]), fields[5])
+                    if shuffle_buffer <= 0:
+                        yield item
+                        continue
+                    if len(buffer) < shuffle_buffer:
+                        buffer.append(item)
+                        continue
+                    draw = rng.randrange(shuffle_buffer)
+                    yield buffer[draw]
+                    buffer[draw] = item
+        rng.shuffle(buffer)
+        for item in buffer:
+            yield item
+
+    def open(self, file_path):
+        """file object of the jpeg of an image, in memory"""
+        return io.BytesIO(self.record(self.img_idx(file_path))[1])
+
+    def load_img(self, file_path):
+        """img_utils.load_img of an image of the shards"""
+        return load_img(self.open(file_path))
+
+    def load_img_resized(self, file_path, resized_width, resized_height):
+        """img_utils.load_img_resized of an image of the shards"""
+        return load_img_resized(self.open(file_path), resized_width, resized_height)
+
+    def close(self):
+        for shard_map in self._maps.values():
+            shard_map.close()
+        self._maps = {}
+
+
+if __name__ == '__main__':
+    import sys
+    max_shard_bytes = int(sys.argv[4]) * 1024 ** 2 if len(sys.argv) > 4 else 1024 ** 3
+    nb_imgs, nb_missing, nb_shards = write_shards(sys.argv[1], sys.argv[2], sys.argv[3], max_shard_bytes)
+    print('packed %d images into %d shards in %s, %d images not found' % (nb_imgs, nb_shards, sys.argv[3], nb_missing))
@@ -0,0 +1,155 @@
+"""
+Synthetic ImageNet-like dataset for offline benchmarks, in the layout read by bbox_reader and clean_data.py:
+    root/Annotation/<wnid>/<wnid>_<n>.xml  annotations in the format of the samples (the first sample is the template)
+    root/<wnid>_<n>.JPEG                   dummy jpegs (all the same small image made from a sample)
+    root/class_name.txt                    wnid,name of every class
+and bbox info files (csv of bbox_parser) can be written directly with write_synthetic_bbox_file.
+Like the real data, some annotated images have no jpeg, some jpegs have no annotation, some boxes are out of the
+image (dropped by box_is_valid) and some objects belong to a synset outside class_name.txt.
+Image sizes are drawn around the sizes of the samples, so boxes and rpn targets look like ImageNet ones.
+usage: python synthetic_data.py root_dir nb_imgs [nb_classes] [seed]
+"""
+
+import os
+import copy
+import random
+import xml.etree.ElementTree as ET
+from io import BytesIO
+from PIL import Image
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', '..', 'samples')
+
+
+def _sample_files(ext):
+    return sorted(os.path.join(SAMPLES_DIR, f) for f in os.listdir(SAMPLES_DIR) if f.endswith(ext))
+
+
+def _sample_sizes():
+    sizes = []
+    for xml_file in _sample_files('.xml'):
+        size = ET.parse(xml_file).getroot().find('size')
+        sizes.append((int(size.findtext('width')), int(size.findtext('height'))))
+    return sizes
+
+
+def _dummy_jpeg_bytes(size=(32, 24)):
+    with Image.open(_sample_files('.JPEG')[0]) as img:
+        small = img.convert('RGB').resize(size, resample=Image.BILINEAR)
+    buffer = BytesIO()
+    small.save(buffer, format='JPEG', quality=75)
+    return buffer.getvalue()
+
+
+def _annotation_xml(template, wnid, file_name, width, height, objects):
+    """xml of an annotation, objects is a list of (wnid, xmin, ymin, xmax, ymax)"""
+    root = copy.deepcopy(template)
+    root.find('folder').text = wnid
+    root.find('filename').text = file_name
+    size = root.find('size')
+    size.find('width').text = str(width)
+    size.find('height').text = str(height)
+    template_objects = root.findall('object')
+    for ob in template_objects:
+        root.remove(ob)
+    for object_wnid, xmin, ymin, xmax, ymax in objects:
+        ob = copy.deepcopy(template_objects[0])
+        ob.find('name').text = object_wnid
+        bb = ob.find('bndbox')
+        bb.find('xmin').text = str(xmin)
+        bb.find('ymin').text = str(ymin)
+        bb.find('xmax').text = str(xmax)
+        bb.find('ymax').text = str(ymax)
+        root.append(ob)
+    if len(objects) > 0:
+        ob.tail = template_objects[-1].tail  # indentation of the closing tag
+    return ET.tostring(root)
+
+
+def generate_synthetic_dataset(root_dir, nb_imgs, nb_classes=10, seed=0, max_nb_bbox=4, lacking_img_ratio=0.05,
+                               no_bbox_img_ratio=0.1, invalid_box_ratio=0.02, other_synset_ratio=0.02):
+    """
+    write a synthetic dataset of nb_imgs annotated images under root_dir
+    :param lacking_img_ratio: ratio of annotated images without jpeg
+    :param no_bbox_img_ratio: number of jpegs without annotation, as a ratio of nb_imgs
+    :param invalid_box_ratio: ratio of boxes out of the image
+    :param other_synset_ratio: ratio of objects of a synset that is not in class_name.txt
+    :return: dict of annotation_path, img_dir, class_name_file, nb_xml, nb_jpeg
+    """
+    rng = random.Random(seed)
+    template = ET.parse(_sample_files('.xml')[0]).getroot()
+    sizes = _sample_sizes()
+    jpeg_bytes = _dummy_jpeg_bytes()
+    wnids = ['n%08d' % (1000000 + i) for i in range(nb_classes)]
+    annotation_path = os.path.join(root_dir, 'Annotation')
+    for wnid in wnids:
+        folder = os.path.join(annotation_path, wnid)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+    class_name_file = os.path.join(root_dir, 'class_name.txt')
+    with open(class_name_file, mode='w') as f:
+        for i, wnid in enumerate(wnids):
+            f.write('%s,class%d\n' % (wnid, i))
+
+    nb_jpeg = 0
+    for img_idx in range(nb_imgs):
+        wnid = wnids[img_idx % nb_classes]
+        file_name = '%s_%d' % (wnid, img_idx)
+        base_width, base_height = sizes[rng.randrange(len(sizes))]
+        width = max(64, int(base_width * rng.uniform(0.7, 1.3)))
+        height = max(64, int(base_height * rng.uniform(0.7, 1.3)))
+        objects = []
+        for _ in range(rng.randint(1, max_nb_bbox)):
+            xmin = rng.randint(0, width - 32)
+            ymin = rng.randint(0, height - 32)
+            xmax = rng.randint(xmin + 16, width)
+            ymax = rng.randint(ymin + 16, height)
+            if rng.random() < invalid_box_ratio:
+                xmax = width + rng.randint(1, 50)
+            object_wnid = 'n%08d' % (2000000 + rng.randrange(100)) if rng.random() < other_synset_ratio else wnid
+            objects.append((object_wnid, xmin, ymin, xmax, ymax))
+        with open(os.path.join(annotation_path, wnid, file_name + '.xml'), mode='wb') as f:
+            f.write(_annotation_xml(template, wnid, file_name, width, height, objects))
+        if rng.random() >= lacking_img_ratio:
+            with open(os.path.join(root_dir, file_name + '.JPEG'), mode='wb') as f:
+                f.write(jpeg_bytes)
+            nb_jpeg += 1
+    for img_idx in range(int(nb_imgs * no_bbox_img_ratio)):
+        with open(os.path.join(root_dir, '%s_nobbox%d.JPEG' % (wnids[img_idx % nb_classes], img_idx)), mode='wb') as f:
+            f.write(jpeg_bytes)
+        nb_jpeg += 1
+    return {'annotation_path': annotation_path, 'img_dir': root_dir, 'class_name_file': class_name_file,
+            'nb_xml': nb_imgs, 'nb_jpeg': nb_jpeg}
+
+
+def write_synthetic_bbox_file(bbox_info_file, nb_imgs, nb_classes=10, seed=0, max_nb_bbox=4):
+    """
+    write a bbox info file (csv of bbox_parser) of nb_imgs images with sizes and boxes drawn as in
+    generate_synthetic_dataset, without writing annotations or images
+    :return: number of lines
+    """
+    rng = random.Random(seed)
+    sizes = _sample_sizes()
+    nb_lines = 0
+    with open(bbox_info_file, mode='w') as f:
+        for img_idx in range(nb_imgs):
+            class_idx = img_idx % nb_classes
+            base_width, base_height = sizes[rng.randrange(len(sizes))]
+            width = max(64, int(base_width * rng.uniform(0.7, 1.3)))
+            height = max(64, int(base_height * rng.uniform(0.7, 1.3)))
+            lines = []
+            for _ in range(rng.randint(1, max_nb_bbox)):
+                xmin = rng.randint(0, width - 32)
+                ymin = rng.randint(0, height - 32)
+                lines.append('n%08d_%d.JPEG,%d,%d,%d,%d,%d,%d,class%d\n'
+                             % (1000000 + class_idx, img_idx, width, height, xmin, ymin,
+                                rng.randint(xmin + 16, width), rng.randint(ymin + 16, height), class_idx))
+            f.write(''.join(lines))
+            nb_lines += len(lines)
+    return nb_lines
+
+
+if __name__ == '__main__':
+    import sys
+    nb_classes = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+    print(generate_synthetic_dataset(sys.argv[1], int(sys.argv[2]), nb_classes, seed))
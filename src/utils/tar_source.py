@@ -0,0 +1,191 @@
+"""
+Read the ImageNet annotations and images from the .tar archives they come in, without extracting them.
+iter_archive_members streams the members of an archive (compressed or not) one at a time into memory, e.g. to feed
+the xml parser. Archives found inside an archive (like the per synset .tar.gz of Annotation.tar.gz) are streamed
+in place.
+TarReader gives random access to the members of an uncompressed .tar (e.g. the jpegs of the dataset, also as a .tar
+of per synset .tar like the ImageNet train images) by reading at their offset. The member -> (offset, size) index is
+built with one pass over the tar headers and cached next to the archive (tar_path.index.pkl), so reopening an
+archive only loads the index.
+bbox_reader.generate_img_bbox and clean_data accept an archive instead of a directory.
+"""
+
+import os
+import io
+import pickle
+import tarfile
+import threading
+import instrumentation
+from img_utils import load_img, load_img_resized
+
+ARCHIVE_EXTS = ('.tar', '.tar.gz', '.tgz')
+
+
+def is_archive(path):
+    return os.path.isfile(path) and path.endswith(ARCHIVE_EXTS)
+
+
+def iter_archive_members(archive, ext=None):
+    """
+    (member name, content) of the regular files of an archive, in archive order, in a single sequential pass
+    :param archive: path or file object of a .tar, .tar.gz or .tgz
+    :param ext: only yield the members with this extension (members of nested archives too)
+    """
+    if isinstance(archive, str):
+        tar = tarfile.open(archive, mode='r|*')
+    else:
+        tar = tarfile.open(fileobj=archive, mode='r|*')
+    with tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            if member.name.endswith(ARCHIVE_EXTS):
+                for nested_member in iter_archive_members(tar.extractfile(member), ext):
+                    yield nested_member
+            elif ext is None or member.name.endswith(ext):
+                yield member.name, tar.extractfile(member).read()
+
+
+def _index_members(tar, base_offset, prefix, members):
+    for member in tar:
+        if not member.isfile():
+            continue
+        if member.name.endswith('.tar'):
+            # archive in the archive (e.g. the per synset .tar of the ImageNet images): its members are indexed
+            # by their offset in the outer file, under nested archive name/member name
+            with tarfile.open(fileobj=tar.extractfile(member), mode='r:') as nested_tar:
+                _index_members(nested_tar, base_offset + member.offset_data, prefix + member.name + '/', members)
+        elif member.name.endswith(ARCHIVE_EXTS):
+            raise ValueError('random access needs uncompressed archives, %s%s is compressed' % (prefix, member.name))
+        else:
+            members[prefix + member.name] = (base_offset + member.offset_data, member.size)
+
+
+def build_tar_index(tar_path):
+    """
+    dict member name -> (offset of its data, size) of the regular files of an uncompressed .tar, the members of
+    the uncompressed .tar it contains (nested archive name/member name) are indexed too
+    """
+    members = {}
+    try:
+        with tarfile.open(tar_path, mode='r:') as tar:
+            _index_members(tar, 0, '', members)
+    except tarfile.ReadError:
+        raise ValueError('%s: random access needs an uncompressed .tar' % tar_path)
+    return members
+
+
+_INDEX_VERSION = 2
+_loaded_indexes = {}  # (tar_path, index_file) -> (signature, index), the indexes loaded by this process
+
+
+def load_tar_index(tar_path, index_file=None):
+    """
+    build_tar_index, cached in index_file (default tar_path.index.pkl) with the (size, mtime) of the archive:
+    the index is rebuilt only when the archive changed. Indexes are also kept in memory, loaded once per process.
+    :return: dict with members (build_tar_index) and file_members (file name without path -> (offset, size))
+    """
+    if index_file is None:
+        index_file = tar_path + '.index.pkl'
+    stat = os.stat(tar_path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+    loaded = _loaded_indexes.get((tar_path, index_file))
+    if loaded is not None and loaded[0] == signature:
+        return loaded[1]
+    index = None
+    if os.path.isfile(index_file):
+        with open(index_file, mode='rb') as f:
+            index = pickle.load(f)
+        if index.get('version') == _INDEX_VERSION and index['signature'] == signature:
+            instrumentation.count('tar.index_loaded')
+        else:
+            index = None
+    if index is None:
+        with instrumentation.timer('tar.build_index'):
+            members = build_tar_index(tar_path)
+        file_members = dict((name.rsplit('/', 1)[-1], member) for name, member in members.items())
+        index = {'version': _INDEX_VERSION, 'signature': signature, 'members': members,
+                 'file_members': file_members}
+        tmp_index_file = index_file + '.tmp'
+        with open(tmp_index_file, mode='wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_index_file, index_file)  # a crash never leaves a half written index
+    _loaded_indexes[(tar_path, index_file)] = (signature, index)
+    return index
+
+
+class TarReader(object):
+    """
+    random access to the members of an uncompressed .tar (and of the uncompressed .tar it contains), thread safe,
+    can be sent to worker processes: only the paths are pickled, each process opens the archive again and loads
+    the cached index once. A member is found by its name or, if not in the archive, by its file name
+    (the file_path of bbox_parser carries the data directory instead of the path in the archive).
+    Use reader.load_img as load_img of RPNDataLoader to train from the archive.
+    """
+
+    def __init__(self, tar_path, index_file=None):
+        self.tar_path = tar_path
+        self.index_file = index_file
+        self._index = load_tar_index(tar_path, index_file)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'tar_path': self.tar_path, 'index_file': self.index_file}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._index = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    @property
+    def members(self):
+        if self._index is None:
+            self._index = load_tar_index(self.tar_path, self.index_file)
+        return self._index['members']
+
+    @property
+    def file_members(self):
+        if self._index is None:
+            self._index = load_tar_index(self.tar_path, self.index_file)
+        return self._index['file_members']
+
+    def file_names(self, ext=None):
+        """file names (without path) of the members"""
+        return [name.rsplit('/', 1)[-1] for name in self.members if ext is None or name.endswith(ext)]
+
+    def _member(self, name):
+        if name in self.members:
+            return self.members[name]
+        try:
+            return self.file_members[name.rsplit('/', 1)[-1]]
+        except KeyError:
+            raise KeyError('%s not found in %s' % (name, self.tar_path))
+
+    def read(self, name):
+        """content of a member"""
+        offset, size = self._member(name)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.tar_path, mode='rb')
+            self._file.seek(offset)
+            return self._file.read(size)
+
+    def open(self, name):
+        """file object of a member, in memory"""
+        return io.BytesIO(self.read(name))
+
+    def load_img(self, file_path):
+        """img_utils.load_img of a member"""
+        return load_img(self.open(file_path))
+
+    def load_img_resized(self, file_path, resized_width, resized_height):
+        """img_utils.load_img_resized of a member"""
+        return load_img_resized(self.open(file_path), resized_width, resized_height)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None